@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark hashing a large set of local rpm's.
+
+Compares reading each file twice in 64KB read() calls (separate md5 and
+sha256 passes, as get_file_md5/get_file_sha256 used to) with
+s3yum.util.hash_files (one mmap'd pass per file, in a process pool):
+
+    python2.7 benchmarks/hashing.py [FILES] [SIZE_KB]
+
+The files are written first, so both runs hash from the page cache.
+"""
+
+import os
+import sys
+import time
+import shutil
+import hashlib
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from s3yum import util
+
+
+def read_hash(filepath, hasher):
+    with open(filepath, 'r') as afile:
+        buf = afile.read(65536)
+        while len(buf) > 0:
+            hasher.update(buf)
+            buf = afile.read(65536)
+    return hasher.hexdigest()
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 2000
+    size = int(argv[2]) * 1024 if len(argv) > 2 else 1024 * 1024
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        paths = []
+        for i in range(count):
+            paths.append(os.path.join(tmp_dir, 'pkg%05i.rpm' % i))
+            with open(paths[-1], 'w') as afile:
+                afile.write(os.urandom(size))
+
+        print "%i files of %iKB" % (count, size / 1024)
+        start = time.time()
+        old = [(read_hash(path, hashlib.md5()),
+                read_hash(path, hashlib.sha256())) for path in paths]
+        print "read() md5 + sha256 passes: %7.2fs" % (time.time() - start)
+
+        start = time.time()
+        util.hash_files(paths)
+        new = [(util.get_file_md5(path), util.get_file_sha256(path))
+               for path in paths]
+        print "hash_files, %2i processes:   %7.2fs" % (
+            multiprocessing.cpu_count(), time.time() - start)
+        assert old == new
+    finally:
+        shutil.rmtree(tmp_dir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
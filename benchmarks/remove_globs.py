@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark matching --remove globs against a large repo listing.
+
+Compares a per-name, per-glob fnmatch loop with s3yum.util.GlobMatcher:
+
+    python2.7 benchmarks/remove_globs.py [RPMS] [GLOBS]
+
+With more than 100 globs, fnmatch's pattern cache thrashes, so the loop
+recompiles every glob for every name; keep RPMS small when comparing.
+"""
+
+import os
+import sys
+import time
+import fnmatch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from s3yum.util import GlobMatcher
+
+
+def make_names(count):
+    return ['el7/x86_64/pkg%05i-%i.0-1.x86_64.rpm' % (i % (count / 10), i)
+            for i in range(count)]
+
+
+def make_globs(count):
+    globs = []
+    for i in range(count):
+        if i % 3 == 0:
+            globs.append('*/pkg%05i-*' % i)
+        elif i % 3 == 1:
+            globs.append('el7/x86_64/pkg%05i-1*' % i)
+        else:
+            globs.append('el7/x86_64/pkg%05i-%i.0-1.x86_64.rpm' % (i, i))
+    return globs
+
+
+def fnmatch_loop(names, globs):
+    removed = []
+    for name in names:
+        for glob in globs:
+            if fnmatch.fnmatch(name, glob):
+                removed.append(name)
+                break
+    return removed
+
+
+def glob_matcher(names, globs):
+    return GlobMatcher(globs).filter(names)
+
+
+def main(argv):
+    rpms = int(argv[1]) if len(argv) > 1 else 2000
+    globs = make_globs(int(argv[2]) if len(argv) > 2 else 150)
+    names = make_names(rpms)
+    print "%i rpm's, %i globs" % (len(names), len(globs))
+    results = []
+    for label, func in (('fnmatch loop', fnmatch_loop),
+                        ('GlobMatcher', glob_matcher)):
+        start = time.time()
+        results.append(func(names, globs))
+        print "%-14s %8.3fs  (%i matched)" % (
+            label, time.time() - start, len(results[-1]))
+    assert results[0] == results[1]
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark s3yum command line startup time.
+
+Runs each command REPEAT times in a fresh interpreter and prints the best
+and median wall clock times, plus the heavy modules each one loaded:
+
+    python2.7 benchmarks/startup.py [REPEAT]
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('boto', 'pkg_resources', 'subprocess')
+
+COMMANDS = [
+    ('import', ['-c', 'import s3yum.s3yum_cli']),
+    ('--help', ['-c', 'from s3yum.s3yum_cli import main\n'
+                      'try: main(["s3yum", "--help"])\n'
+                      'except SystemExit: pass']),
+    ('help', ['-c', 'from s3yum.s3yum_cli import main\n'
+                    'try: main(["s3yum", "help"])\n'
+                    'except SystemExit: pass']),
+]
+
+
+def loaded_modules(args):
+    """
+    Return the heavy modules loaded by running the command 'args'.
+    """
+    code = args[1] + (
+        '\nimport sys\nsys.stderr.write(",".join('
+        'm for m in %r if m in sys.modules))' % (HEAVY_MODULES,))
+    proc = subprocess.Popen(
+        [sys.executable, '-c', code], cwd=ROOT,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, err = proc.communicate()
+    return err.strip().splitlines()[-1] if err.strip() else ''
+
+
+def time_command(args, repeat):
+    """
+    Return the sorted wall clock times of 'repeat' runs of 'args'.
+    """
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.call([sys.executable] + args, cwd=ROOT,
+                            stdout=devnull, stderr=devnull)
+            times.append(time.time() - start)
+    return sorted(times)
+
+
+def main(argv):
+    repeat = int(argv[1]) if len(argv) > 1 else 20
+    print "%-8s %9s %9s  %s" % ('command', 'best', 'median', 'loaded')
+    for name, args in COMMANDS:
+        times = time_command(args, repeat)
+        print "%-8s %8.1fms %8.1fms  %s" % (
+            name, times[0] * 1000, times[len(times) // 2] * 1000,
+            loaded_modules(args) or '-')
+    return
+
+
+if __name__ == '__main__':
+    main(sys.argv)
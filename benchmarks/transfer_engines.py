@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark the transfer engines on many small objects.
+
+Serves a fake bucket from a local HTTP server which adds LATENCY_MS to
+every request, then downloads and uploads OBJECTS objects of SIZE_KB with
+each --engine (gevent only if it is installed), in a fresh interpreter
+each:
+
+    python2.7 benchmarks/transfer_engines.py [OBJECTS] [LATENCY_MS] [SIZE_KB]
+"""
+
+import os
+import sys
+import imp
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+import BaseHTTPServer
+import SocketServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BUCKET = 'bench'
+
+
+def payload(name, size):
+    return (hashlib.md5(name).hexdigest() * (size / 32 + 1))[:size]
+
+
+class FakeS3Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        return
+
+    def respond(self, body, etag):
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"%s"' % etag)
+        self.send_header('Last-Modified', 'Mon, 01 Jan 2018 00:00:00 GMT')
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+    def do_GET(self):
+        body = payload(self.path, self.server.size)
+        self.respond(body, hashlib.md5(body).hexdigest())
+        return
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.respond('', hashlib.md5(body).hexdigest())
+        return
+
+
+class FakeS3Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def run_engine(engine, port, objects, size):
+    """
+    Time downloading and uploading 'objects' objects with 'engine'. Runs in
+    its own interpreter, since gevent patches the socket module.
+    """
+    import boto.s3.key
+    import boto.s3.connection
+    from s3yum import s3yum_cli
+    from s3yum.s3yum_types import S3YumContext
+    from s3yum.engine import init_engine
+
+    context = S3YumContext()
+    s3yum_cli.parse_args(context, [
+        's3yum', '--engine', engine, '--workers', '16',
+        '--concurrency', '256', '--force-upload'])
+    s3yum_cli.verbose = lambda *args: None
+    init_engine(context)
+    conn = boto.s3.connection.S3Connection(
+        'key', 'secret', host='127.0.0.1', port=port, is_secure=False,
+        calling_format=boto.s3.connection.OrdinaryCallingFormat())
+    context.s3_bucket = conn.get_bucket(BUCKET, validate=False)
+
+    items = []
+    for i in range(objects):
+        item = boto.s3.key.Key(context.s3_bucket, 'repo/pkg%05i.rpm' % i)
+        body = payload('/%s/%s' % (BUCKET, item.name), size)
+        item.size = size
+        item.etag = '"%s"' % hashlib.md5(body).hexdigest()
+        items.append(item)
+
+    dest_dir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        s3yum_cli.download_items(context, items, dest_dir, True)
+        download = time.time() - start
+        start = time.time()
+        s3yum_cli.upload_directory(context, dest_dir, 'copy')
+        upload = time.time() - start
+    finally:
+        shutil.rmtree(dest_dir)
+    print "%-8s download %7.2fs  upload %7.2fs" % (engine, download, upload)
+    return 0
+
+
+def main(argv):
+    if len(argv) > 1 and argv[1] == '--engine':
+        return run_engine(argv[2], int(argv[3]), int(argv[4]), int(argv[5]))
+
+    objects = int(argv[1]) if len(argv) > 1 else 2000
+    latency = float(argv[2]) if len(argv) > 2 else 20
+    size = int(argv[3]) * 1024 if len(argv) > 3 else 32 * 1024
+
+    server = FakeS3Server(('127.0.0.1', 0), FakeS3Handler)
+    server.latency = latency / 1000.0
+    server.size = size
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    engines = ['threads']
+    try:
+        imp.find_module('gevent')
+        engines.append('gevent')
+    except ImportError:
+        print "gevent is not installed; only timing the threads engine"
+
+    print "%i objects of %iKB, %ims latency" % (objects, size / 1024, latency)
+    for engine in engines:
+        subprocess.check_call([
+            sys.executable, os.path.abspath(__file__), '--engine', engine,
+            str(server.server_address[1]), str(objects), str(size)])
+    server.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
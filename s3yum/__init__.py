@@ -6,16 +6,31 @@
 """
 __author__ =  'NYTD Edge Team'
 
-import pkg_resources
-try:
-    __version__ = pkg_resources.get_distribution('s3yum').version
-except pkg_resources.DistributionNotFound:
-    __version__ = '{0} local source'.format(__name__)
+# The single source of the version number: setup.py reads it from here,
+# rather than us asking pkg_resources (which scans every installed
+# distribution) at import time.
+__version__ = '1.6.4'
 
 __all__ = [
+    'batch',
+    'daemon',
+    'deltas',
+    'engine',
+    'lock',
+    'plan',
+    'progress',
+    'repo',
+    'metadata',
+    'query',
     's3yum_cli',
     's3yum_types',
-    'util'
+    'serve',
+    'snapshots',
+    'sqlitedb',
+    'stream',
+    'util',
+    'verify',
+    'watch'
     ]
 # EOF
 
@@ -0,0 +1,320 @@
+#!python
+# -*- coding: utf-8 -*-
+#==============================================================================
+#
+# s3yum: Repo creation/maintenance tool for S3-based yum repos
+#
+# Copyright 2013-2019 The New York Times Company
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+
+"""s3yum.batch: Update many repos in one bucket from a manifest file.
+
+The manifest is JSON (or YAML, if PyYAML is installed) listing the repos to
+update, and the rpm's to add to and remove from each:
+
+    {"repos": [
+        {"path": "el7/x86_64/stable",
+         "add": ["build/*.x86_64.rpm", "build/*.noarch.rpm"],
+         "remove": ["*/my_pkg-0.9-*"]},
+        {"path": "el7/x86_64/testing",
+         "add": ["build/*.x86_64.rpm", "build/*.noarch.rpm"]}
+    ]}
+
+Every repo is listed, and its changes worked out, before anything is
+modified. An rpm added to several repos is uploaded once and server-side
+copied to the others, and createrepo runs for all the repos in parallel
+worker processes.
+"""
+
+#----------------
+#    Imports:
+#----------------
+import os
+import re
+import copy
+import glob
+import json
+import datetime
+import itertools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import boto.s3.key
+
+from s3yum import s3yum_cli
+from s3yum.s3yum_types import (
+    UserError,
+    S3YumContext
+)
+from s3yum.engine import transfer_map
+from s3yum.util import (
+    s3join,
+    get_file_md5,
+    hash_files,
+    datetime_as_s3time
+)
+
+
+#----------------------------------------------
+#               Manifest:
+#----------------------------------------------
+def load_batch_manifest(filename):
+    """
+    Read the batch manifest 'filename', returning a list of
+    {'path': ..., 'add': [...], 'remove': [...]} dicts.
+    """
+    with open(filename, 'r') as manifest_file:
+        if filename.endswith(('.yml', '.yaml')):
+            try:
+                import yaml
+            except ImportError:
+                raise UserError("PyYAML is required to read %s" % filename)
+            try:
+                manifest = yaml.safe_load(manifest_file)
+            except yaml.YAMLError as ex:
+                raise UserError("Bad batch manifest %s: %s" % (filename, ex))
+        else:
+            try:
+                manifest = json.load(manifest_file)
+            except ValueError as ex:
+                raise UserError("Bad batch manifest %s: %s" % (filename, ex))
+
+    if isinstance(manifest, dict):
+        manifest = manifest.get('repos')
+    if not isinstance(manifest, list) or not manifest:
+        raise UserError("Batch manifest %s lists no repos" % filename)
+
+    entries = []
+    for entry in manifest:
+        if not isinstance(entry, dict) or not entry.get('path'):
+            raise UserError("Every repo in %s needs a 'path'" % filename)
+        entries.append({
+            'path': re.sub(r'^\/+', '', entry['path']),
+            'add': list(entry.get('add') or []),
+            'remove': list(entry.get('remove') or []),
+        })
+
+    paths = [entry['path'] for entry in entries]
+    if len(set(paths)) != len(paths):
+        raise UserError("Batch manifest %s lists a repo twice" % filename)
+    return entries
+
+
+def expand_globs(patterns):
+    """
+    Expand the local file globs 'patterns' into a sorted list of files.
+    """
+    rpm_paths = set()
+    for pattern in patterns:
+        matches = glob.glob(pattern)
+        if not matches:
+            raise UserError("No rpm's match '%s'" % pattern)
+        rpm_paths.update(matches)
+    return sorted(rpm_paths)
+
+
+def repo_context(context, entry):
+    """
+    Make a context for one repo in the batch, sharing the batch context's
+    connection and options.
+    """
+    repo = S3YumContext()
+    repo.action = s3yum_cli.UPDATE
+    repo.parser = context.parser
+    repo.opts = copy.copy(context.opts)
+    repo.opts.path = entry['path']
+    repo.opts.remove = entry['remove']
+    repo.rpm_args = expand_globs(entry['add'])
+    repo.s3_conn = context.s3_conn
+    repo.s3_bucket = context.s3_bucket
+    repo.working_dir = os.path.join(
+        context.working_dir, entry['path'].replace('/', '_') or '_root')
+    repo.working_dir_repodata = os.path.join(
+        repo.working_dir, s3yum_cli.REPODATA)
+    if not os.path.exists(repo.working_dir):
+        os.makedirs(repo.working_dir)
+    return repo
+
+
+#----------------------------------------------
+#               Batch steps:
+#----------------------------------------------
+def list_repo(repo):
+    s3yum_cli.list_metadata(repo)
+    s3yum_cli.list_rpms(repo)
+    return
+
+
+def prepare_repo(repo):
+    s3yum_cli.get_repo(repo, repo.working_dir)
+    s3yum_cli.remove_local_rpms(repo)
+    s3yum_cli.copy_rpms(repo)
+    s3yum_cli.prepare_repodata(repo)
+    return
+
+
+def plan_uploads(repos):
+    """
+    Work out which repos each local rpm has to be uploaded to. Returns a
+    list of (rpm_path, [repo, ...]) tuples.
+    """
+    targets = {}
+    for repo in repos:
+        items_by_name = dict(
+            (os.path.basename(item.name), item) for item in repo.s3_rpm_items)
+        for rpm_path in repo.rpm_args:
+            remote_item = items_by_name.get(os.path.basename(rpm_path))
+            if s3yum_cli.should_upload(
+                    rpm_path, remote_item, repo.opts.force_upload):
+                targets.setdefault(
+                    os.path.realpath(rpm_path), []).append(repo)
+    return sorted(targets.items())
+
+
+def published_item(repo, rpm_path, dest_path):
+    """
+    An s3 item for the rpm we just put at 'dest_path' in the repo.
+    """
+    item = boto.s3.key.Key(repo.s3_bucket, dest_path)
+    item.size = os.path.getsize(rpm_path)
+    item.etag = '"%s"' % get_file_md5(rpm_path)
+    item.last_modified = datetime_as_s3time(datetime.datetime.utcnow())
+    return item
+
+
+def record_published(results):
+    """
+    Add the items published by transfer_rpm ('results', lists of (repo,
+    item) tuples) to their repos' listings, so that upload_repodata neither
+    uploads them again nor leaves them out of the manifest. This runs once
+    the transfers are done, as they share the listings.
+    """
+    published = {}
+    for repo, item in itertools.chain.from_iterable(results):
+        published.setdefault(id(repo), (repo, {}))[1][item.name] = item
+    for repo, items in published.values():
+        repo.s3_rpm_items = [i for i in repo.s3_rpm_items
+                             if i.name not in items] + items.values()
+    return
+
+
+def transfer_rpm(upload):
+    """
+    Upload an rpm to the first repo that needs it, then server-side copy it
+    to the rest. Returns the (repo, item) published to each, for
+    record_published.
+    """
+    rpm_path, repos = upload
+    filename = os.path.basename(rpm_path)
+    first = repos[0]
+    first_path = s3join(first.opts.path, filename)
+    s3yum_cli.verbose("Uploading: %s", first_path)
+    if not first.opts.dry_run:
+        rpm_key = boto.s3.key.Key(first.s3_bucket, first_path)
+        rpm_key.set_contents_from_filename(
+            rpm_path,
+            headers=s3yum_cli.get_upload_headers(first, filename, rpm_path))
+    published = [(first, published_item(first, rpm_path, first_path))]
+
+    for repo in repos[1:]:
+        dest_path = s3join(repo.opts.path, filename)
+        s3yum_cli.verbose("Copying: %s -> %s", first_path, dest_path)
+        if not repo.opts.dry_run:
+            repo.s3_bucket.copy_key(dest_path, repo.s3_bucket.name, first_path)
+        published.append((repo, published_item(repo, rpm_path, dest_path)))
+    return published
+
+
+def publish_repo(repo):
+    s3yum_cli.compress_repodata(repo)
+    if repo.opts.sqlite:
+        from s3yum.sqlitedb import make_databases
+        make_databases(repo)
+    if repo.opts.deltas:
+        from s3yum.deltas import make_deltas
+        make_deltas(repo)
+    # Every new rpm is already in place; only changed metadata remains:
+    repo.opts.force_upload = False
+    s3yum_cli.upload_repodata(repo)
+    return
+
+
+def run_batch(context):
+    """
+    Update every repo in the batch manifest given on the command line.
+    """
+    entries = load_batch_manifest(context.rpm_args[0])
+    s3yum_cli.init_workingdir(context)
+    repos = [repo_context(context, entry) for entry in entries]
+
+    # Take every repo's lock before touching any of them. Always locking in
+    # path order means two batches can't deadlock:
+    leases = []
+    try:
+        if context.opts.lock and not context.opts.dry_run:
+            from s3yum.lock import S3Lease
+            for repo in sorted(repos, key=lambda r: r.opts.path):
+                lease = S3Lease(
+                    repo.s3_bucket,
+                    s3join(repo.opts.path, s3yum_cli.LOCK),
+                    repo.opts.lock_ttl)
+                if not lease.acquire(repo.opts.lock_timeout):
+                    raise UserError("Timed out waiting for lock %s" % (
+                        lease.name))
+                leases.append(lease)
+                repo.s3_lease = lease
+
+        pool = ThreadPool(max(1, context.opts.workers))
+        try:
+            pool.map(list_repo, repos)
+            hash_files(set(rpm_path for repo in repos
+                           for rpm_path in repo.rpm_args))
+            uploads = plan_uploads(repos)
+            s3yum_cli.verbose("Batch: %i repos, %i rpm's to upload",
+                              len(repos), len(uploads))
+            pool.map(prepare_repo, repos)
+        finally:
+            pool.close()
+            pool.join()
+        record_published(transfer_map(context, transfer_rpm, uploads))
+
+        # createrepo is CPU bound; give each repo its own process, and split
+        # the CPUs between them:
+        cpus = multiprocessing.cpu_count()
+        for repo in repos:
+            if repo.opts.createrepo_workers is None:
+                repo.opts.createrepo_workers = max(1, cpus // len(repos))
+        mirrored = s3yum_cli.pull_cachedir(context)
+        procs = multiprocessing.Pool(max(1, min(len(repos), cpus)))
+        try:
+            procs.map(s3yum_cli.run_createrepo,
+                      [s3yum_cli.createrepo_args(repo) for repo in repos])
+        finally:
+            procs.close()
+            procs.join()
+        s3yum_cli.push_cachedir(context, mirrored)
+
+        pool = ThreadPool(max(1, context.opts.workers))
+        try:
+            pool.map(publish_repo, repos)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        for lease in leases:
+            lease.release()
+    return
+
+# EOF
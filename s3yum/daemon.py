@@ -0,0 +1,523 @@
+#!python
+# -*- coding: utf-8 -*-
+#==============================================================================
+#
+# s3yum: Repo creation/maintenance tool for S3-based yum repos
+#
+# Copyright 2013-2019 The New York Times Company
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+
+"""s3yum.daemon: Long-running publish service for a single repo.
+
+Many producers (e.g. CI jobs) submit rpm's to the daemon over a small HTTP
+API, on a TCP port or a unix socket. Submissions are queued and coalesced:
+the first rpm to arrive opens a batch, and once the batch window has passed
+every queued rpm is published with a single metadata regeneration. The
+working directory, and with it every previously downloaded rpm, is kept
+between batches, and the package manifest written by each publish keeps the
+next batch's listing down to a single GET.
+
+API:
+    PUT  /rpms/<filename>   - queue an rpm (request body) for publishing
+    POST /remove            - queue --remove globs: {"globs": [...]}
+    GET  /batches/<id>      - status of a batch
+    GET  /status            - daemon status
+
+Batch ids start from 1 whenever the daemon starts, so every response also
+carries the daemon's 'instance', a token which changes with each start:
+a client only trusts a batch's status from the instance it submitted to.
+"""
+
+#----------------
+#    Imports:
+#----------------
+import os
+import re
+import time
+import json
+import uuid
+import socket
+import shutil
+import httplib
+import urlparse
+import tempfile
+import threading
+import SocketServer
+import BaseHTTPServer
+
+from s3yum import s3yum_cli
+from s3yum.s3yum_types import (
+    UserError,
+    ServiceError
+)
+
+#----------------------------------------------
+#                Constants:
+#----------------------------------------------
+QUEUED = 'queued'
+PUBLISHING = 'publishing'
+PUBLISHED = 'published'
+FAILED = 'failed'
+
+UNIX_PREFIX = 'unix:'
+RPM_NAME_RE = re.compile(r'^[^/\\]+\.rpm$')
+COPY_BUFSIZE = 65536
+
+
+#----------------------------------------------
+#                 Publishing:
+#----------------------------------------------
+class PublishDaemon(object):
+
+    """
+    Queue of pending rpm's and removals, and the worker which publishes
+    them in batches.
+    """
+
+    def __init__(self, context, spool_dir, window):
+        """
+        'context' is an initialized s3yum context (connected, with a working
+        directory), 'spool_dir' holds submitted rpm's until they are
+        published, and 'window' is the batching window in seconds.
+        """
+        self.context = context
+        self.spool_dir = spool_dir
+        self.window = window
+        self.cond = threading.Condition()
+        self.batch_id = 1           # The batch new submissions are added to
+        self.batch_opened = None    # When the first submission arrived
+        self.pending_rpms = {}      # filename -> spooled path
+        self.pending_removes = []   # --remove globs
+        self.batches = {}           # batch id -> (status, message)
+        self.stopping = False
+        self.instance = uuid.uuid4().hex    # See the module docstring
+        return
+
+    def queue_rpm(self, filename, fileobj, length):
+        """
+        Spool 'length' bytes of 'fileobj' as the rpm 'filename' and queue it
+        for the current batch. Returns the batch id.
+        """
+        # Spool into a private file first; the rpm is only queued once
+        # it has been received completely:
+        fd, tmp_path = tempfile.mkstemp(dir=self.spool_dir, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as spool_file:
+                remaining = length
+                while remaining > 0:
+                    buf = fileobj.read(min(COPY_BUFSIZE, remaining))
+                    if not buf:
+                        raise IOError("Short read receiving %s" % filename)
+                    spool_file.write(buf)
+                    remaining -= len(buf)
+
+            with self.cond:
+                # The batch may have been drained while we were receiving:
+                batch_id = self.batch_id
+                batch_dir = os.path.join(self.spool_dir, str(batch_id))
+                if not os.path.exists(batch_dir):
+                    os.makedirs(batch_dir)
+                spool_path = os.path.join(batch_dir, filename)
+                os.rename(tmp_path, spool_path)
+                self.pending_rpms[filename] = spool_path
+                self._opened()
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        s3yum_cli.verbose("Queued %s for batch %i", filename, batch_id)
+        return batch_id
+
+    def queue_file(self, filepath):
+        """
+        Queue the rpm at 'filepath' for the current batch, without spooling
+        a copy (it must stay in place until the batch is published). Returns
+        the batch id.
+        """
+        with self.cond:
+            self.pending_rpms[os.path.basename(filepath)] = filepath
+            self._opened()
+            return self.batch_id
+
+    def queue_removes(self, globs):
+        """
+        Queue --remove globs for the next batch. Returns the batch id.
+        """
+        with self.cond:
+            self.pending_removes.extend(globs)
+            self._opened()
+            return self.batch_id
+
+    def _opened(self):
+        """
+        Note that the current batch has work, waking the worker. Must be
+        called with self.cond held.
+        """
+        if self.batch_opened is None:
+            self.batch_opened = time.time()
+            self.batches[self.batch_id] = (QUEUED, None)
+            self.cond.notify()
+        return
+
+    def status(self, batch_id=None):
+        """
+        Return the status of the given batch, or of the daemon as a whole.
+        """
+        with self.cond:
+            if batch_id is not None:
+                status, message = self.batches.get(batch_id, (None, None))
+                return {'batch': batch_id, 'status': status,
+                        'message': message, 'instance': self.instance}
+            return {
+                'instance': self.instance,
+                'bucket': self.context.opts.bucket,
+                'path': self.context.opts.path,
+                'batch': self.batch_id,
+                'queued_rpms': sorted(self.pending_rpms),
+                'queued_removes': list(self.pending_removes),
+            }
+
+    def stop(self):
+        """
+        Ask the worker to exit once the current batch is published.
+        """
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        return
+
+    def run(self):
+        """
+        Worker loop: wait for a batch to open, let it fill up for the batch
+        window, then publish everything that was queued.
+        """
+        while True:
+            with self.cond:
+                while self.batch_opened is None and not self.stopping:
+                    self.cond.wait(1.0)
+                if self.batch_opened is None:
+                    return
+
+                remaining = self.batch_opened + self.window - time.time()
+                if remaining > 0 and not self.stopping:
+                    self.cond.wait(remaining)
+                    continue
+
+                # Drain the batch; new submissions go to the next one:
+                batch_id = self.batch_id
+                rpm_paths = sorted(self.pending_rpms.values())
+                removes = self.pending_removes
+                self.pending_rpms = {}
+                self.pending_removes = []
+                self.batch_opened = None
+                self.batch_id += 1
+                self.batches[batch_id] = (PUBLISHING, None)
+
+            self.publish(batch_id, rpm_paths, removes)
+
+    def publish(self, batch_id, rpm_paths, removes):
+        """
+        Publish one batch: the equivalent of a single 's3yum update'.
+        """
+        context = self.context
+        s3yum_cli.verbose("Publishing batch %i: %i rpm's, %i removals",
+                          batch_id, len(rpm_paths), len(removes))
+        context.rpm_args = rpm_paths
+        context.opts.remove = removes
+        try:
+            publish_update(context)
+            result = (PUBLISHED, None)
+        except (ServiceError, UserError) as ex:
+            result = (FAILED, ex.strerror)
+        except Exception as ex:
+            result = (FAILED, str(ex))
+
+        if result[0] == FAILED:
+            s3yum_cli.verbose("Batch %i failed: %s", batch_id, result[1])
+            # Don't let a failed batch's rpm's leak into the next one:
+            for rpm_path in rpm_paths:
+                local_copy = os.path.join(
+                    context.working_dir, os.path.basename(rpm_path))
+                if os.path.exists(local_copy):
+                    os.remove(local_copy)
+
+        shutil.rmtree(os.path.join(self.spool_dir, str(batch_id)), True)
+        context.rpm_args = []
+        context.opts.remove = []
+        with self.cond:
+            self.batches[batch_id] = result
+        return
+
+
+def publish_update(context):
+    """
+    Refresh the listing and run the update pipeline for context.rpm_args and
+    context.opts.remove, under the repo lock if --lock was given. The listing
+    is normally served by the manifest written by the previous batch.
+    """
+    def list_and_update(context):
+        s3yum_cli.list_metadata(context)
+        s3yum_cli.list_rpms(context)
+        s3yum_cli.update_repo(context)
+
+    if context.opts.lock:
+        s3yum_cli.with_publish_lock(context, list_and_update)
+    else:
+        list_and_update(context)
+    return
+
+
+#----------------------------------------------
+#                 HTTP API:
+#----------------------------------------------
+class DaemonRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """
+    Request handler for the daemon API.
+    """
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+    def do_GET(self):
+        daemon = self.server.publish_daemon
+        parts = self.path.strip('/').split('/')
+        if parts == ['status']:
+            self.send_json(200, daemon.status())
+        elif len(parts) == 2 and parts[0] == 'batches' and \
+                parts[1].isdigit():
+            self.send_json(200, daemon.status(int(parts[1])))
+        else:
+            self.send_json(404, {'error': 'Not found: %s' % self.path})
+        return
+
+    def do_PUT(self):
+        daemon = self.server.publish_daemon
+        parts = self.path.strip('/').split('/', 1)
+        if len(parts) != 2 or parts[0] != 'rpms' or \
+                not RPM_NAME_RE.match(parts[1]):
+            self.send_json(400, {'error': 'Expected PUT /rpms/<name>.rpm'})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length < 0:
+                raise ValueError("negative Content-Length")
+            batch_id = daemon.queue_rpm(parts[1], self.rfile, length)
+        except (ValueError, IOError) as ex:
+            self.send_json(400, {'error': 'Bad upload of %s: %s' % (
+                parts[1], ex)})
+            return
+        self.send_json(202, {'batch': batch_id, 'status': QUEUED,
+                             'instance': daemon.instance})
+        return
+
+    def do_POST(self):
+        daemon = self.server.publish_daemon
+        if self.path.strip('/') != 'remove':
+            self.send_json(404, {'error': 'Not found: %s' % self.path})
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            globs = json.loads(self.rfile.read(length))['globs']
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {'error': 'Expected {"globs": [...]}'})
+            return
+        batch_id = daemon.queue_removes(globs)
+        self.send_json(202, {'batch': batch_id, 'status': QUEUED,
+                             'instance': daemon.instance})
+        return
+
+    def address_string(self):
+        # Unix socket clients have no address:
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return UNIX_PREFIX
+
+    def log_message(self, fmt, *args):
+        s3yum_cli.verbose("%s: %s", self.address_string(), fmt % args)
+        return
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn,
+                              SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(listen, handler_class):
+    """
+    Create a threaded HTTP server for 'listen', which is either
+    'unix:/path/to/socket' or '[host:]port'.
+    """
+    if listen.startswith(UNIX_PREFIX):
+        sock_path = listen[len(UNIX_PREFIX):]
+        if os.path.exists(sock_path):
+            os.remove(sock_path)
+        return ThreadingUnixHTTPServer(sock_path, handler_class)
+
+    host, _, port = listen.rpartition(':')
+    try:
+        return ThreadingHTTPServer((host or '127.0.0.1', int(port)),
+                                   handler_class)
+    except ValueError:
+        raise UserError("Bad listen address: '%s'" % listen)
+
+
+def run_daemon(context):
+    """
+    Serve the daemon API until interrupted.
+    """
+    spool_dir = tempfile.mkdtemp(prefix='s3yum-spool-')
+    daemon = PublishDaemon(context, spool_dir, context.opts.batch_window)
+    try:
+        server = make_server(context.opts.listen, DaemonRequestHandler)
+    except socket.error as ex:
+        raise ServiceError("Unable to listen on %s: %s" % (
+            context.opts.listen, ex))
+    server.publish_daemon = daemon
+
+    worker = threading.Thread(target=daemon.run, name='s3yum-publish')
+    worker.start()
+    print "Publishing %s to %s, listening on %s" % (
+        context.opts.path, context.opts.bucket, context.opts.listen)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print "Shutting down, publishing any queued rpm's.."
+    finally:
+        server.server_close()
+        daemon.stop()
+        worker.join()
+        shutil.rmtree(spool_dir, True)
+    return
+
+
+#----------------------------------------------
+#                  Client:
+#----------------------------------------------
+class UnixHTTPConnection(httplib.HTTPConnection):
+
+    """
+    httplib connection over a unix socket.
+    """
+
+    def __init__(self, sock_path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.sock_path = sock_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.sock_path)
+
+
+def daemon_connection(url):
+    """
+    Return an httplib connection to the daemon at 'url', which is either
+    'unix:/path/to/socket' or 'http://host:port'.
+    """
+    if url.startswith(UNIX_PREFIX):
+        return UnixHTTPConnection(url[len(UNIX_PREFIX):])
+    parsed = urlparse.urlparse(url)
+    if parsed.scheme != 'http' or not parsed.netloc:
+        raise UserError("Bad daemon url: '%s'" % url)
+    return httplib.HTTPConnection(parsed.netloc)
+
+
+def daemon_request(url, method, path, body=None):
+    """
+    Make a single API request, returning the decoded JSON response.
+    """
+    conn = daemon_connection(url)
+    try:
+        conn.request(method, path, body)
+        response = conn.getresponse()
+        result = json.loads(response.read())
+    except (socket.error, httplib.HTTPException, ValueError) as ex:
+        raise ServiceError("Error talking to daemon at %s: %s" % (url, ex))
+    finally:
+        conn.close()
+
+    if response.status >= 400:
+        raise ServiceError("Daemon error: %s" % result.get('error'))
+    return result
+
+
+def submit_to_daemon(url, rpm_paths, removes, poll_interval=1.0,
+                     timeout=None):
+    """
+    Submit rpm's and --remove globs to the daemon at 'url', then wait (up to
+    'timeout' seconds, if given) for the batch(es) they were queued in to be
+    published. Raises ServiceError if a batch fails, or its outcome can't be
+    known because the daemon restarted.
+    """
+    submitted = []
+
+    def check_instance(result):
+        if submitted and result.get('instance') != submitted[0]:
+            raise ServiceError(
+                "The daemon at %s restarted; its queued rpm's were lost, "
+                "please resubmit" % url)
+        submitted[:1] = [result.get('instance')]
+        return
+
+    batch_ids = set()
+    for rpm_path in rpm_paths:
+        s3yum_cli.verbose("Submitting %s to %s", rpm_path, url)
+        with open(rpm_path, 'rb') as rpm_file:
+            result = daemon_request(
+                url, 'PUT', '/rpms/%s' % os.path.basename(rpm_path),
+                rpm_file)
+        check_instance(result)
+        batch_ids.add(result['batch'])
+
+    if removes:
+        result = daemon_request(
+            url, 'POST', '/remove', json.dumps({'globs': removes}))
+        check_instance(result)
+        batch_ids.add(result['batch'])
+
+    deadline = None if timeout is None else time.time() + timeout
+    for batch_id in sorted(batch_ids):
+        while True:
+            result = daemon_request(url, 'GET', '/batches/%i' % batch_id)
+            check_instance(result)
+            if result['status'] == PUBLISHED:
+                s3yum_cli.verbose("Batch %i published", batch_id)
+                break
+            elif result['status'] == FAILED:
+                raise ServiceError("Batch %i failed: %s" % (
+                    batch_id, result['message']))
+            elif result['status'] is None:
+                raise ServiceError("The daemon at %s has no batch %i" % (
+                    url, batch_id))
+            if deadline is not None and time.time() >= deadline:
+                raise ServiceError(
+                    "Timed out waiting for batch %i to be published" % (
+                        batch_id))
+            time.sleep(poll_interval)
+    return
+
+# EOF
@@ -0,0 +1,304 @@
+#!python
+# -*- coding: utf-8 -*-
+#==============================================================================
+#
+# s3yum: Repo creation/maintenance tool for S3-based yum repos
+#
+# Copyright 2013-2019 The New York Times Company
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+
+"""s3yum.deltas: Delta rpm (drpm) generation.
+
+With --deltas, every publish makes drpms from the previous --num-deltas
+versions of each package to its newest version, and adds prestodelta
+metadata describing them to the repodata. yum (with yum-presto) and dnf
+then download a delta and rebuild the new rpm from the installed one,
+instead of downloading the whole new rpm.
+
+drpms are built by 'makedeltarpm' (the MAKEDELTARPM environment variable
+overrides the path) in a process pool. They live in the bucket under
+<path>/drpms/, with an index keyed by the (old, new) package checksum pair,
+so a delta is only ever built once, by whichever publish first needs it.
+drpms which are no longer needed are deleted once they have been out of the
+metadata for --metadata-grace seconds.
+"""
+
+#----------------
+#    Imports:
+#----------------
+import os
+import time
+import shutil
+import multiprocessing
+
+from s3yum import s3yum_cli
+from s3yum.s3yum_types import ServiceError
+from s3yum.metadata import (
+    repomd_data,
+    data_location,
+    parse_primary,
+    compare_evr,
+    package_evr,
+    add_data_file,
+    prestodelta_doc
+)
+from s3yum.util import (
+    s3join,
+    get_file_sha256,
+    json_to_gzip,
+    gzip_to_json
+)
+
+#----------------------------------------------
+#                Constants:
+#----------------------------------------------
+MAKEDELTARPM = os.environ.get('MAKEDELTARPM', 'makedeltarpm')
+DRPMS = 'drpms'
+DELTA_INDEX = '.s3yum-deltas.json.gz'
+
+
+#----------------------------------------------
+#                Functions:
+#----------------------------------------------
+def delta_key(old, new):
+    """
+    The delta index key for the drpm from package 'old' to 'new'.
+    """
+    return '%s_%s' % (old['pkgid'], new['pkgid'])
+
+
+def delta_filename(old, new):
+    """
+    The name of the drpm from package 'old' to 'new', relative to the repo.
+    """
+    return '%s/%s-%s-%s_%s-%s.%s.drpm' % (
+        DRPMS, new['name'], old['version'], old['release'],
+        new['version'], new['release'], new['arch'])
+
+
+def plan_deltas(packages, num_deltas):
+    """
+    Return (old, new) package pairs for the drpms to offer: from each of the
+    previous 'num_deltas' versions of every package to its newest version.
+    """
+    by_name = {}
+    for package in packages:
+        by_name.setdefault(
+            (package['name'], package['arch']), []).append(package)
+
+    pairs = []
+    for key in sorted(by_name):
+        versions = sorted(
+            by_name[key], reverse=True,
+            cmp=lambda a, b: compare_evr(package_evr(a), package_evr(b)))
+        for old in versions[1:1 + num_deltas]:
+            pairs.append((old, versions[0]))
+    return pairs
+
+
+def make_delta(args):
+    """
+    Run makedeltarpm to build the drpm 'out_path' from 'old_path' to
+    'new_path'. Returns the drpm's sequence (which makedeltarpm writes out
+    with -s). This has no dependency on the context, so that it can be run
+    in a worker process.
+    """
+    import subprocess
+
+    makedeltarpm, old_path, new_path, out_path = args
+    seq_path = out_path + '.seq'
+    try:
+        subprocess.check_output(
+            [makedeltarpm, '-s', seq_path, old_path, new_path, out_path],
+            stderr=subprocess.STDOUT)
+        with open(seq_path) as seq_file:
+            return seq_file.read().strip()
+    except subprocess.CalledProcessError as ex:
+        raise ServiceError("'%s' failed with status code %i: %s" % (
+            makedeltarpm, ex.returncode, ex.output))
+    except OSError as ex:
+        raise ServiceError("Unable to invoke '%s': %s" % (
+            makedeltarpm, ex.strerror))
+    finally:
+        if os.path.exists(seq_path):
+            os.remove(seq_path)
+
+
+def read_delta_index(context):
+    """
+    Fetch the repo's delta index: {delta key: entry}. Each entry has the
+    drpm's filename, sequence, size and checksum, or 'useless' if the delta
+    was no smaller than the new rpm. Entries no longer in use have a
+    'retired' time.
+    """
+    index_key = context.s3_bucket.get_key(
+        s3join(context.opts.path, DRPMS, DELTA_INDEX))
+    if index_key is None:
+        return {}
+    try:
+        return gzip_to_json(index_key.get_contents_as_string())
+    except ValueError as ex:
+        s3yum_cli.verbose("Ignoring corrupt delta index: %s", ex)
+        return {}
+
+
+def write_delta_index(context, index):
+    """
+    Upload the repo's delta index (see read_delta_index).
+    """
+    import boto.s3.key
+
+    index_path = s3join(context.opts.path, DRPMS, DELTA_INDEX)
+    s3yum_cli.verbose("Writing delta index: %s (%i deltas)",
+                      index_path, len(index))
+    if not context.opts.dry_run:
+        index_key = boto.s3.key.Key(context.s3_bucket, index_path)
+        index_key.set_contents_from_string(
+            json_to_gzip(index),
+            headers={'Content-Type': 'application/x-gzip'})
+    return
+
+
+def build_deltas(context, jobs):
+    """
+    Build the drpms for 'jobs', a list of (key, old, new) tuples, in a
+    process pool. Returns {key: index entry}.
+    """
+    drpm_dir = os.path.join(context.working_dir, DRPMS)
+    if not os.path.exists(drpm_dir):
+        os.makedirs(drpm_dir)
+
+    args = []
+    for key, old, new in jobs:
+        args.append((
+            MAKEDELTARPM,
+            local_rpm(context, old),
+            local_rpm(context, new),
+            os.path.join(context.working_dir, delta_filename(old, new))))
+
+    procs = multiprocessing.Pool(max(1, min(
+        len(args),
+        context.opts.createrepo_workers or multiprocessing.cpu_count())))
+    try:
+        sequences = procs.map(make_delta, args)
+    finally:
+        procs.close()
+        procs.join()
+
+    entries = {}
+    for (key, old, new), arg, sequence in zip(jobs, args, sequences):
+        out_path = arg[3]
+        size = os.path.getsize(out_path)
+        if size >= new['size']:
+            s3yum_cli.verbose("Not offering %s: no smaller than the rpm",
+                              delta_filename(old, new))
+            os.remove(out_path)
+            entries[key] = {'useless': True}
+            continue
+        entries[key] = {
+            'filename': delta_filename(old, new),
+            'sequence': sequence,
+            'size': size,
+            'checksum': get_file_sha256(out_path),
+        }
+    return entries
+
+
+def local_rpm(context, package):
+    """
+    The path of 'package' in the working directory.
+    """
+    return os.path.join(
+        context.working_dir, os.path.basename(package['location']))
+
+
+def make_deltas(context):
+    """
+    Make the drpms for the newly generated repodata in the working
+    directory, upload them, and add prestodelta metadata to the repodata.
+    drpms which were retired at least --metadata-grace seconds ago are
+    deleted: no published metadata has referenced them since.
+    """
+    _, entries = repomd_data(context.working_dir_repodata)
+    packages = parse_primary(os.path.join(
+        context.working_dir_repodata,
+        os.path.basename(data_location(entries['primary']))))
+    pairs = plan_deltas(packages, context.opts.num_deltas)
+
+    drpm_prefix = s3join(context.opts.path, DRPMS, '')
+    drpm_items = dict(
+        (item.name, item) for item in
+        context.s3_bucket.list(prefix=drpm_prefix)
+        if item.name.endswith('.drpm'))
+    index = read_delta_index(context)
+
+    jobs = []
+    for old, new in pairs:
+        key = delta_key(old, new)
+        entry = index.get(key)
+        if entry is not None and (entry.get('useless') or s3join(
+                context.opts.path, entry['filename']) in drpm_items):
+            continue
+        if not os.path.exists(local_rpm(context, old)) or \
+                not os.path.exists(local_rpm(context, new)):
+            continue
+        jobs.append((key, old, new))
+    s3yum_cli.verbose("Deltas: %i offered, %i to build",
+                      len(pairs), len(jobs))
+
+    drpm_dir = os.path.join(context.working_dir, DRPMS)
+    shutil.rmtree(drpm_dir, True)
+    built = {}
+    if jobs:
+        built = build_deltas(context, jobs)
+        index.update(built)
+        s3yum_cli.upload_directory(
+            context, drpm_dir, s3join(context.opts.path, DRPMS),
+            drpm_items.values())
+
+    # Retire the deltas we no longer offer, and expire old retirees:
+    now = time.time()
+    in_use = set(delta_key(old, new) for old, new in pairs)
+    stale = []
+    for key, entry in index.items():
+        if key in in_use:
+            entry.pop('retired', None)
+        elif 'retired' not in entry:
+            entry['retired'] = now
+        elif now - entry['retired'] >= context.opts.metadata_grace:
+            del index[key]
+            item = drpm_items.get(
+                s3join(context.opts.path, entry.get('filename', '')))
+            if item is not None:
+                stale.append(item)
+    write_delta_index(context, index)
+    s3yum_cli.delete_items(context, stale)
+
+    # Only offer drpms which exist: an entry whose drpm has gone from the
+    # bucket, and which couldn't be rebuilt, is left out:
+    deltas = []
+    for old, new in pairs:
+        key = delta_key(old, new)
+        entry = index.get(key)
+        if entry is None or entry.get('useless'):
+            continue
+        if key in built or s3join(
+                context.opts.path, entry['filename']) in drpm_items:
+            deltas.append((new, old, entry))
+    add_data_file(context.working_dir_repodata, 'prestodelta',
+                  prestodelta_doc(deltas), None)
+    return
+
+# EOF
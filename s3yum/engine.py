@@ -0,0 +1,100 @@
+#!python
+# -*- coding: utf-8 -*-
+#==============================================================================
+#
+# s3yum: Repo creation/maintenance tool for S3-based yum repos
+#
+# Copyright 2013-2019 The New York Times Company
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+
+"""s3yum.engine: Engines for running many S3 transfers at once.
+
+Uploads and downloads of small rpm's spend nearly all their time waiting on
+the network. --engine picks how they are run concurrently:
+ - 'threads' (the default): --workers threads.
+ - 'gevent': up to --concurrency greenlets. gevent patches the socket
+   module, so boto's blocking (SigV4 signed) requests yield while they
+   wait, and hundreds can be in flight on one thread. Requires the gevent
+   module.
+Every transfer streams between a file and its connection, so memory use is
+bounded by the number of transfers in flight.
+"""
+
+#----------------
+#    Imports:
+#----------------
+from s3yum.s3yum_types import UserError
+
+#----------------------------------------------
+#                Constants:
+#----------------------------------------------
+THREADS = 'threads'
+GEVENT = 'gevent'
+ENGINES = (THREADS, GEVENT)
+
+
+#----------------------------------------------
+#                Functions:
+#----------------------------------------------
+def init_engine(context):
+    """
+    Ready --engine. This must run before any S3 connection is opened.
+    """
+    if context.opts.engine != GEVENT:
+        return
+    try:
+        from gevent import monkey
+    except ImportError:
+        raise UserError("The gevent module is required for --engine gevent")
+    monkey.patch_socket()
+    monkey.patch_ssl()
+    monkey.patch_select()
+    return
+
+
+def transfer_width(context, count):
+    """
+    How many of 'count' transfers the engine runs at once.
+    """
+    if context.opts.engine == GEVENT:
+        width = context.opts.concurrency
+    else:
+        width = context.opts.workers
+    return max(1, min(count, width))
+
+
+def transfer_map(context, func, jobs):
+    """
+    Call 'func' on each of 'jobs' concurrently, with --engine. Returns the
+    results in the order of 'jobs'; the first exception raised is re-raised.
+    """
+    jobs = list(jobs)
+    width = transfer_width(context, len(jobs))
+    if width <= 1:
+        return [func(job) for job in jobs]
+
+    if context.opts.engine == GEVENT:
+        import gevent.pool
+        return gevent.pool.Pool(width).map(func, jobs)
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(width)
+    try:
+        return pool.map(func, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+# EOF
@@ -0,0 +1,231 @@
+#!python
+# -*- coding: utf-8 -*-
+#==============================================================================
+#
+# s3yum: Repo creation/maintenance tool for S3-based yum repos
+#
+# Copyright 2013-2019 The New York Times Company
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+
+"""s3yum.lock: A lease (expiring lock) stored as an object in S3.
+
+The lease is acquired by creating the lock object with a conditional PUT
+(If-None-Match: *), so exactly one writer can win. The holder keeps it alive
+by rewriting it every ttl/3 seconds with If-Match on the ETag it last wrote;
+if that fails, someone else has taken over and the lease is lost. A lease
+which hasn't been renewed for 'ttl' seconds (by the object's Last-Modified
+time) may be taken over by another writer, again with If-Match.
+"""
+
+#----------------
+#    Imports:
+#----------------
+import os
+import json
+import time
+import uuid
+import socket
+import hashlib
+import datetime
+import threading
+
+import boto
+import boto.exception
+import boto.s3.key
+
+from s3yum.s3yum_types import ServiceError
+from s3yum.util import (
+    get_s3item_md5,
+    s3time_as_datetime
+)
+
+#----------------------------------------------
+#                Constants:
+#----------------------------------------------
+# S3 answers a failed precondition with 412, and a conditional write which
+# raced another one with 409:
+CONFLICT_STATUSES = (409, 412)
+
+
+#----------------------------------------------
+#                 Classes:
+#----------------------------------------------
+class S3Lease(object):
+
+    """
+    Expiring lock held in the object 'name' of 'bucket'.
+    """
+
+    def __init__(self, bucket, name, ttl, owner=None):
+        self.bucket = bucket
+        self.name = name
+        self.ttl = ttl
+        self.owner = owner or default_owner()
+        self.etag = None    # ETag of the lock object we last wrote
+        self.lost = False
+        self.heartbeat = None
+        self.stop_event = threading.Event()
+        return
+
+    def _write(self, headers):
+        """
+        Write the lock object with the conditional 'headers'.
+        """
+        body = json.dumps({
+            'owner': self.owner,
+            'ttl': self.ttl,
+            'renewed': time.time(),
+        })
+        headers = dict(headers)
+        headers['Content-Type'] = 'application/json'
+        headers['Cache-Control'] = 'no-cache'
+        lock_key = boto.s3.key.Key(self.bucket, self.name)
+        lock_key.set_contents_from_string(body, headers=headers)
+        self.etag = hashlib.md5(body).hexdigest()
+        return
+
+    def holder(self):
+        """
+        Return (info, etag, expired) for the current lock object, or None if
+        the lease is not held.
+        """
+        lock_key = self.bucket.get_key(self.name)
+        if lock_key is None:
+            return None
+        try:
+            info = json.loads(lock_key.get_contents_as_string())
+            ttl = info.get('ttl', self.ttl)
+        except ValueError:
+            info, ttl = {}, self.ttl
+        renewed = s3time_as_datetime(lock_key.last_modified)
+        expired = datetime.datetime.utcnow() - renewed > \
+            datetime.timedelta(seconds=ttl)
+        return info, get_s3item_md5(lock_key), expired
+
+    def try_acquire(self):
+        """
+        Make a single attempt to acquire the lease. Returns True on success.
+        """
+        try:
+            self._write({'If-None-Match': '*'})
+            self.lost = False
+            return True
+        except boto.exception.S3ResponseError as ex:
+            if ex.status not in CONFLICT_STATUSES:
+                raise ServiceError("Unable to write lock %s: %s" % (
+                    self.name, ex.reason))
+
+        current = self.holder()
+        if current is None or not current[2]:
+            return False
+
+        # The holder stopped renewing; take over, unless someone beats us:
+        info, etag, _ = current
+        try:
+            self._write({'If-Match': '"%s"' % etag})
+        except boto.exception.S3ResponseError as ex:
+            if ex.status not in CONFLICT_STATUSES:
+                raise ServiceError("Unable to write lock %s: %s" % (
+                    self.name, ex.reason))
+            return False
+        self.lost = False
+        return True
+
+    def acquire(self, timeout, poll_interval=5.0):
+        """
+        Wait up to 'timeout' seconds to acquire the lease, then start the
+        heartbeat. Returns True on success.
+        """
+        deadline = time.time() + timeout
+        while not self.try_acquire():
+            if time.time() >= deadline:
+                return False
+            time.sleep(poll_interval)
+        self.start_heartbeat()
+        return True
+
+    def renew(self):
+        """
+        Extend the lease. Marks the lease as lost if it was taken over.
+        """
+        try:
+            self._write({'If-Match': '"%s"' % self.etag})
+        except boto.exception.S3ResponseError as ex:
+            if ex.status in CONFLICT_STATUSES or ex.status == 404:
+                self.lost = True
+            # Any other error is retried at the next heartbeat; if it
+            # persists, the lease simply expires.
+        return
+
+    def start_heartbeat(self):
+        """
+        Renew the lease every ttl/3 seconds from a background thread.
+        """
+        def beat():
+            while not self.stop_event.wait(self.ttl / 3.0):
+                self.renew()
+                if self.lost:
+                    return
+
+        self.stop_event.clear()
+        self.heartbeat = threading.Thread(target=beat, name='s3yum-lease')
+        self.heartbeat.daemon = True
+        self.heartbeat.start()
+        return
+
+    def check(self):
+        """
+        Raise ServiceError if the lease has been lost.
+        """
+        if self.lost:
+            raise ServiceError(
+                "Lost the lock %s to another writer; not publishing" % (
+                    self.name))
+        return
+
+    def release(self):
+        """
+        Stop the heartbeat and delete the lock object, if it is still ours.
+        """
+        self.stop_event.set()
+        if self.heartbeat is not None:
+            self.heartbeat.join()
+            self.heartbeat = None
+
+        if self.lost or self.etag is None:
+            return
+        current = self.holder()
+        if current is not None and current[1] == self.etag:
+            try:
+                self.bucket.delete_key(
+                    self.name, headers={'If-Match': '"%s"' % self.etag})
+            except boto.exception.S3ResponseError as ex:
+                if ex.status not in CONFLICT_STATUSES:
+                    raise
+        self.etag = None
+        return
+
+
+#----------------------------------------------
+#                Functions:
+#----------------------------------------------
+def default_owner():
+    """
+    A name for this process which is unique across hosts.
+    """
+    return '%s-%i-%s' % (socket.gethostname(), os.getpid(),
+                         uuid.uuid4().hex[:8])
+
+# EOF
@@ -0,0 +1,600 @@
+#!python
+# -*- coding: utf-8 -*-
+#==============================================================================
+#
+# s3yum: Repo creation/maintenance tool for S3-based yum repos
+#
+# Copyright 2013-2019 The New York Times Company
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+
+"""s3yum.metadata: Functions for reading and writing yum repo metadata.
+
+This module understands the files createrepo writes into a repodata folder
+(repomd.xml, primary.xml, etc.). It knows nothing about S3.
+"""
+
+#----------------
+#    Imports:
+#----------------
+import os
+import re
+import bz2
+import gzip
+import time
+import shutil
+import hashlib
+import xml.etree.ElementTree as ElementTree
+
+#----------------------------------------------
+#                Constants:
+#----------------------------------------------
+REPO_NS = 'http://linux.duke.edu/metadata/repo'
+COMMON_NS = 'http://linux.duke.edu/metadata/common'
+RPM_NS = 'http://linux.duke.edu/metadata/rpm'
+FILELISTS_NS = 'http://linux.duke.edu/metadata/filelists'
+OTHER_NS = 'http://linux.duke.edu/metadata/other'
+
+# The per-package metadata files, and their default namespaces:
+PACKAGE_DATA = {
+    'primary': COMMON_NS,
+    'filelists': FILELISTS_NS,
+    'other': OTHER_NS,
+}
+
+ElementTree.register_namespace('rpm', RPM_NS)
+
+# repomd.xml checksum types which don't match the hashlib name:
+HASHLIB_NAMES = {'sha': 'sha1'}
+
+# Metadata compressions, and their file extensions:
+COMPRESSIONS = {
+    'gz': '.gz',
+    'bz2': '.bz2',
+    'xz': '.xz',
+    'zstd': '.zst',
+}
+
+# The multi-threaded command line compressors for the other compressions:
+XZ = os.environ.get('XZ', 'xz')
+ZSTD = os.environ.get('ZSTD', 'zstd')
+COMPRESSION_TOOLS = {
+    'xz': XZ,
+    'zstd': ZSTD,
+}
+
+
+#----------------------------------------------
+#                 Classes:
+#----------------------------------------------
+class ToolReader(object):
+
+    """
+    File-like reader of a decompression command's output (for the
+    compressions python 2.7 can't read itself).
+    """
+
+    def __init__(self, args):
+        import subprocess
+
+        self.args = args
+        try:
+            self.proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+        except OSError as ex:
+            raise ValueError("Unable to invoke '%s': %s" % (
+                args[0], ex.strerror))
+        return
+
+    def read(self, size=-1):
+        return self.proc.stdout.read(size)
+
+    def close(self):
+        self.proc.stdout.close()
+        if self.proc.wait() != 0:
+            raise ValueError("'%s' failed with status code %i" % (
+                ' '.join(self.args), self.proc.returncode))
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.proc.stdout.close()
+            self.proc.wait()
+        return False
+
+
+#----------------------------------------------
+#                Functions:
+#----------------------------------------------
+def is_derived_data(data_type):
+    """
+    Whether the repomd.xml data type 'data_type' is another format of the
+    per-package metadata (a sqlite database or zchunk file).
+    """
+    return re.search(r'_(db|zck)$', data_type) is not None
+
+
+def repo_tag(name):
+    """
+    Qualify the tag 'name' with the repomd.xml namespace.
+    """
+    return '{%s}%s' % (REPO_NS, name)
+
+
+def repomd_locations(repomd_xml):
+    """
+    Return the location hrefs (relative to the repo root) of every metadata
+    file referenced by the repomd.xml document given by the string
+    'repomd_xml'.
+    """
+    root = ElementTree.fromstring(repomd_xml)
+    locations = []
+    for data in root.findall(repo_tag('data')):
+        location = data.find(repo_tag('location'))
+        if location is not None:
+            locations.append(location.get('href'))
+    return locations
+
+
+def common_tag(name):
+    """
+    Qualify the tag 'name' with the primary.xml namespace.
+    """
+    return '{%s}%s' % (COMMON_NS, name)
+
+
+def rpm_tag(name):
+    """
+    Qualify the tag 'name' with the rpm: namespace used in primary.xml.
+    """
+    return '{%s}%s' % (RPM_NS, name)
+
+
+def open_metadata(filepath, mode='rb'):
+    """
+    Open the (possibly compressed) metadata file 'filepath', by extension.
+    """
+    if filepath.endswith('.gz'):
+        return gzip.GzipFile(filepath, mode)
+    elif filepath.endswith('.bz2'):
+        return bz2.BZ2File(filepath, mode)
+    elif filepath.endswith(('.xz', '.zst')) and mode == 'rb':
+        return ToolReader([
+            XZ if filepath.endswith('.xz') else ZSTD, '-dcq', filepath])
+    elif filepath.endswith(('.xz', '.zst', '.zck')):
+        raise ValueError("Unsupported metadata compression: %s" % filepath)
+    return open(filepath, mode)
+
+
+def file_checksum(filepath, checksum_type):
+    """
+    Return the hex digest of the file 'filepath' using the repomd.xml
+    checksum type 'checksum_type' (e.g. sha256).
+    """
+    hasher = hashlib.new(HASHLIB_NAMES.get(checksum_type, checksum_type))
+    with open(filepath, 'rb') as afile:
+        for buf in iter(lambda: afile.read(65536), ''):
+            hasher.update(buf)
+    return hasher.hexdigest()
+
+
+def repomd_data(repodata_dir):
+    """
+    Parse repodata_dir/repomd.xml, returning (tree, {type: data element}).
+    """
+    tree = ElementTree.parse(os.path.join(repodata_dir, 'repomd.xml'))
+    entries = {}
+    for data in tree.getroot().findall(repo_tag('data')):
+        entries[data.get('type')] = data
+    return tree, entries
+
+
+def data_location(data):
+    """
+    The href of a repomd.xml data element, relative to the repo root.
+    """
+    return data.find(repo_tag('location')).get('href')
+
+
+def parse_primary(filepath, deps=False):
+    """
+    Read the packages in the primary metadata file 'filepath'. Returns a list
+    of dicts with the keys: pkgid, name, arch, epoch, version, release,
+    location, size, time (the rpm's mtime when createrepo last indexed it,
+    not when it was added to the repo) and checksum_type.
+
+    If 'deps' is set, the dicts also have 'provides' and 'requires' (lists
+    of capability names, without versions) and 'files' (the files primary.xml
+    lists).
+    """
+    packages = []
+    with open_metadata(filepath) as primary:
+        for _, elem in ElementTree.iterparse(primary):
+            if elem.tag != common_tag('package'):
+                continue
+            version = elem.find(common_tag('version'))
+            checksum = elem.find(common_tag('checksum'))
+            packages.append({
+                'pkgid': checksum.text,
+                'checksum_type': checksum.get('type'),
+                'name': elem.findtext(common_tag('name')),
+                'arch': elem.findtext(common_tag('arch')),
+                'epoch': version.get('epoch'),
+                'version': version.get('ver'),
+                'release': version.get('rel'),
+                'location': elem.find(common_tag('location')).get('href'),
+                'size': int(elem.find(common_tag('size')).get('package')),
+                'time': int(elem.find(common_tag('time')).get('file')),
+            })
+            if deps:
+                packages[-1].update(package_deps(elem))
+            elem.clear()
+    return packages
+
+
+def package_deps(elem):
+    """
+    The provides, requires and files of the primary.xml package element
+    'elem'.
+    """
+    fmt = elem.find(common_tag('format'))
+    result = {'provides': [], 'requires': [], 'files': []}
+    if fmt is None:
+        return result
+    for kind in ('provides', 'requires'):
+        entries = fmt.find(rpm_tag(kind))
+        if entries is not None:
+            result[kind] = [entry.get('name')
+                            for entry in entries.findall(rpm_tag('entry'))]
+    result['files'] = [f.text for f in fmt.findall(common_tag('file'))]
+    return result
+
+
+def rpmvercmp(a, b):
+    """
+    Compare two rpm version (or release) strings the way rpm does. Returns
+    -1, 0 or 1.
+    """
+    if a == b:
+        return 0
+    segments_a = re.findall(r'~|\^|[a-zA-Z]+|[0-9]+', a)
+    segments_b = re.findall(r'~|\^|[a-zA-Z]+|[0-9]+', b)
+    for i in range(max(len(segments_a), len(segments_b))):
+        x = segments_a[i] if i < len(segments_a) else None
+        y = segments_b[i] if i < len(segments_b) else None
+
+        # '~' sorts before anything, even the end of the string:
+        if x == '~' or y == '~':
+            if x != y:
+                return -1 if x == '~' else 1
+            continue
+
+        # '^' sorts after the end of the string, but before anything else:
+        if x == '^' or y == '^':
+            if x == y:
+                continue
+            if x == '^':
+                return -1 if y is not None else 1
+            return 1 if x is not None else -1
+
+        if x is None or y is None:
+            return 1 if y is None else -1
+
+        # Numeric segments are newer than alphabetic ones:
+        if x.isdigit() != y.isdigit():
+            return 1 if x.isdigit() else -1
+        if x.isdigit():
+            x, y = int(x), int(y)
+        if x != y:
+            return 1 if x > y else -1
+    return 0
+
+
+def compare_evr(evr_a, evr_b):
+    """
+    Compare two (epoch, version, release) tuples. Returns -1, 0 or 1.
+    """
+    epoch_a = int(evr_a[0] or 0)
+    epoch_b = int(evr_b[0] or 0)
+    if epoch_a != epoch_b:
+        return 1 if epoch_a > epoch_b else -1
+    return rpmvercmp(evr_a[1], evr_b[1]) or rpmvercmp(evr_a[2], evr_b[2])
+
+
+def package_evr(package):
+    """
+    The (epoch, version, release) of a package dict from parse_primary.
+    """
+    return (package['epoch'], package['version'], package['release'])
+
+
+def write_xml(tree, outfile, default_namespace):
+    """
+    Write the document 'tree' to 'outfile' (a filename or file object), with
+    'default_namespace' (if not None) as the default namespace.
+    ElementTree's own default_namespace option rejects unqualified attributes
+    on python2.7, so the tags in that namespace are unqualified in place
+    instead.
+    """
+    if default_namespace is not None:
+        prefix = '{%s}' % default_namespace
+        for elem in tree.getroot().iter():
+            if isinstance(elem.tag, basestring) and \
+                    elem.tag.startswith(prefix):
+                elem.tag = elem.tag[len(prefix):]
+        tree.getroot().set('xmlns', default_namespace)
+    tree.write(outfile, encoding='UTF-8', xml_declaration=True)
+    return
+
+
+def write_data_file(tree, repodata_dir, data_type, default_namespace,
+                    checksum_type):
+    """
+    Write the metadata document 'tree' as a gzip'd, checksum-named file in
+    'repodata_dir'. Returns the repomd.xml values describing it.
+    """
+    tmp_path = os.path.join(repodata_dir, '%s.xml.gz.tmp' % data_type)
+    gz_file = gzip.GzipFile(tmp_path, 'wb')
+    open_hasher = hashlib.new(HASHLIB_NAMES.get(checksum_type, checksum_type))
+
+    class HashingWriter(object):
+        def __init__(self):
+            self.size = 0
+
+        def write(self, data):
+            open_hasher.update(data)
+            self.size += len(data)
+            gz_file.write(data)
+
+    writer = HashingWriter()
+    try:
+        write_xml(tree, writer, default_namespace)
+    finally:
+        gz_file.close()
+
+    checksum = file_checksum(tmp_path, checksum_type)
+    filename = '%s-%s.xml.gz' % (checksum, data_type)
+    os.rename(tmp_path, os.path.join(repodata_dir, filename))
+    return {
+        'checksum': checksum,
+        'open-checksum': open_hasher.hexdigest(),
+        'location': 'repodata/%s' % filename,
+        'size': os.path.getsize(os.path.join(repodata_dir, filename)),
+        'open-size': writer.size,
+    }
+
+
+def update_data(data, checksum_type, values):
+    """
+    Update the repomd.xml data element 'data' with the values returned by
+    write_data_file.
+    """
+    for child in list(data):
+        data.remove(child)
+    for tag in ('checksum', 'open-checksum'):
+        elem = ElementTree.SubElement(data, repo_tag(tag))
+        elem.set('type', checksum_type)
+        elem.text = values[tag]
+    ElementTree.SubElement(data, repo_tag('location')).set(
+        'href', values['location'])
+    for tag in ('timestamp', 'size', 'open-size'):
+        ElementTree.SubElement(data, repo_tag(tag)).text = str(
+            values.get(tag, int(time.time())))
+    if 'database_version' in values:
+        ElementTree.SubElement(data, repo_tag('database_version')).text = \
+            str(values['database_version'])
+    return
+
+
+def replace_data(repodata_dir, tree, entries, data_type):
+    """
+    Return the data element for 'data_type' in the repomd.xml document
+    'tree' (whose data elements, by type, are 'entries'), removing the file
+    it described from 'repodata_dir'. A new element is added if there is
+    none.
+    """
+    if data_type in entries:
+        old_path = os.path.join(
+            repodata_dir, os.path.basename(data_location(entries[data_type])))
+        if os.path.exists(old_path):
+            os.remove(old_path)
+        return entries[data_type]
+    data = ElementTree.SubElement(tree.getroot(), repo_tag('data'))
+    data.set('type', data_type)
+    entries[data_type] = data
+    return data
+
+
+def add_data_file(repodata_dir, data_type, doc, default_namespace,
+                  checksum_type='sha256'):
+    """
+    Write the metadata document 'doc' into 'repodata_dir' as 'data_type',
+    and add it to repomd.xml there (replacing any previous file of that
+    type).
+    """
+    tree, entries = repomd_data(repodata_dir)
+    data = replace_data(repodata_dir, tree, entries, data_type)
+    values = write_data_file(ElementTree.ElementTree(doc), repodata_dir,
+                             data_type, default_namespace, checksum_type)
+    update_data(data, checksum_type, values)
+    write_repomd(tree, repodata_dir)
+    return
+
+
+def data_compression(data):
+    """
+    The compression of the file the repomd.xml data element 'data'
+    describes, or None if it isn't one of COMPRESSIONS.
+    """
+    location = data_location(data)
+    for compression, extension in COMPRESSIONS.items():
+        if location.endswith(extension):
+            return compression
+    return None
+
+
+def compress_data_file(repodata_dir, data, compression, threads=1):
+    """
+    Rewrite the metadata file described by the repomd.xml data element
+    'data' (in 'repodata_dir') with 'compression', one of COMPRESSIONS.
+    xz and zstd run their command line tools with 'threads' threads. The old
+    file is removed and 'data' updated; repomd.xml is not written.
+    """
+    import subprocess
+
+    data_type = data.get('type')
+    checksum_type = data.find(repo_tag('checksum')).get('type')
+    src_path = os.path.join(repodata_dir, os.path.basename(
+        data_location(data)))
+    tmp_path = os.path.join(repodata_dir, '%s.xml%s.tmp' % (
+        data_type, COMPRESSIONS[compression]))
+    open_hasher = hashlib.new(HASHLIB_NAMES.get(checksum_type, checksum_type))
+    open_size = 0
+
+    proc = None
+    if compression in COMPRESSION_TOOLS:
+        tool = COMPRESSION_TOOLS[compression]
+        outfile = open(tmp_path, 'wb')
+        try:
+            proc = subprocess.Popen(
+                [tool, '-T%i' % threads, '-cq'],
+                stdin=subprocess.PIPE, stdout=outfile)
+        except OSError as ex:
+            raise ValueError("Unable to invoke '%s': %s" % (
+                tool, ex.strerror))
+        finally:
+            outfile.close()
+        writer = proc.stdin
+    elif compression == 'bz2':
+        writer = bz2.BZ2File(tmp_path, 'wb')
+    else:
+        writer = gzip.GzipFile(tmp_path, 'wb')
+
+    try:
+        with open_metadata(src_path) as src:
+            for buf in iter(lambda: src.read(65536), ''):
+                open_hasher.update(buf)
+                open_size += len(buf)
+                writer.write(buf)
+    finally:
+        writer.close()
+        if proc is not None and proc.wait() != 0:
+            raise ValueError("'%s' failed with status code %i" % (
+                tool, proc.returncode))
+
+    checksum = file_checksum(tmp_path, checksum_type)
+    filename = '%s-%s.xml%s' % (checksum, data_type, COMPRESSIONS[compression])
+    os.rename(tmp_path, os.path.join(repodata_dir, filename))
+    if os.path.basename(src_path) != filename:
+        os.remove(src_path)
+    update_data(data, checksum_type, {
+        'checksum': checksum,
+        'open-checksum': open_hasher.hexdigest(),
+        'location': 'repodata/%s' % filename,
+        'size': os.path.getsize(os.path.join(repodata_dir, filename)),
+        'open-size': open_size,
+    })
+    return
+
+
+def prestodelta_doc(deltas):
+    """
+    Build a prestodelta.xml document. 'deltas' is a list of (new package,
+    old package, delta) tuples: packages are dicts from parse_primary, and
+    each delta is a dict of filename, sequence, size and checksum (sha256).
+    """
+    root = ElementTree.Element('prestodelta')
+    newpackages = {}
+    for new, old, delta in deltas:
+        newpackage = newpackages.get(new['pkgid'])
+        if newpackage is None:
+            newpackage = ElementTree.SubElement(root, 'newpackage')
+            for attr, key in (('name', 'name'), ('epoch', 'epoch'),
+                              ('version', 'version'),
+                              ('release', 'release'), ('arch', 'arch')):
+                newpackage.set(attr, new[key] or '0')
+            newpackages[new['pkgid']] = newpackage
+        elem = ElementTree.SubElement(newpackage, 'delta')
+        elem.set('oldepoch', old['epoch'] or '0')
+        elem.set('oldversion', old['version'])
+        elem.set('oldrelease', old['release'])
+        ElementTree.SubElement(elem, 'filename').text = delta['filename']
+        ElementTree.SubElement(elem, 'sequence').text = delta['sequence']
+        ElementTree.SubElement(elem, 'size').text = str(delta['size'])
+        checksum = ElementTree.SubElement(elem, 'checksum')
+        checksum.set('type', 'sha256')
+        checksum.text = delta['checksum']
+    return root
+
+
+def write_repomd(tree, repodata_dir):
+    """
+    Write repomd.xml into 'repodata_dir', bumping its revision.
+    """
+    revision = tree.getroot().find(repo_tag('revision'))
+    if revision is not None:
+        revision.text = str(int(time.time()))
+    write_xml(tree, os.path.join(repodata_dir, 'repomd.xml'), REPO_NS)
+    return
+
+
+def filter_repodata(src_dir, dest_dir, keep_pkgids):
+    """
+    Write a copy of the repodata in 'src_dir' to 'dest_dir', keeping only the
+    packages whose pkgid is in the set 'keep_pkgids'. The primary, filelists
+    and other metadata are rewritten; databases and other per-package
+    formats derived from them are dropped, and any other metadata (groups,
+    updateinfo, ...) is copied as-is.
+    """
+    tree, entries = repomd_data(src_dir)
+    if not os.path.exists(dest_dir):
+        os.makedirs(dest_dir)
+
+    for data_type, data in sorted(entries.items()):
+        location = data_location(data)
+        src_path = os.path.join(src_dir, os.path.basename(location))
+
+        if data_type in PACKAGE_DATA:
+            checksum_type = data.find(repo_tag('checksum')).get('type')
+            with open_metadata(src_path) as src_file:
+                doc = ElementTree.parse(src_file)
+            root = doc.getroot()
+            kept = 0
+            for package in list(root):
+                pkgid = package.get('pkgid')
+                if pkgid is None:
+                    pkgid = package.find(common_tag('checksum')).text
+                if pkgid in keep_pkgids:
+                    kept += 1
+                else:
+                    root.remove(package)
+            root.set('packages', str(kept))
+            values = write_data_file(doc, dest_dir, data_type,
+                                     PACKAGE_DATA[data_type], checksum_type)
+            update_data(data, checksum_type, values)
+
+        elif is_derived_data(data_type):
+            tree.getroot().remove(data)
+
+        else:
+            shutil.copy(src_path, dest_dir)
+
+    write_repomd(tree, dest_dir)
+    return
+
+# EOF
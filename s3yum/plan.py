@@ -0,0 +1,400 @@
+#!python
+# -*- coding: utf-8 -*-
+#==============================================================================
+#
+# s3yum: Repo creation/maintenance tool for S3-based yum repos
+#
+# Copyright 2013-2019 The New York Times Company
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+
+"""s3yum.plan: Plan a create/update without running it.
+
+'--plan' works out what a create or update would transfer from the bucket
+listing and the local files alone: no object is read, nothing is written,
+and createrepo doesn't run. It prints the objects to get, put, copy and
+delete, with their bytes, the S3 requests they take, and rough estimates of
+the time and request cost. The new metadata can't be known without
+createrepo, so its size is estimated from the published metadata, scaled by
+the change in the number of packages.
+
+'--plan-output FILE' also saves the plan as JSON. 'apply FILE' runs the
+saved action later, with the same rpm's and --remove globs, provided that
+neither the published repomd.xml nor the local rpm's have changed since.
+"""
+
+#----------------
+#    Imports:
+#----------------
+import os
+import json
+import math
+import datetime
+
+from s3yum import s3yum_cli
+from s3yum.s3yum_types import (
+    UserError,
+    ServiceError
+)
+from s3yum.engine import transfer_width
+from s3yum.util import (
+    s3join,
+    hash_files,
+    format_bytes,
+    get_s3item_md5,
+    s3time_as_datetime,
+    datetime_as_s3time
+)
+
+#----------------------------------------------
+#                Constants:
+#----------------------------------------------
+PLAN_VERSION = 1
+GET = 'get'
+PUT = 'put'
+COPY = 'copy'
+DELETE = 'delete'
+OPERATIONS = (GET, PUT, COPY, DELETE)
+# Rough figures for the estimates (S3 Standard, us-east-1):
+LIST_PAGE_SIZE = 1000
+REQUEST_LATENCY = 0.05              # Seconds per request
+BANDWIDTH = 50 * 1024 * 1024        # Bytes per second
+REQUEST_PRICES = {                  # Dollars per 1000 requests
+    'LIST': 0.005,
+    'GET': 0.0004,
+    'PUT': 0.005,
+    'COPY': 0.005,
+    'DELETE': 0.005,                # Multi-object deletes are POSTs
+}
+TRANSFER_OUT_PRICE = 0.09           # Dollars per GB, outside AWS
+# Compressed primary, filelists and other metadata, for a new repo:
+METADATA_BYTES_PER_PACKAGE = 3000
+NEW_REPO_METADATA_FILES = ('primary.xml.gz', 'filelists.xml.gz',
+                           'other.xml.gz')
+
+
+#----------------------------------------------
+#                Functions:
+#----------------------------------------------
+def page_count(count):
+    """
+    Number of LIST or multi-object DELETE requests for 'count' keys.
+    """
+    return int(math.ceil(count / float(LIST_PAGE_SIZE)))
+
+
+def file_fingerprint(filepath):
+    """
+    The (size, mtime) a planned rpm must still have when the plan is applied.
+    """
+    stat = os.stat(filepath)
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+def published_repomd(context):
+    """
+    The published repomd.xml item, from the listing, or None.
+    """
+    repomd_path = s3join(context.s3_repodata_path, s3yum_cli.REPOMD)
+    for item in context.s3_repodata_items:
+        if item.name == repomd_path:
+            return item
+    return None
+
+
+def metadata_generations(context):
+    """
+    Split the listed metadata files into the newest of each type (those the
+    published repomd.xml references, as far as the listing can tell) and the
+    older ones, without reading repomd.xml.
+    """
+    newest = {}
+    for item in context.s3_repodata_items:
+        filename = os.path.basename(item.name)
+        if filename == s3yum_cli.REPOMD:
+            continue
+        data_type = s3yum_cli.CHECKSUM_NAME_RE.sub('', filename)
+        if data_type not in newest or \
+                item.last_modified > newest[data_type].last_modified:
+            newest[data_type] = item
+    current = set(item.name for item in newest.values())
+    older = [item for item in context.s3_repodata_items
+             if item.name not in current and
+             os.path.basename(item.name) != s3yum_cli.REPOMD]
+    return newest, older
+
+
+def entry(name, size, note=None):
+    result = {'name': name, 'bytes': int(size)}
+    if note:
+        result['note'] = note
+    return result
+
+
+def make_plan(context):
+    """
+    Return the plan for the create/update in 'context', from its listing.
+    """
+    opts = context.opts
+    working_dir = opts.working_dir
+    operations = dict((operation, []) for operation in OPERATIONS)
+    requests = dict((method, 0) for method in REQUEST_PRICES)
+    notes = []
+
+    # Listing (the package manifest is a GET instead):
+    requests['LIST'] += max(1, page_count(len(context.s3_repodata_items)))
+    if context.s3_manifest is not None:
+        requests['GET'] += 1
+    else:
+        requests['LIST'] += max(1, page_count(len(context.s3_rpm_items)))
+
+    # Hash the local rpm's, and any copies in the working directory, in bulk:
+    local_copies = []
+    if working_dir is not None:
+        local_copies = [os.path.join(working_dir, os.path.basename(item.name))
+                        for item in context.s3_rpm_items]
+    hash_files([os.path.abspath(path) for path in context.rpm_args] +
+               local_copies)
+
+    # update downloads the repo into the working directory first:
+    if context.action == s3yum_cli.UPDATE:
+        for item in context.s3_repodata_items:
+            operations[GET].append(entry(item.name, item.size))
+        for item in context.s3_rpm_items:
+            filepath = os.path.join(
+                working_dir or '', os.path.basename(item.name))
+            if working_dir is None or s3yum_cli.should_download(
+                    item, filepath, opts.force_download):
+                operations[GET].append(entry(item.name, item.size))
+    removed = s3yum_cli.match_removes(context, report=True)
+    repomd = published_repomd(context)
+    if repomd is not None:
+        requests['GET'] += 1    # repomd.xml is read to collect stale metadata
+
+    # Rpm's to upload:
+    rpm_items = dict((os.path.basename(item.name), item)
+                     for item in context.s3_rpm_items)
+    files = {}
+    added = 0
+    for rpm_path in context.rpm_args:
+        filepath = os.path.abspath(rpm_path)
+        try:
+            files[filepath] = file_fingerprint(filepath)
+        except OSError as ex:
+            raise ServiceError('Unable to read "%s": %s' % (
+                filepath, ex.strerror))
+        filename = os.path.basename(filepath)
+        item = rpm_items.get(filename)
+        if item is None:
+            added += 1
+        if s3yum_cli.should_upload(filepath, item, opts.force_upload):
+            operations[PUT].append(entry(
+                s3join(opts.path, filename), files[filepath][0]))
+
+    # The new metadata, estimated from the published metadata:
+    old_count = len(context.s3_rpm_items)
+    new_count = max(0, old_count + added - len(removed))
+    newest, older = metadata_generations(context)
+    repodata_path = s3join(opts.path, s3yum_cli.REPODATA)
+    if newest and old_count:
+        scale = new_count / float(old_count)
+        metadata = [(data_type, newest_item.size * scale)
+                    for data_type, newest_item in sorted(newest.items())]
+    else:
+        metadata = [(data_type, new_count * METADATA_BYTES_PER_PACKAGE /
+                     len(NEW_REPO_METADATA_FILES))
+                    for data_type in NEW_REPO_METADATA_FILES]
+    for data_type, size in metadata:
+        operations[PUT].append(entry(
+            s3join(repodata_path, '<checksum>-' + data_type), size,
+            'estimated'))
+    operations[PUT].append(entry(
+        s3join(repodata_path, s3yum_cli.REPOMD),
+        repomd.size if repomd is not None else 3000, 'estimated'))
+    requests['PUT'] += 1    # The package manifest
+
+    # Deletes: --remove'd rpm's, and metadata whose grace period is over:
+    for item in removed:
+        operations[DELETE].append(entry(item.name, item.size))
+    if repomd is not None:
+        stale_since = s3time_as_datetime(repomd.last_modified)
+        grace = datetime.timedelta(seconds=opts.metadata_grace)
+        if datetime.datetime.utcnow() - stale_since >= grace:
+            for item in older:
+                operations[DELETE].append(entry(item.name, item.size))
+
+    # Snapshot copies, and the snapshots they expire:
+    if opts.snapshots > 0:
+        from s3yum.snapshots import list_snapshots
+        snapshots = list_snapshots(context)
+        requests['LIST'] += max(1, page_count(
+            sum(len(items) for items in snapshots.values())))
+        for data_type, size in metadata + [(s3yum_cli.REPOMD, 3000)]:
+            operations[COPY].append(entry(
+                s3join(repodata_path, s3yum_cli.SNAPSHOTS, '<id>', data_type),
+                size, 'estimated'))
+        for snapshot_id in sorted(snapshots)[:max(
+                0, len(snapshots) + 1 - opts.snapshots)]:
+            for item in snapshots[snapshot_id]:
+                operations[DELETE].append(entry(item.name, item.size))
+
+    if opts.sqlite or opts.deltas:
+        notes.append("sqlite databases and delta rpm's are not estimated")
+
+    requests['GET'] += len(operations[GET])
+    requests['PUT'] += len(operations[PUT])
+    requests['COPY'] += len(operations[COPY])
+    requests['DELETE'] += page_count(len(operations[DELETE]))
+
+    repomd_etag = get_s3item_md5(repomd) if repomd is not None else None
+    return {
+        'version': PLAN_VERSION,
+        'created': datetime_as_s3time(datetime.datetime.utcnow()),
+        'action': context.action,
+        'bucket': opts.bucket,
+        'path': opts.path,
+        'rpm_args': sorted(files),
+        'remove': opts.remove,
+        'repomd_etag': repomd_etag,
+        'files': files,
+        'operations': operations,
+        'requests': requests,
+        'estimates': estimate(context, operations, requests),
+        'notes': notes,
+    }
+
+
+def estimate(context, operations, requests):
+    """
+    Rough time and cost estimates for a plan's 'operations' and 'requests'.
+    """
+    transfers = len(operations[GET]) + len(operations[PUT]) + \
+        len(operations[COPY])
+    transfer_bytes = sum(op['bytes'] for op in
+                         operations[GET] + operations[PUT])
+    width = transfer_width(context, transfers)
+    seconds = (transfers * REQUEST_LATENCY / width +
+               transfer_bytes / float(BANDWIDTH) +
+               (sum(requests.values()) - transfers) * REQUEST_LATENCY)
+    request_cost = sum(REQUEST_PRICES[method] * count / 1000.0
+                       for method, count in requests.items())
+    get_bytes = sum(op['bytes'] for op in operations[GET])
+    return {
+        'seconds': round(seconds, 1),
+        'request_cost': round(request_cost, 6),
+        'transfer_out_cost': round(
+            get_bytes / float(1024 ** 3) * TRANSFER_OUT_PRICE, 6),
+    }
+
+
+def print_plan(plan):
+    """
+    Print a summary of 'plan' (each object with -v).
+    """
+    print "Plan for %s of %s:" % (
+        plan['action'], s3join(plan['bucket'], plan['path']))
+    for operation in OPERATIONS:
+        ops = plan['operations'][operation]
+        for op in ops:
+            s3yum_cli.verbose("\t%-6s %s (%s%s)", operation.upper(), op['name'],
+                              format_bytes(op['bytes']),
+                              ', ' + op['note'] if 'note' in op else '')
+        print "\t%-6s %6i objects %10s" % (
+            operation.upper(), len(ops),
+            format_bytes(sum(op['bytes'] for op in ops)))
+    print "\tRequests: %s" % ', '.join(
+        '%s %i' % (method, count)
+        for method, count in sorted(plan['requests'].items()))
+    estimates = plan['estimates']
+    print "\tEstimated time: %.1fs for S3 requests and transfers " \
+        "(createrepo not included)" % estimates['seconds']
+    print "\tEstimated cost: $%.6f in requests, $%.6f transfer out " \
+        "(if run outside AWS)" % (
+            estimates['request_cost'], estimates['transfer_out_cost'])
+    for note in plan['notes']:
+        print "\tNote: %s" % note
+    return
+
+
+def run_plan(context):
+    """
+    Print the plan for the action, saving it to --plan-output if given.
+    """
+    plan = make_plan(context)
+    print_plan(plan)
+    if context.opts.plan_output:
+        try:
+            with open(context.opts.plan_output, 'w') as plan_file:
+                json.dump(plan, plan_file, indent=2, sort_keys=True)
+        except IOError as ex:
+            raise ServiceError('Unable to write plan "%s": %s' % (
+                context.opts.plan_output, ex.strerror))
+        print "Saved plan to %s (run it with: s3yum apply %s)" % (
+            context.opts.plan_output, context.opts.plan_output)
+    return plan
+
+
+def load_plan(context):
+    """
+    Set up the context to apply the saved plan given as the only argument:
+    its action, bucket, path, rpm's and --remove globs.
+    """
+    if len(context.rpm_args) != 1:
+        raise UserError("Please specify a single plan file to apply.")
+    try:
+        with open(context.rpm_args[0]) as plan_file:
+            plan = json.load(plan_file)
+    except IOError as ex:
+        raise UserError('Unable to read plan "%s": %s' % (
+            context.rpm_args[0], ex.strerror))
+    except ValueError as ex:
+        raise UserError('Bad plan "%s": %s' % (context.rpm_args[0], ex))
+    if plan.get('version') != PLAN_VERSION:
+        raise UserError("Unsupported plan version: %s" % plan.get('version'))
+    if plan.get('action') not in (s3yum_cli.CREATE, s3yum_cli.UPDATE):
+        raise UserError("Bad plan action: %s" % plan.get('action'))
+
+    context.plan = plan
+    context.action = str(plan['action'])
+    context.rpm_args = [str(path) for path in plan['rpm_args']]
+    context.opts.bucket = str(plan['bucket'])
+    context.opts.path = str(plan['path'])
+    context.opts.remove = [str(pattern) for pattern in plan['remove']]
+    return
+
+
+def check_plan(context):
+    """
+    Raise ServiceError if the repo or the rpm's changed since the plan being
+    applied was made.
+    """
+    plan = context.plan
+    repomd = published_repomd(context)
+    repomd_etag = get_s3item_md5(repomd) if repomd is not None else None
+    if repomd_etag != plan['repomd_etag']:
+        raise ServiceError(
+            "The repo has been published since the plan was made (%s); "
+            "please plan again" % plan['created'])
+    for filepath, fingerprint in sorted(plan['files'].items()):
+        try:
+            changed = file_fingerprint(filepath) != fingerprint
+        except OSError:
+            changed = True
+        if changed:
+            raise ServiceError(
+                "%s has changed since the plan was made; please plan again" % (
+                    filepath))
+    return
+
+# EOF
@@ -0,0 +1,254 @@
+#!python
+# -*- coding: utf-8 -*-
+#==============================================================================
+#
+# s3yum: Repo creation/maintenance tool for S3-based yum repos
+#
+# Copyright 2013-2019 The New York Times Company
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+
+"""s3yum.progress: Aggregated progress for concurrent transfers.
+
+With -v, a set of downloads or uploads reports its progress through one
+ProgressAggregator. boto's per-transfer callbacks only update counters; a
+background thread renders the totals every --progress-interval seconds:
+ - on a terminal, a single status line (rewritten in place) with the files
+   and bytes done, the throughput, an ETA and the transfers in flight. While
+   it is shown, verbose() clears it before writing, and redraws it after;
+ - otherwise (e.g. in CI logs), one JSON object per line.
+Everything goes to stderr, so it never mixes with 'get --stream' output.
+"""
+
+#----------------
+#    Imports:
+#----------------
+import sys
+import json
+import time
+import threading
+
+from s3yum import s3yum_cli
+from s3yum.util import format_bytes
+
+
+#----------------------------------------------
+#                Constants:
+#----------------------------------------------
+# boto progress callbacks per transfer; they only update counters:
+PROGRESS_CALLBACKS = 100
+JSON_INTERVAL_FACTOR = 10   # JSON lines are written less often than a TTY's
+
+
+#----------------------------------------------
+#                 Classes:
+#----------------------------------------------
+class ProgressAggregator(object):
+
+    """
+    Collects the byte counts of many concurrent transfers, and renders their
+    totals at a fixed rate.
+    """
+
+    def __init__(self, label, sizes, interval, stream=None, json_lines=None):
+        """
+        'sizes' are the sizes of the transfers to come. Lines are JSON if
+        'json_lines' is set, or (by default) if 'stream' isn't a terminal.
+        """
+        self.label = label
+        self.stream = stream or sys.stderr
+        if json_lines is None:
+            isatty = getattr(self.stream, 'isatty', None)
+            json_lines = not (isatty and isatty())
+        self.json_lines = json_lines
+        self.interval = interval * (JSON_INTERVAL_FACTOR if json_lines else 1)
+        self.total_files = len(sizes)
+        self.total_bytes = sum(sizes)
+        self.done_files = 0
+        self.done_bytes = 0
+        self.active = {}        # name -> bytes transferred so far
+        self.start_time = time.time()
+        self.line_length = 0
+        self.lock = threading.Lock()
+        self.output_lock = threading.RLock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.restore = None     # called by close(), see start_progress
+        return
+
+    def start(self):
+        """
+        Render from a background thread until close().
+        """
+        def render_loop():
+            while not self.stop_event.wait(self.interval):
+                self.render()
+
+        self.thread = threading.Thread(target=render_loop,
+                                       name='s3yum-progress')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def callback(self, name):
+        """
+        Return a boto progress callback for the transfer 'name'.
+        """
+        def progress_fn(transferred, total):
+            with self.lock:
+                self.active[name] = transferred
+        with self.lock:
+            self.active[name] = 0
+        return progress_fn
+
+    def finish(self, name, size):
+        """
+        Count the transfer 'name' of 'size' bytes as done.
+        """
+        with self.lock:
+            self.active.pop(name, None)
+            self.done_files += 1
+            self.done_bytes += size
+        return
+
+    def skip(self, size):
+        """
+        Leave a transfer of 'size' bytes which wasn't needed out of the
+        totals.
+        """
+        with self.lock:
+            self.total_files -= 1
+            self.total_bytes -= size
+        return
+
+    def snapshot(self):
+        """
+        Return the current totals, as a dict.
+        """
+        with self.lock:
+            done_bytes = self.done_bytes + sum(self.active.values())
+            active = len(self.active)
+            done_files = self.done_files
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        rate = done_bytes / elapsed
+        remaining = max(0, self.total_bytes - done_bytes)
+        return {
+            'label': self.label,
+            'files_done': done_files,
+            'files_total': self.total_files,
+            'bytes_done': done_bytes,
+            'bytes_total': self.total_bytes,
+            'bytes_per_second': int(rate),
+            'eta_seconds': int(remaining / rate) if rate > 0 else None,
+            'active': active,
+            'elapsed_seconds': round(elapsed, 1),
+        }
+
+    def render(self, final=False):
+        """
+        Write the current totals to the stream.
+        """
+        status = self.snapshot()
+        if self.json_lines:
+            line = json.dumps(status, sort_keys=True) + '\n'
+        else:
+            line = format_status(status)
+            padding = ' ' * max(0, self.line_length - len(line))
+            line = '\r' + line + padding + ('\n' if final else '')
+        with self.output_lock:
+            if not self.json_lines:
+                self.line_length = 0 if final else len(line.strip('\r'))
+            self.write(line)
+        return
+
+    def write(self, text):
+        try:
+            self.stream.write(text)
+            self.stream.flush()
+        except (IOError, ValueError):
+            pass
+        return
+
+    def wrap_print(self, print_fn):
+        """
+        Return the verbose function 'print_fn', made to clear the status
+        line before it writes, and redraw it after, so that its lines aren't
+        spliced onto the status line.
+        """
+        if self.json_lines:
+            return print_fn
+
+        def print_over_status(msg, *args):
+            with self.output_lock:
+                if self.line_length:
+                    self.write('\r' + ' ' * self.line_length + '\r')
+                    self.line_length = 0
+                print_fn(msg, *args)
+                self.render()
+        return print_over_status
+
+    def close(self):
+        """
+        Stop rendering, and render the final totals.
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.render(final=True)
+        if self.restore is not None:
+            self.restore()
+        return
+
+
+#----------------------------------------------
+#                Functions:
+#----------------------------------------------
+def format_duration(seconds):
+    """
+    Format an ETA for people: 42s, 3m05s, 2h10m.
+    """
+    if seconds is None:
+        return '?'
+    if seconds < 60:
+        return '%is' % seconds
+    if seconds < 3600:
+        return '%im%02is' % divmod(seconds, 60)
+    return '%ih%02im' % divmod(seconds // 60, 60)
+
+
+def format_status(status):
+    """
+    One status line for a terminal.
+    """
+    return "%s: %i/%i files, %s/%s, %s/s, ETA %s, %i active" % (
+        status['label'], status['files_done'], status['files_total'],
+        format_bytes(status['bytes_done']), format_bytes(status['bytes_total']),
+        format_bytes(status['bytes_per_second']),
+        format_duration(status['eta_seconds']), status['active'])
+
+
+def start_progress(context, label, sizes):
+    """
+    Return a started ProgressAggregator for transfers of 'sizes' bytes, or
+    None if progress isn't reported (without -v, or for a dry run).
+    """
+    if not context.opts.verbose or context.opts.dry_run or not sizes:
+        return None
+    progress = ProgressAggregator(label, sizes, context.opts.progress_interval)
+    print_fn = s3yum_cli.verbose
+    s3yum_cli.verbose = progress.wrap_print(print_fn)
+    progress.restore = lambda: setattr(s3yum_cli, 'verbose', print_fn)
+    return progress.start()
+
+# EOF
@@ -0,0 +1,198 @@
+#!python
+# -*- coding: utf-8 -*-
+#==============================================================================
+#
+# s3yum: Repo creation/maintenance tool for S3-based yum repos
+#
+# Copyright 2013-2019 The New York Times Company
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+
+"""s3yum.query: Select packages from a repo's primary metadata.
+
+Used by 'get' to download part of a repo. Packages are selected by:
+ - filename globs (--include, --exclude)
+ - architecture (--arch)
+ - NEVRA queries (--query), as accepted by yum: 'name', 'name.arch',
+   'name-version', 'name-version-release', 'name-version-release.arch' or
+   'name-epoch:version-release.arch', any of which may be a glob. A query
+   selects the newest matching version of each name and arch.
+and, optionally, the packages they require (resolve_deps).
+"""
+
+#----------------
+#    Imports:
+#----------------
+import os
+
+from s3yum.metadata import (
+    compare_evr,
+    package_evr
+)
+from s3yum.util import GlobMatcher
+
+
+#----------------------------------------------
+#                Functions:
+#----------------------------------------------
+def nevra_forms(package):
+    """
+    The names a NEVRA query may use for 'package'.
+    """
+    name, arch = package['name'], package['arch']
+    version, release = package['version'], package['release']
+    return [
+        name,
+        '%s.%s' % (name, arch),
+        '%s-%s' % (name, version),
+        '%s-%s-%s' % (name, version, release),
+        '%s-%s-%s.%s' % (name, version, release, arch),
+        '%s-%s:%s-%s.%s' % (name, package['epoch'] or '0', version, release,
+                            arch),
+    ]
+
+
+def newest(packages):
+    """
+    The newest version of each name and arch in 'packages'.
+    """
+    by_name = {}
+    for package in packages:
+        key = (package['name'], package['arch'])
+        current = by_name.get(key)
+        if current is None or compare_evr(
+                package_evr(package), package_evr(current)) > 0:
+            by_name[key] = package
+    return by_name.values()
+
+
+def filename(package):
+    """
+    The rpm filename of 'package'.
+    """
+    return os.path.basename(package['location'])
+
+
+def select_packages(packages, includes=(), excludes=(), arches=(),
+                    queries=()):
+    """
+    Select the packages (dicts from parse_primary) matching the filename
+    globs 'includes' or the NEVRA 'queries' (or all, if neither is given),
+    of the given 'arches' (if any), which don't match the filename globs
+    'excludes'. Returns (selected, unmatched): the selected packages, in
+    their original order, and the includes and queries which matched no
+    package.
+    """
+    includes, queries = list(includes), list(queries)
+    selected = set()
+    unmatched = []
+    if not includes and not queries:
+        selected.update(package['pkgid'] for package in packages)
+
+    if includes:
+        by_filename = dict((filename(package), package)
+                           for package in packages)
+        matcher = GlobMatcher(includes)
+        selected.update(by_filename[name]['pkgid']
+                        for name in matcher.filter(sorted(by_filename)))
+        unmatched += matcher.unmatched()
+
+    if queries:
+        by_form = {}
+        for package in packages:
+            for form in nevra_forms(package):
+                by_form.setdefault(form, []).append(package)
+        for query in queries:
+            # Each query picks its own newest versions:
+            hits = GlobMatcher([query]).filter(sorted(by_form))
+            matches = dict((package['pkgid'], package)
+                           for form in hits for package in by_form[form])
+            selected.update(package['pkgid']
+                            for package in newest(matches.values()))
+            if not hits:
+                unmatched.append(query)
+
+    arches = set(arches)
+    excluded = set(package['pkgid'] for package in excluded_packages(
+        packages, excludes))
+    return [package for package in packages
+            if package['pkgid'] in selected and
+            package['pkgid'] not in excluded and
+            (not arches or package['arch'] in arches)], unmatched
+
+
+def excluded_packages(packages, excludes):
+    """
+    The packages whose filename matches any of the globs 'excludes'.
+    """
+    if not excludes:
+        return []
+    by_filename = dict((filename(package), package) for package in packages)
+    return [by_filename[name] for name in
+            GlobMatcher(excludes).filter(sorted(by_filename))]
+
+
+def choose_provider(providers, requirer):
+    """
+    Pick the package to satisfy a requirement of 'requirer': one of the
+    same arch if possible, else noarch, else any; the newest of those.
+    """
+    for arch in (requirer['arch'], 'noarch', None):
+        candidates = [package for package in providers
+                      if arch is None or package['arch'] == arch]
+        if candidates:
+            return sorted(
+                candidates, reverse=True,
+                cmp=lambda a, b: compare_evr(package_evr(a),
+                                             package_evr(b)))[0]
+    return None
+
+
+def resolve_deps(packages, selected):
+    """
+    Add the packages required by 'selected', recursively, choosing from
+    'packages' (dicts from parse_primary with deps=True). Version
+    constraints are not checked. Returns (closure, unresolved): the selected
+    packages plus their dependencies, in the order of 'packages', and the
+    requirements no package in the repo provides.
+    """
+    providers = {}
+    for package in packages:
+        for capability in package['provides'] + package['files']:
+            providers.setdefault(capability, []).append(package)
+
+    chosen = dict((package['pkgid'], package) for package in selected)
+    provided = set()
+    unresolved = set()
+    queue = list(selected)
+    while queue:
+        package = queue.pop()
+        provided.update(package['provides'])
+        provided.update(package['files'])
+        for requirement in package['requires']:
+            if requirement.startswith('rpmlib(') or requirement in provided:
+                continue
+            candidates = providers.get(requirement)
+            if not candidates:
+                unresolved.add(requirement)
+                continue
+            if any(c['pkgid'] in chosen for c in candidates):
+                continue
+            provider = choose_provider(candidates, package)
+            chosen[provider['pkgid']] = provider
+            queue.append(provider)
+
+    return [p for p in packages if p['pkgid'] in chosen], sorted(unresolved)
+
+# EOF
@@ -0,0 +1,189 @@
+#!python
+# -*- coding: utf-8 -*-
+#==============================================================================
+#
+# s3yum: Repo creation/maintenance tool for S3-based yum repos
+#
+# Copyright 2013-2019 The New York Times Company
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+
+"""s3yum.repo: Python API for s3yum.
+
+S3YumRepo performs the same operations as the s3yum command line, for
+tooling which manages many repos from a single process:
+
+    from s3yum.repo import S3YumRepo
+
+    with S3YumRepo('my_bucket', 'el7/x86_64/stable') as repo:
+        repo.add_rpms(['my_pkg-1.0-1.x86_64.rpm'])
+        repo.remove(['*/old_pkg-*'])
+        for item in repo.list():
+            print item.name
+
+S3 connections (and with them, any --assume-role credentials) are shared by
+every S3YumRepo in the process which uses the same region and role. Each
+repo keeps its listing and working directory between calls, so only the
+first call pays for a full listing and download.
+
+Errors are raised as s3yum.s3yum_types.UserError/ServiceError.
+"""
+
+#----------------
+#    Imports:
+#----------------
+import shutil
+import threading
+
+from s3yum import s3yum_cli
+from s3yum.s3yum_types import (
+    UserError,
+    S3YumContext
+)
+from s3yum.util import get_print_fn
+
+#----------------------------------------------
+#                 Globals:
+#----------------------------------------------
+# (region, assume_role, role_external_id) -> boto s3 connection
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+#----------------------------------------------
+#                 Classes:
+#----------------------------------------------
+class S3YumRepo(object):
+
+    """
+    A yum repo at 'path' in the S3 bucket 'bucket'.
+
+    Keyword arguments are the long command line options, with dashes as
+    underscores (e.g. region='us-east-1', working_dir='/var/cache/repo',
+    lock=True, verbose=1).
+    """
+
+    def __init__(self, bucket, path, **options):
+        context = S3YumContext()
+        s3yum_cli.parse_args(context, ['s3yum'])
+        for name, value in options.items():
+            if not hasattr(context.opts, name):
+                raise UserError("Unknown s3yum option: '%s'" % name)
+            setattr(context.opts, name, value)
+
+        context.opts.bucket = bucket
+        context.opts.path = path.lstrip('/')
+        context.opts.lock = context.opts.lock or context.opts.piggyback
+        self.context = context
+        self.print_fn = get_print_fn(context.opts.dry_run, context.opts.verbose)
+        self.listed = False
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def activate(self):
+        """
+        Point s3yum's module-level output at this repo, and connect.
+        """
+        s3yum_cli.verbose = self.print_fn
+        if self.context.s3_bucket is None:
+            opts = self.context.opts
+            cache_key = (opts.region, opts.assume_role, opts.role_external_id)
+            with _connections_lock:
+                self.context.s3_conn = _connections.get(cache_key)
+                s3yum_cli.connect_to_bucket(self.context)
+                _connections[cache_key] = self.context.s3_conn
+        return
+
+    def refresh(self, force=False):
+        """
+        List the repo, unless we already have a current listing.
+        """
+        self.activate()
+        if force or not self.listed:
+            s3yum_cli.list_metadata(self.context)
+            s3yum_cli.list_rpms(self.context)
+            self.listed = True
+        return
+
+    def list(self):
+        """
+        Return the repo's rpm's, as boto s3 keys.
+        """
+        self.refresh()
+        return list(self.context.s3_rpm_items)
+
+    def add_rpms(self, rpm_paths, remove=()):
+        """
+        Add the local rpm files 'rpm_paths' to the repo, and remove the rpm's
+        matching the globs in 'remove'; then publish new repodata.
+        """
+        self.activate()
+        context = self.context
+        context.rpm_args = list(rpm_paths)
+        context.opts.remove = list(remove)
+        if context.working_dir is None:
+            s3yum_cli.init_workingdir(context)
+
+        def publish(context):
+            self.refresh()
+            s3yum_cli.update_repo(context)
+
+        try:
+            if context.opts.lock and not context.opts.dry_run:
+                # The lock requires a fresh listing, taken while holding it:
+                self.listed = False
+                s3yum_cli.with_publish_lock(context, publish)
+            else:
+                publish(context)
+        finally:
+            # The publish changed the repo; list it again when next needed.
+            # After a successful publish, that's a single manifest GET.
+            self.listed = False
+            context.rpm_args = []
+            context.opts.remove = []
+        return
+
+    def remove(self, globs):
+        """
+        Remove the rpm's matching 'globs' from the repo.
+        """
+        self.add_rpms([], globs)
+        return
+
+    def get(self, dest_dir):
+        """
+        Download the entire repo, including repodata, to 'dest_dir'.
+        """
+        self.refresh()
+        s3yum_cli.get_repo(self.context, dest_dir)
+        return
+
+    def close(self):
+        """
+        Remove our working directory, unless it was given as working_dir.
+        """
+        context = self.context
+        if context.working_dir is not None and not context.opts.working_dir:
+            shutil.rmtree(context.working_dir, True)
+        context.working_dir = None
+        context.working_dir_repodata = None
+        return
+
+# EOF
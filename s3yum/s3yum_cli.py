@@ -30,23 +30,22 @@ for the s3yum utility.
 #----------------
 #    Imports:
 #----------------
+# boto and subprocess are imported by the functions which need them, so that
+# short invocations (--help, help, bad arguments) don't pay for them.
 import os
 import sys
 import time
 import string
 import optparse
-import boto
-import boto.s3
-import boto.s3.connection
-import boto.sts
 import tempfile
 import shutil
 import re
 import traceback
-import subprocess
-import fnmatch
-import pkg_resources
+import datetime
+import calendar
+import json
 
+from s3yum import __version__
 from s3yum.s3yum_types import (
     UserError,
     ServiceError,
@@ -55,11 +54,42 @@ from s3yum.s3yum_types import (
 from s3yum.util import (
     s3join,
     get_print_fn,
-    get_progress_fn,
+    list_keys_sharded,
+    quantile_boundaries,
+    charset_boundaries,
+    get_file_md5,
+    get_file_sha256,
+    hash_files,
+    set_file_mtime,
     md5_matches,
     get_s3item_md5,
     mtime_as_datetime,
-    s3time_as_datetime
+    s3time_as_datetime,
+    datetime_as_s3time,
+    json_to_gzip,
+    gzip_to_json,
+    GlobMatcher
+)
+from s3yum.metadata import (
+    is_derived_data,
+    repomd_locations,
+    repomd_data,
+    data_location,
+    parse_primary,
+    filter_repodata,
+    compare_evr,
+    package_evr,
+    write_repomd,
+    data_compression,
+    compress_data_file,
+    PACKAGE_DATA,
+    COMPRESSIONS
+)
+from s3yum.engine import (
+    init_engine,
+    transfer_map,
+    ENGINES,
+    THREADS
 )
 
 
@@ -71,10 +101,7 @@ verbose = None  # <-- verbose flag used by get_print_fn
 # Program metadata:
 USAGE = "usage: %prog ACTION [OPTIONS] [RPM1] [RPM2] ... [RPM2]"
 DESCRIPTION = "Create/maintain s3-based yum repos"
-try:
-    VERSION = pkg_resources.get_distribution('s3yum').version
-except pkg_resources.DistributionNotFound:
-    VERSION = '{0} local source'.format(__name__)
+VERSION = __version__
 
 
 # s3yum actions:
@@ -84,6 +111,14 @@ CREATE = 'create'
 UPDATE = 'update'
 GET = 'get'
 DELETE = 'delete'
+DAEMON = 'daemon'
+BATCH = 'batch'
+PRUNE = 'prune'
+VERIFY = 'verify'
+WATCH = 'watch'
+SERVE = 'serve'
+ROLLBACK = 'rollback'
+APPLY = 'apply'
 
 ACTIONS_HELP = {
     HELP: 'provide help for a given action',
@@ -92,6 +127,14 @@ ACTIONS_HELP = {
     UPDATE: "update a yum repo by adding or deleting rpm's",
     GET: "copy the entirety of a given repo to a local directory",
     DELETE: "remove an entire repo (DANGEROUS!)",
+    DAEMON: "serve an API which publishes submitted rpm's in batches",
+    BATCH: "update many repos from a manifest file of paths and rpm globs",
+    PRUNE: "delete old rpm versions (see --keep and --older-than)",
+    VERIFY: "check the repodata against the rpm's in the bucket",
+    WATCH: "publish the rpm's dropped into a directory, in batches",
+    SERVE: "serve the repo over HTTP, through a local cache",
+    ROLLBACK: "republish the repodata of a --snapshot",
+    APPLY: "run a create/update saved with --plan-output",
 }
 
 ACTIONS = (
@@ -101,6 +144,14 @@ ACTIONS = (
     UPDATE,
     GET,
     DELETE,
+    DAEMON,
+    BATCH,
+    PRUNE,
+    VERIFY,
+    WATCH,
+    SERVE,
+    ROLLBACK,
+    APPLY,
 )
 
 ACTIONS_DESC = string.join(ACTIONS, '|')
@@ -116,8 +167,45 @@ Environment:
 
 # Constants:
 REPODATA = 'repodata'
+REPOMD = 'repomd.xml'
+MANIFEST = 's3yum-manifest.json.gz'
+MANIFEST_VERSION = 1
+LOCK = '.s3yum-lock'
+INBOX = '.s3yum-inbox'
+INBOX_REMOVES = 'remove.json'
+SNAPSHOTS = 'snapshots'
+LOCK_POLL_INTERVAL = 5
+DELETE_BATCH_SIZE = 1000
+# Object metadata holding an rpm's sha256, checked by verify:
+SHA256_HEADER = 'x-amz-meta-sha256'
 CREATEREPO = os.environ.get('CREATEREPO', 'createrepo')
+CACHEDIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    's3yum', 'createrepo')
+SERVE_CACHEDIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    's3yum', 'serve')
 FOLDER_SUFFIX = "_$folder$"
+# Metadata files createrepo names after their checksum (unique-md-filenames):
+CHECKSUM_NAME_RE = re.compile(r'^[0-9a-f]{32,128}-')
+CONTENT_TYPES = {
+    '.rpm': 'application/x-rpm',
+    '.drpm': 'application/x-rpm',
+    '.xml': 'text/xml',
+    '.gz': 'application/x-gzip',
+    '.bz2': 'application/x-bzip2',
+    '.xz': 'application/x-xz',
+    '.zst': 'application/zstd',
+    '.zck': 'application/octet-stream',
+    '.sqlite': 'application/x-sqlite3',
+    '.asc': 'text/plain',
+}
+# Characters RPM file names typically start with, used to shard listings:
+RPM_NAME_CHARS = string.digits + string.ascii_letters
+# Without --list-shards, listings are sharded one range per this many
+# packages (10 LIST pages), up to LIST_SHARDS_MAX ranges:
+LIST_SHARD_KEYS = 10000
+LIST_SHARDS_MAX = 16
 
 
 #----------------------------------------------
@@ -182,6 +270,278 @@ def parse_args(context, argv):
         help="Force all rpms to upload, instead of just the missing ones.",
         action='store_true', default=False)
 
+    parser.add_option(
+        "--workers",
+        help="Number of concurrent S3 requests (default: %default)",
+        type='int', default=8)
+
+    parser.add_option(
+        "--engine",
+        help="How to run concurrent transfers: %s. gevent keeps up to "
+             "--concurrency requests in flight (default: %%default)"
+             % ', '.join(ENGINES),
+        type='choice', choices=ENGINES, default=THREADS)
+
+    parser.add_option(
+        "--concurrency",
+        help="Number of concurrent S3 requests with --engine gevent "
+             "(default: %default)",
+        type='int', default=200)
+
+    parser.add_option(
+        "--list-shards",
+        help="Split bucket listings into this many key ranges, " +
+        "listed concurrently (default: one range per %i packages in a " % (
+            LIST_SHARD_KEYS) +
+        "stale manifest, up to %i, and no sharding for small repos)" % (
+            LIST_SHARDS_MAX),
+        type='int', default=None)
+
+    parser.add_option(
+        "--no-manifest",
+        help="Ignore the package manifest and always list the bucket.",
+        action='store_true', default=False)
+
+    parser.add_option(
+        "--metadata-grace",
+        help="Seconds to keep superseded metadata files after a publish, " +
+        "for clients holding the old repomd.xml (default: %default)",
+        type='int', default=3600)
+
+    parser.add_option(
+        "--plan",
+        help="Print the objects, requests, time and cost a CREATE/UPDATE " +
+        "would take, from the listing alone, instead of running it",
+        action='store_true', default=False)
+
+    parser.add_option(
+        "--plan-output",
+        help="Also save the --plan as JSON, to APPLY later",
+        type='string', default=None)
+
+    parser.add_option(
+        "--snapshots",
+        help="Keep snapshots of the repodata of the newest SNAPSHOTS " +
+        "publishes, for ROLLBACK (default: %default)",
+        type='int', default=0)
+
+    parser.add_option(
+        "--snapshot",
+        help="Snapshot id to ROLLBACK to, or to GET the repo as of",
+        type='string', default=None)
+
+    parser.add_option(
+        "--max-age",
+        help="Cache-Control max-age for rpm's and checksum-named " +
+        "metadata, which never change (default: %default)",
+        type='int', default=31536000)
+
+    parser.add_option(
+        "--repomd-max-age",
+        help="Cache-Control max-age for repomd.xml and other metadata " +
+        "which is overwritten in place (default: %default)",
+        type='int', default=60)
+
+    parser.add_option(
+        "--no-cache-headers",
+        help="Don't set Cache-Control/Content-Type headers on uploads",
+        action='store_true', default=False)
+
+    parser.add_option(
+        "--listen",
+        help="Address for the DAEMON and SERVE actions: [host:]port or " +
+        "unix:/path/to/socket (default: %default)",
+        type='string', default='127.0.0.1:8642')
+
+    parser.add_option(
+        "--batch-window",
+        help="Seconds the DAEMON action waits for more rpm's after the " +
+        "first one arrives, before publishing (default: %default)",
+        type='int', default=30)
+
+    parser.add_option(
+        "--progress-interval",
+        help="Seconds between -v progress updates for concurrent transfers; "
+             "ten times as long for JSON lines, when stderr isn't a "
+             "terminal (default: %default)",
+        type='float', default=1.0)
+
+    parser.add_option(
+        "--poll-interval",
+        help="Seconds between WATCH rescans of the directory, which find "
+             "files inotify can't see (e.g. written by other NFS clients) "
+             "(default: %default)",
+        type='int', default=30)
+
+    parser.add_option(
+        "--serve-cache",
+        help="Directory SERVE caches rpm's and checksum-named metadata in "
+             "(default: %default)",
+        type='string', default=SERVE_CACHEDIR)
+
+    parser.add_option(
+        "--serve-cache-size",
+        help="MB of objects SERVE keeps cached, evicting the least recently "
+             "used (default: %default)",
+        type='int', default=10240)
+
+    parser.add_option(
+        "--daemon-url",
+        help="UPDATE via the DAEMON at this url (http://host:port or " +
+        "unix:/path/to/socket) instead of publishing directly",
+        type='string', default=None)
+
+    parser.add_option(
+        "--daemon-timeout",
+        help="Seconds an UPDATE via --daemon-url waits for its rpm's to be " +
+        "published (default: %default)",
+        type='int', default=3600)
+
+    parser.add_option(
+        "--lock",
+        help="Hold a lock object in S3 while updating the repo, so " +
+        "concurrent CREATE/UPDATE runs don't overwrite each other",
+        action='store_true', default=False)
+
+    parser.add_option(
+        "--piggyback",
+        help="If the lock is held, hand our rpm's to the holder's next " +
+        "publish instead of waiting to publish them ourselves (implies --lock)",
+        action='store_true', default=False)
+
+    parser.add_option(
+        "--lock-ttl",
+        help="Seconds after which an unrenewed lock expires " +
+        "(default: %default)",
+        type='int', default=300)
+
+    parser.add_option(
+        "--lock-timeout",
+        help="Seconds to wait for the lock (default: %default)",
+        type='int', default=1800)
+
+    parser.add_option(
+        "--keep",
+        help="PRUNE: keep the newest KEEP versions of each package",
+        type='int', default=None)
+
+    parser.add_option(
+        "--older-than",
+        help="PRUNE: only prune package versions uploaded more than OLDER_THAN "
+             "days ago",
+        type='float', default=None)
+
+    parser.add_option(
+        "--createrepo-workers",
+        help="Number of createrepo worker processes [default: one per CPU]",
+        type='int', default=None)
+
+    parser.add_option(
+        "--no-createrepo-update",
+        help="Regenerate all metadata, instead of reusing the previous "
+             "repodata for unchanged rpm's (createrepo --update)",
+        action="store_true", default=False)
+
+    parser.add_option(
+        "--cachedir",
+        help="createrepo checksum cache directory [default: %default]",
+        type='string', default=CACHEDIR)
+
+    parser.add_option(
+        "--no-cachedir",
+        help="Don't give createrepo a checksum cache directory",
+        action="store_true", default=False)
+
+    parser.add_option(
+        "--cachedir-mirror",
+        help="Path in the bucket to share the --cachedir through: it is "
+             "synced down before, and up after, running createrepo",
+        type='string', default=None)
+
+    parser.add_option(
+        "--compression",
+        help="Compression of the package metadata: one of %s for all of "
+             "it, or a list of TYPE=COMPRESSION, e.g. "
+             "'primary=gz,filelists=zstd,other=zstd' [default: createrepo's]"
+             % ', '.join(sorted(COMPRESSIONS)),
+        type='string', default=None)
+
+    parser.add_option(
+        "--sqlite",
+        help="Publish sqlite databases of the metadata (primary_db, etc.), "
+             "updated from the previous publish's instead of rebuilt",
+        action="store_true", default=False)
+
+    parser.add_option(
+        "--zchunk",
+        help="Also publish zchunk metadata, which dnf can update by "
+             "downloading only the changed chunks (requires createrepo_c)",
+        action="store_true", default=False)
+
+    parser.add_option(
+        "--deltas",
+        help="Publish delta rpm's from the previous --num-deltas versions of "
+             "each package to the newest (requires makedeltarpm)",
+        action="store_true", default=False)
+
+    parser.add_option(
+        "--num-deltas",
+        help="Number of older versions to make delta rpm's from "
+             "[default: %default]",
+        type='int', default=1)
+
+    parser.add_option(
+        "--include",
+        help="GET: only download rpm's whose filename matches the glob "
+             "INCLUDE (may be repeated)",
+        action="append", default=[])
+
+    parser.add_option(
+        "--exclude",
+        help="GET: don't download rpm's whose filename matches the glob "
+             "EXCLUDE (may be repeated)",
+        action="append", default=[])
+
+    parser.add_option(
+        "--arch",
+        help="GET: only download rpm's built for ARCH (may be repeated)",
+        action="append", default=[])
+
+    parser.add_option(
+        "--query",
+        help="GET: download the newest package matching the NEVRA QUERY, "
+             "e.g. 'nginx' or 'nginx-1.12*.x86_64' (may be repeated)",
+        action="append", default=[])
+
+    parser.add_option(
+        "--resolve-deps",
+        help="GET: also download the packages the selected ones require",
+        action="store_true", default=False)
+
+    parser.add_option(
+        "--stream",
+        help="GET: write the repo as a tar to --output ('-' or none for "
+             "stdout) instead of to a directory",
+        action="store_true", default=False)
+
+    parser.add_option(
+        "--stream-compression",
+        help="GET: compress the --stream tar with COMPRESSION (none, gzip "
+             "or zstd) [default: %default]",
+        type='choice', choices=['none', 'gzip', 'zstd'], default='none')
+
+    parser.add_option(
+        "--read-ahead",
+        help="GET: with --stream, download up to READ_AHEAD MB ahead of the "
+             "tar writer [default: %default]",
+        type='int', default=64)
+
+    parser.add_option(
+        "--sample",
+        help="VERIFY: check only a random SAMPLE of packages with HEAD "
+             "requests (0 for all) [default: %default]",
+        type='int', default=1000)
+
     parser.add_option(
         "--dry-run",
         help='Indicate what would happen, ' +
@@ -215,6 +575,7 @@ def parse_args(context, argv):
         context.action = None
 
     opts.path = re.sub(r'^\/+', '', opts.path)
+    opts.lock = opts.lock or opts.piggyback
     context.rpm_args = args[2:]
     return opts
 
@@ -275,6 +636,37 @@ def init_workingdir(context):
     return
 
 
+def match_removes(context, report=False):
+    """
+    Return the rpm items matching the --remove globs. If 'report' is set,
+    warn about any glob which matches nothing.
+    """
+    if not context.opts.remove:
+        return []
+    matcher = GlobMatcher(context.opts.remove)
+    items_by_name = dict((item.name, item) for item in context.s3_rpm_items)
+    removed = [items_by_name[name] for name in matcher.filter(
+        [item.name for item in context.s3_rpm_items])]
+    if report:
+        for pattern in matcher.unmatched():
+            print "Warning: --remove '%s' matches no rpm's" % pattern
+    return removed
+
+
+def remove_local_rpms(context):
+    """
+    Remove local copies of any --remove'd rpm's from the working directory,
+    so that they are left out of the new repodata.
+    """
+    for item in match_removes(context, report=True):
+        filepath = os.path.join(
+            context.working_dir, os.path.basename(item.name))
+        if os.path.exists(filepath):
+            verbose("Removing local copy: %s", filepath)
+            os.remove(filepath)
+    return
+
+
 def copy_rpms(context):
     """
     Copy input rpm's into the working directory.
@@ -296,10 +688,21 @@ def copy_rpms(context):
 def connect_to_bucket(context):
     """
     Connect to s3 and get the specified bucket, if it exists.
+    An existing context.s3_conn is reused.
     """
+    import boto
+    import boto.s3
+    import boto.s3.bucket
+    import boto.s3.connection
+    import boto.sts
+
+    init_engine(context)
     try:
+        # Reuse the connection we were given (e.g. by s3yum.repo):
+        if context.s3_conn is not None:
+            conn = context.s3_conn
         # If we're assuming a role, attempt to get temporary credentials:
-        if context.opts.assume_role:
+        elif context.opts.assume_role:
             sts_conn = boto.sts.STSConnection()
             assumedRoleObject = sts_conn.assume_role(
                 role_arn=context.opts.assume_role,
@@ -351,6 +754,11 @@ def print_lists(context):
 
     for rpm_item in context.s3_rpm_items:
         list_item(rpm_item)
+
+    from s3yum.snapshots import list_snapshots
+    snapshots = sorted(list_snapshots(context))
+    if snapshots:
+        print "Snapshots: %s" % ', '.join(snapshots)
     return
 
 
@@ -361,10 +769,13 @@ def list_metadata(context):
     context.s3_repodata_path = s3join(context.opts.path, REPODATA)
     key_list = context.s3_bucket.list(prefix=context.s3_repodata_path)
 
+    snapshots_prefix = s3join(context.s3_repodata_path, SNAPSHOTS, '')
     context.s3_repodata_items = []
     for item in key_list:
         if item.name.find(FOLDER_SUFFIX) != -1:
             continue
+        if item.name.startswith(snapshots_prefix):
+            continue
 
         context.s3_repodata_items.append(item)
 
@@ -374,16 +785,206 @@ def list_metadata(context):
 def list_rpms(context):
     """
     List the current rpm items in s3, storing in s3_rpm_items.
+
+    If a fresh package manifest is available, it is used instead of walking
+    the bucket listing. Otherwise the listing is sharded into key ranges
+    (see list_boundaries) which are listed concurrently.
     """
-    key_list = context.s3_bucket.list(prefix=context.opts.path)
+    context.s3_manifest = None
+    manifest = None
+    if not context.opts.no_manifest:
+        manifest = read_manifest(context)
+        if manifest is not None and manifest_is_fresh(context, manifest):
+            verbose("Using package manifest: %s",
+                    s3join(context.opts.path, MANIFEST))
+            context.s3_manifest = manifest
+            context.s3_rpm_items = manifest_items(context, manifest)
+            return
+        elif manifest is not None:
+            verbose("Package manifest is stale, listing bucket")
+
+    inbox_prefix = s3join(context.opts.path, INBOX, '')
+    shards = list_shard_count(context, manifest)
+    if shards > 1:
+        boundaries = list_boundaries(context, shards, manifest)
+        verbose("Listing %s in %i shards", context.opts.path,
+                len(boundaries) + 1)
+        key_list = list_keys_sharded(
+            context.s3_bucket,
+            context.opts.path,
+            boundaries,
+            context.opts.workers)
+    else:
+        key_list = context.s3_bucket.list(prefix=context.opts.path)
     context.s3_rpm_items = []
     for item in key_list:
         if not item.name.endswith('.rpm'):
             continue
+        if item.name.startswith(inbox_prefix):
+            continue
         context.s3_rpm_items.append(item)
     return
 
 
+def list_shard_count(context, manifest=None):
+    """
+    How many key ranges to list the rpm's in: --list-shards if given.
+    Otherwise each range costs at least one LIST request, so only repos
+    known (from a stale manifest) to be large are sharded.
+    """
+    if context.opts.list_shards is not None:
+        return context.opts.list_shards
+    if manifest is None:
+        return 1
+    return max(1, min(LIST_SHARDS_MAX,
+                      len(manifest.get('packages', [])) // LIST_SHARD_KEYS))
+
+
+def list_boundaries(context, shards, manifest=None):
+    """
+    Choose the key names at which to shard the rpm listing into 'shards'
+    ranges. A stale manifest is still a good sample of the key distribution,
+    so its names are used if available; otherwise we split on the first
+    character of the rpm name.
+    """
+    if manifest is not None and manifest.get('packages'):
+        return quantile_boundaries(
+            [entry['name'] for entry in manifest['packages']], shards)
+    return charset_boundaries(
+        s3join(context.opts.path, ''), RPM_NAME_CHARS, shards)
+
+
+#----------------------------------------------
+#                 S3: Manifest
+#----------------------------------------------
+def manifest_entry_from_item(item, sha256=None):
+    """
+    Build a manifest entry for the s3 item given by 'item'.
+    """
+    return {
+        'name': item.name,
+        'size': item.size,
+        'etag': get_s3item_md5(item),
+        'last_modified': item.last_modified,
+        'sha256': sha256,
+    }
+
+
+def manifest_entry_from_file(filepath, dest_path):
+    """
+    Build a manifest entry for the local file at 'filepath', which has just
+    been uploaded to 'dest_path'.
+    """
+    return {
+        'name': dest_path,
+        'size': os.path.getsize(filepath),
+        'etag': get_file_md5(filepath),
+        'last_modified': datetime_as_s3time(datetime.datetime.utcnow()),
+        'sha256': get_file_sha256(filepath),
+    }
+
+
+def read_manifest(context):
+    """
+    Fetch and parse the package manifest for the repo. Returns None if the
+    manifest does not exist or cannot be read.
+    """
+    import boto.exception
+
+    manifest_path = s3join(context.opts.path, MANIFEST)
+    try:
+        manifest_key = context.s3_bucket.get_key(manifest_path)
+        if manifest_key is None:
+            return None
+        manifest = gzip_to_json(manifest_key.get_contents_as_string())
+    except boto.exception.S3ResponseError as ex:
+        verbose("Unable to read manifest %s: %s", manifest_path, ex.reason)
+        return None
+    except ValueError as ex:
+        verbose("Ignoring corrupt manifest %s: %s", manifest_path, ex)
+        return None
+
+    if not isinstance(manifest, dict) or \
+            manifest.get('version') != MANIFEST_VERSION:
+        verbose("Ignoring manifest %s: unknown version", manifest_path)
+        return None
+    return manifest
+
+
+def manifest_is_fresh(context, manifest):
+    """
+    A manifest is fresh if it was written for the repomd.xml which is
+    currently published. Any publish by a tool which doesn't maintain the
+    manifest changes repomd.xml, making the manifest stale.
+    """
+    repomd_path = s3join(context.s3_repodata_path, REPOMD)
+    for item in context.s3_repodata_items:
+        if item.name == repomd_path:
+            return get_s3item_md5(item) == manifest.get('repomd_etag')
+    return False
+
+
+def manifest_items(context, manifest):
+    """
+    Convert the entries of 'manifest' into s3 key objects, equivalent to the
+    ones returned by a bucket listing.
+    """
+    import boto.s3.key
+
+    items = []
+    for entry in manifest['packages']:
+        item = boto.s3.key.Key(context.s3_bucket, entry['name'])
+        item.size = entry['size']
+        item.etag = '"%s"' % entry['etag']
+        item.last_modified = entry['last_modified']
+        items.append(item)
+    return items
+
+
+def write_manifest(context, uploaded, removed):
+    """
+    Write the package manifest for the repo as published: the listed rpm
+    items, minus the 'removed' items, plus the 'uploaded' files (a list of
+    (filepath, dest_path) tuples).
+    """
+    import boto.s3.key
+
+    old_checksums = {}
+    if context.s3_manifest is not None:
+        for entry in context.s3_manifest['packages']:
+            old_checksums[entry['name']] = entry.get('sha256')
+
+    removed_names = set(item.name for item in removed)
+    packages = {}
+    for item in context.s3_rpm_items:
+        if item.name not in removed_names:
+            packages[item.name] = manifest_entry_from_item(
+                item, old_checksums.get(item.name))
+
+    for filepath, dest_path in uploaded:
+        if dest_path.endswith('.rpm'):
+            packages[dest_path] = manifest_entry_from_file(
+                filepath, dest_path)
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'repomd_etag': get_file_md5(
+            os.path.join(context.working_dir_repodata, REPOMD)),
+        'packages': [packages[name] for name in sorted(packages)],
+    }
+
+    manifest_path = s3join(context.opts.path, MANIFEST)
+    verbose("Writing package manifest: %s (%i packages)",
+            manifest_path, len(packages))
+    if not context.opts.dry_run:
+        manifest_key = boto.s3.key.Key(context.s3_bucket)
+        manifest_key.key = manifest_path
+        manifest_key.set_contents_from_string(
+            json_to_gzip(manifest),
+            headers={'Content-Type': 'application/x-gzip'})
+    return manifest
+
+
 #----------------------------------------------
 #                 S3: Download
 #----------------------------------------------
@@ -405,49 +1006,81 @@ def should_download(item, filepath, force_download):
     return files_differ and remote_mtime >= local_mtime
 
 
-def download_items(context, items, dest_dir, force_download=False):
+def download_item(context, item, dest_dir, force_download, progress):
     """
-    Download the s3 items given by 'items' into the destination directory
-    given by 'dest_dir'. If force_download is true, download *everything* in
-    the list. Otherwise, skip downloads for items which are already present
-    in the working directory.
+    Download the s3 item 'item' into 'dest_dir', unless an identical copy is
+    already there (see should_download). If 'progress' (a
+    ProgressAggregator) is given, the download is counted in it.
     """
-    try:
-        no_items = 0
-        for item in items:
-            # Skip folder keys:
-            if item.name.find(FOLDER_SUFFIX) != -1:
-                verbose("Not downloading: %s", item.name)
-                continue
+    filename = os.path.basename(item.name)
+    filepath = os.path.join(dest_dir, filename)
 
-            filename = os.path.basename(item.name)
-            filepath = os.path.join(dest_dir, filename)
-
-            if should_download(item, filepath, force_download):
-                f = open(filepath, 'w')
-
-                item.get_file(f, cb=get_progress_fn(
-                    context.opts.verbose, "Downloading %s" % item.name))
-
-                f.close()
-
-                # Verify the checksum of the downloaded item:
-                if not md5_matches(filepath, get_s3item_md5(item)):
-                    raise ServiceError(
-                        "\nDownload failed: md5 mismatch for %s" % (filename))
-            else:
-                verbose('File "%s" already exists in "%s" skipping download',
-                        filename, dest_dir)
-            no_items += 1
+    if not should_download(item, filepath, force_download):
+        if progress is not None:
+            progress.skip(int(item.size))
+        else:
+            verbose('File "%s" already exists in "%s" skipping download',
+                    filename, dest_dir)
+        return
 
-        return no_items
+    try:
+        f = open(filepath, 'w')
+        if progress is not None:
+            from s3yum.progress import PROGRESS_CALLBACKS
+            item.get_file(f, cb=progress.callback(item.name),
+                          num_cb=PROGRESS_CALLBACKS)
+            progress.finish(item.name, int(item.size))
+        else:
+            verbose("Downloading %s", item.name)
+            item.get_file(f)
+        f.close()
     except IOError as ex:
         err_msg = "Error opening %s: %s (%i)" % (
             ex.filename, ex.strerror, ex.errno)
         raise ServiceError(err_msg)
+
+    # Verify the checksum of the downloaded item:
+    if not md5_matches(filepath, get_s3item_md5(item)):
+        raise ServiceError(
+            "\nDownload failed: md5 mismatch for %s" % (filename))
     return
 
 
+def download_items(context, items, dest_dir, force_download=False):
+    """
+    Download the s3 items given by 'items' into the destination directory
+    given by 'dest_dir'. If force_download is true, download *everything* in
+    the list. Otherwise, skip downloads for items which are already present
+    in the working directory.
+
+    Items are downloaded concurrently by the --engine, with -v reporting
+    their aggregated progress (see s3yum.progress).
+    """
+    wanted = []
+    for item in items:
+        # Skip folder keys:
+        if item.name.find(FOLDER_SUFFIX) != -1:
+            verbose("Not downloading: %s", item.name)
+            continue
+        wanted.append(item)
+
+    # Hash any local copies in bulk, for should_download:
+    if not force_download:
+        hash_files([os.path.join(dest_dir, os.path.basename(item.name))
+                    for item in wanted])
+
+    from s3yum.progress import start_progress
+    progress = start_progress(
+        context, "Downloading", [int(item.size) for item in wanted])
+    try:
+        transfer_map(context, lambda item: download_item(
+            context, item, dest_dir, force_download, progress), wanted)
+    finally:
+        if progress is not None:
+            progress.close()
+    return len(wanted)
+
+
 def get_repo(context, dest_dir):
     """
     Download the entire repo to 'dest_dir' on the local disk.
@@ -470,9 +1103,130 @@ def get_repo(context, dest_dir):
     return
 
 
+def get_filtered(context, dest_dir):
+    """
+    Download the rpm's selected by --include/--exclude/--arch/--query (and
+    their dependencies, with --resolve-deps) to 'dest_dir', along with
+    repodata for just those packages, filtered from the published repodata.
+    """
+    from s3yum.query import (
+        select_packages,
+        excluded_packages,
+        resolve_deps
+    )
+
+    opts = context.opts
+    repodata_dir = os.path.join(dest_dir, REPODATA)
+    old_repodata = tempfile.mkdtemp(prefix='s3yum-repodata-')
+    try:
+        entries = download_published_repodata(
+            context, old_repodata, derived=False)
+        packages = parse_primary(os.path.join(
+            old_repodata, os.path.basename(data_location(entries['primary']))),
+            deps=opts.resolve_deps)
+
+        selected, unmatched = select_packages(
+            packages, opts.include, opts.exclude, opts.arch, opts.query)
+        for pattern in unmatched:
+            print "Warning: '%s' matches no packages" % pattern
+        if opts.resolve_deps:
+            excluded = set(package['pkgid'] for package in
+                           excluded_packages(packages, opts.exclude))
+            selected, unresolved = resolve_deps(
+                [p for p in packages if p['pkgid'] not in excluded], selected)
+            for requirement in unresolved:
+                verbose("Not provided by this repo: %s", requirement)
+
+        items_by_name = dict(
+            (item.name, item) for item in context.s3_rpm_items)
+        items = []
+        for package in selected:
+            item = items_by_name.get(
+                s3join(opts.path, package['location']))
+            if item is None:
+                raise ServiceError("Package is missing from the bucket: %s" % (
+                    package['location']))
+            items.append(item)
+        verbose("Selected %i of %i packages", len(selected), len(packages))
+
+        # The repodata is regenerated, so don't leave old files behind:
+        shutil.rmtree(repodata_dir, True)
+        filter_repodata(old_repodata, repodata_dir,
+                        set(package['pkgid'] for package in selected))
+    finally:
+        shutil.rmtree(old_repodata, True)
+
+    download_items(context, items, dest_dir, opts.force_download)
+    return
+
+
+def package_filters(context):
+    """
+    Whether any of get's package selection options were given.
+    """
+    opts = context.opts
+    return bool(opts.include or opts.exclude or opts.arch or opts.query or
+                opts.resolve_deps)
+
+
+def repo_entries(context):
+    """
+    Return (relative path, item) for every item get_repo would download, in
+    the same layout.
+    """
+    entries = []
+    for item in context.s3_repodata_items:
+        if item.name.find(FOLDER_SUFFIX) == -1:
+            entries.append(
+                (s3join(REPODATA, os.path.basename(item.name)), item))
+    for item in context.s3_rpm_items:
+        entries.append((os.path.basename(item.name), item))
+    return entries
+
+
 #----------------------------------------------
 #                 S3: Upload
 #----------------------------------------------
+def get_upload_headers(context, filename, filepath=None):
+    """
+    Return the HTTP headers to upload the file named 'filename' with. If the
+    local 'filepath' of an rpm is given, its sha256 is stored in the object's
+    metadata, for the verify action.
+
+    Rpm's and checksum-named metadata files never change once written, so
+    caches in front of the bucket may keep them forever. Anything which is
+    overwritten in place (notably repomd.xml) gets a short max-age, so that
+    a publish becomes visible quickly.
+
+    Compressed metadata is not given a Content-Encoding: yum expects the
+    compressed bytes, not a transparently decoded body.
+    """
+    headers = {}
+    if filepath is not None and filename.endswith('.rpm'):
+        headers[SHA256_HEADER] = get_file_sha256(filepath)
+    if context.opts.no_cache_headers:
+        return headers
+
+    extension = os.path.splitext(filename)[1]
+    headers['Content-Type'] = CONTENT_TYPES.get(
+        extension, 'application/octet-stream')
+    if is_immutable(filename):
+        headers['Cache-Control'] = 'public, max-age=%i, immutable' % (
+            context.opts.max_age)
+    else:
+        headers['Cache-Control'] = 'public, max-age=%i, must-revalidate' % (
+            context.opts.repomd_max_age)
+    return headers
+
+
+def is_immutable(filename):
+    """
+    Return true if the repo file named 'filename' is never overwritten.
+    """
+    return os.path.splitext(filename)[1] in ('.rpm', '.drpm') or \
+        bool(CHECKSUM_NAME_RE.match(filename))
+
+
 def should_upload(filepath, item, force_upload):
     """
     Return true if the file at filepath should be uploaded, false otherwise.
@@ -491,19 +1245,35 @@ def should_upload(filepath, item, force_upload):
     return files_differ and local_mtime >= remote_mtime
 
 
-def upload_directory(context, dir_path, upload_prefix, check_items=[]):
+def upload_directory(context, dir_path, upload_prefix, check_items=[],
+                     filenames=None):
     """
     Upload all the files in the directory 'dir_path' into the s3 bucket.
     The variable 'upload_prefix' is the path relative to the s3 bucket.
     The list item 'check_items' is a list of existing s3 items at this path.
     If an item to be uploaded is found in check_items, it is skipped.
+    If 'filenames' is given, only those files are uploaded, in that order.
+
+    Files are uploaded concurrently by the --engine. Returns a list of
+    (filepath, dest_path) tuples for the uploaded files.
     """
+    uploaded = []
 
     items_by_name = dict(zip(map(
         lambda x: os.path.basename(x.name), check_items), check_items))
 
+    if filenames is None:
+        filenames = os.listdir(dir_path)
+
+    # Hash in bulk the files should_upload compares, and the rpm's whose
+    # sha256 goes in their headers:
+    hash_files([os.path.join(dir_path, filename) for filename in filenames
+                if filename.endswith('.rpm') or (
+                    filename in items_by_name and
+                    not context.opts.force_upload)])
+
     # Upload RPM's:
-    for filename in os.listdir(dir_path):
+    for filename in filenames:
         filepath = os.path.join(dir_path, filename)
         remote_item = items_by_name.get(filename, None)
 
@@ -518,48 +1288,301 @@ def upload_directory(context, dir_path, upload_prefix, check_items=[]):
                 filename, upload_prefix)
             continue
 
-        # Perform the upload:
-        dest_path = s3join(upload_prefix, filename)
-        item_key = boto.s3.key.Key(context.s3_bucket)
-        item_key.key = dest_path
-        if not context.opts.dry_run:
-            item_key.set_contents_from_filename(
-                filepath, cb=get_progress_fn(
-                    context.opts.verbose, "Uploading: %s" % dest_path))
-        else:
-            verbose("Uploading: %s" % dest_path)
+        uploaded.append((filepath, s3join(upload_prefix, filename)))
+
+    from s3yum.progress import start_progress
+    progress = start_progress(context, "Uploading", [
+        os.path.getsize(upload[0]) for upload in uploaded])
+    try:
+        transfer_map(context, lambda upload: upload_file(
+            context, upload[0], upload[1], progress), uploaded)
+    finally:
+        if progress is not None:
+            progress.close()
+    return uploaded
+
+
+def upload_file(context, filepath, dest_path, progress=None):
+    """
+    Upload the file 'filepath' to 'dest_path' in the bucket. If 'progress'
+    (a ProgressAggregator) is given, the upload is counted in it.
+    """
+    import boto.s3.key
+
+    item_key = boto.s3.key.Key(context.s3_bucket)
+    item_key.key = dest_path
+    if context.opts.dry_run:
+        verbose("Uploading: %s" % dest_path)
+    elif progress is not None:
+        from s3yum.progress import PROGRESS_CALLBACKS
+        item_key.set_contents_from_filename(
+            filepath,
+            headers=get_upload_headers(
+                context, os.path.basename(filepath), filepath),
+            cb=progress.callback(dest_path), num_cb=PROGRESS_CALLBACKS)
+        progress.finish(dest_path, os.path.getsize(filepath))
+    else:
+        verbose("Uploading: %s" % dest_path)
+        item_key.set_contents_from_filename(
+            filepath,
+            headers=get_upload_headers(
+                context, os.path.basename(filepath), filepath))
     return
 
 
-def upload_repodata(context):
+def read_published_repomd(context):
+    """
+    Return the (item, contents) of the currently published repomd.xml, or
+    (None, None) if the repo has no metadata yet.
+    """
+    repomd_path = s3join(context.s3_repodata_path, REPOMD)
+    for item in context.s3_repodata_items:
+        if item.name == repomd_path:
+            return item, item.get_contents_as_string()
+    return None, None
+
+
+def collect_stale_metadata(context, published_names, repomd_item, repomd_xml):
+    """
+    Return the metadata files which are no longer referenced by the newly
+    published repomd.xml, and have been unreferenced for at least the
+    --metadata-grace period, for deletion. Clients which fetched the previous repomd.xml
+    just before the swap still need the files it references, so those are
+    kept until a later publish.
+
+    Files which the previous repomd.xml didn't reference have been stale
+    since it was published (its last-modified time).
+    """
+    previous_refs = set()
+    stale_since = None
+    if repomd_item is not None:
+        previous_refs = set(
+            s3join(context.opts.path, href)
+            for href in repomd_locations(repomd_xml))
+        stale_since = s3time_as_datetime(repomd_item.last_modified)
+
+    grace = datetime.timedelta(seconds=context.opts.metadata_grace)
+    now = datetime.datetime.utcnow()
+    stale = []
+    for item in context.s3_repodata_items:
+        if item.name in published_names:
+            continue
+        if item.name in previous_refs or \
+                (stale_since is not None and now - stale_since < grace):
+            verbose("Keeping stale metadata file until grace period ends: %s",
+                    item.name)
+            continue
+        stale.append(item)
+    return stale
+
+
+def delete_items(context, items):
+    """
+    Delete the s3 items 'items', up to 1000 per (multi-object delete)
+    request.
+    """
+    for start in range(0, len(items), DELETE_BATCH_SIZE):
+        batch = items[start:start + DELETE_BATCH_SIZE]
+        for item in batch:
+            verbose("Deleting: %s", item.name)
+        if context.opts.dry_run:
+            continue
+
+        result = context.s3_bucket.delete_keys(
+            [item.name for item in batch], quiet=True)
+        if result.errors:
+            error = result.errors[0]
+            raise ServiceError("Unable to delete %s: %s (%i errors)" % (
+                error.key, error.message, len(result.errors)))
+    return
+
+
+def upload_repodata(context, removed=None):
     """
     Upload repodata to the specified bucket.
+
+    The publish is ordered so that clients never see a repomd.xml which
+    references missing files:
+     1. Upload new rpm's
+     2. Upload the new (checksum-named) metadata files
+     3. Swap repomd.xml with a single PUT
+     4. Delete any --remove'd rpm's and garbage collect stale metadata
+
+    If 'removed' is given, those rpm items are deleted instead of the ones
+    matching --remove, and no rpm's are uploaded.
     """
+    if removed is None:
+        uploaded = upload_directory(
+            context,
+            context.working_dir,
+            context.opts.path,
+            context.s3_rpm_items)
+    else:
+        uploaded = []
+
+    repomd_item, repomd_xml = read_published_repomd(context)
+
+    # Upload new metadata, ALWAYS - we never use check_items here. Only the
+    # files the new repomd.xml references are published (the working
+    # directory may hold old ones, see prepare_repodata).
+    # repomd.xml goes last, since it makes the new metadata visible:
+    repo_dest = s3join(context.opts.path, REPODATA)
+    with open(os.path.join(context.working_dir_repodata, REPOMD)) as repomd:
+        metadata_files = sorted(set(
+            os.path.basename(href) for href in repomd_locations(repomd.read())))
+    upload_directory(
+        context,
+        context.working_dir_repodata,
+        repo_dest,
+        filenames=metadata_files)
+    if context.s3_lease is not None:
+        context.s3_lease.check()
     upload_directory(
         context,
-        context.working_dir,
-        context.opts.path,
-        context.s3_rpm_items)
+        context.working_dir_repodata,
+        repo_dest,
+        filenames=[REPOMD])
+
+    # Delete any --remove'd RPM's, and stale metadata:
+    if removed is None:
+        removed = match_removes(context)
+
+    published_names = set(
+        s3join(repo_dest, filename) for filename in metadata_files + [REPOMD])
+    delete_items(context, removed + collect_stale_metadata(
+        context, published_names, repomd_item, repomd_xml))
+    if context.opts.snapshots > 0:
+        from s3yum.snapshots import take_snapshot
+        take_snapshot(context, metadata_files)
+
+    # Record what we just published, for the next invocation's listing:
+    write_manifest(context, uploaded, removed)
+    return
 
-    # ALWAYS delete the existing s3 metadata items and upload the new ones.
-    # We NEVER use check_items here:
-    # Delete old metadata:
-    for item in context.s3_repodata_items:
-        verbose("Deleting old metadata file: %s", item.name)
-        if not context.opts.dry_run:
+
+#----------------------------------------------
+#                S3: Locking
+#----------------------------------------------
+def inbox_path(context, *args):
+    """
+    Path of the piggyback inbox, or of an item within it.
+    """
+    return s3join(context.opts.path, INBOX, *args)
+
+
+def stage_to_inbox(context, owner):
+    """
+    Upload our rpm's and --remove globs to the piggyback inbox, for the lock
+    holder to publish. Returns the staged key names.
+    """
+    import boto.s3.key
+
+    staged = []
+    for rpm_path in context.rpm_args:
+        dest_path = inbox_path(context, owner, os.path.basename(rpm_path))
+        verbose("Staging %s to %s", rpm_path, dest_path)
+        staged_key = boto.s3.key.Key(context.s3_bucket, dest_path)
+        staged_key.set_contents_from_filename(rpm_path)
+        staged.append(dest_path)
+
+    if context.opts.remove:
+        dest_path = inbox_path(context, owner, INBOX_REMOVES)
+        staged_key = boto.s3.key.Key(context.s3_bucket, dest_path)
+        staged_key.set_contents_from_string(json.dumps(context.opts.remove))
+        staged.append(dest_path)
+    return staged
+
+
+def drain_inbox(context):
+    """
+    Publish everything staged in the piggyback inbox. Called with the lock
+    held; repeats until the inbox is empty, since other runs may stage more
+    while we publish.
+    """
+    while True:
+        staged = list(context.s3_bucket.list(prefix=inbox_path(context, '')))
+        if not staged:
+            return
+
+        verbose("Publishing %i piggybacked items", len(staged))
+        inbox_dir = tempfile.mkdtemp(prefix='s3yum-inbox-')
+        try:
+            rpm_args = []
+            removes = []
+            for item in staged:
+                if item.name.endswith(INBOX_REMOVES):
+                    removes.extend(json.loads(item.get_contents_as_string()))
+                elif item.name.endswith('.rpm'):
+                    owner_dir = os.path.join(
+                        inbox_dir, os.path.basename(os.path.dirname(item.name)))
+                    if not os.path.exists(owner_dir):
+                        os.makedirs(owner_dir)
+                    rpm_path = os.path.join(
+                        owner_dir, os.path.basename(item.name))
+                    item.get_contents_to_filename(rpm_path)
+                    rpm_args.append(rpm_path)
+
+            context.rpm_args = rpm_args
+            context.opts.remove = removes
+            if context.working_dir is None:
+                init_workingdir(context)
+            list_metadata(context)
+            list_rpms(context)
+            update_repo(context)
+        finally:
+            shutil.rmtree(inbox_dir, True)
+
+        # Only now that they're published may the stagers stop waiting:
+        for item in staged:
             item.delete()
 
-    # Delete any --remove'd RPM's:
-    for item in context.s3_rpm_items:
-        for remove_rpm in context.opts.remove:
-            if fnmatch.fnmatch(item.name, remove_rpm):
-                verbose("Deleting: %s", item.name)
-                if not context.opts.dry_run:
-                    item.delete()
 
-    # Upload new metadata:
-    repo_dest = s3join(context.opts.path, REPODATA)
-    upload_directory(context, context.working_dir_repodata, repo_dest)
+def with_publish_lock(context, publish_fn):
+    """
+    Call publish_fn(context) while holding the repo's lock, then publish
+    anything piggybacked on us.
+
+    With --piggyback, if the lock is held we stage our rpm's in the inbox and
+    wait for them to disappear: the holder publishes and removes them. If
+    the lock is released first (the holder exited before it saw them), we
+    take the lock and publish the inbox ourselves.
+    """
+    from s3yum.lock import S3Lease
+    lease = S3Lease(
+        context.s3_bucket,
+        s3join(context.opts.path, LOCK),
+        context.opts.lock_ttl)
+
+    staged = None
+    deadline = time.time() + context.opts.lock_timeout
+    while not lease.try_acquire():
+        if context.opts.piggyback and staged is None:
+            holder = lease.holder()
+            verbose("Lock held by %s; piggybacking on its publish",
+                    holder[0].get('owner') if holder else 'unknown')
+            staged = stage_to_inbox(context, lease.owner)
+
+        if staged is not None:
+            pending = context.s3_bucket.list(
+                prefix=inbox_path(context, lease.owner, ''))
+            if not list(pending):
+                verbose("Published by the lock holder")
+                return
+
+        if time.time() >= deadline:
+            raise ServiceError("Timed out waiting for lock %s" % lease.name)
+        time.sleep(LOCK_POLL_INTERVAL)
+
+    verbose("Acquired lock %s", lease.name)
+    lease.start_heartbeat()
+    context.s3_lease = lease
+    try:
+        if staged is None:
+            publish_fn(context)
+        drain_inbox(context)
+    finally:
+        lease.release()
+        context.s3_lease = None
     return
 
 
@@ -570,25 +1593,164 @@ def delete_repo(context):
     """
     Delete the repo metadata and all rpm's.
     """
+    from s3yum.deltas import DRPMS
+
     delete_ok = confirm_delete(context)
     if not delete_ok:
         print "Delete aborted!"
         return False
 
-    # Delete old metadata:
-    for item in context.s3_repodata_items:
-        verbose("Deleting old metadata file: %s", item.name)
-        if not context.opts.dry_run:
-            item.delete()
-
-    # Delete any --remove'd RPM's:
-    for item in context.s3_rpm_items:
-        verbose("Deleting: %s", item.name)
-        if not context.opts.dry_run:
-            item.delete()
+    # Delete old metadata and snapshots, then the RPM's and any delta rpm's:
+    snapshot_items = list(context.s3_bucket.list(
+        prefix=s3join(context.s3_repodata_path, SNAPSHOTS, '')))
+    drpm_items = list(context.s3_bucket.list(
+        prefix=s3join(context.opts.path, DRPMS, '')))
+    delete_items(context, context.s3_repodata_items + snapshot_items +
+                 context.s3_rpm_items + drpm_items)
+
+    # Delete the package manifest:
+    manifest_path = s3join(context.opts.path, MANIFEST)
+    verbose("Deleting package manifest: %s", manifest_path)
+    if not context.opts.dry_run:
+        context.s3_bucket.delete_key(manifest_path)
     return True
 
 
+#----------------------------------------------
+#                 S3: Prune
+#----------------------------------------------
+def select_prune(packages, keep, older_than, now, added):
+    """
+    Return the packages (from parse_primary) to prune. For each package
+    name/arch, the newest version is always kept, as are the newest 'keep'
+    versions and any added less than 'older_than' days before 'now' (epoch
+    seconds). Either criterion may be None.
+
+    'added' maps package locations to the times (epoch seconds) their rpm's
+    were uploaded; a package missing from it is taken to be old.
+    """
+    by_name = {}
+    for package in packages:
+        by_name.setdefault(
+            (package['name'], package['arch']), []).append(package)
+
+    pruned = []
+    for versions in by_name.values():
+        versions.sort(
+            cmp=lambda a, b: compare_evr(package_evr(a), package_evr(b)),
+            reverse=True)
+        for index, package in enumerate(versions):
+            if index == 0:
+                continue
+            if keep is not None and index < keep:
+                continue
+            if older_than is not None and \
+                    now - added.get(package['location'], 0) < \
+                    older_than * 86400:
+                continue
+            pruned.append(package)
+    return sorted(pruned, key=lambda package: package['location'])
+
+
+def download_published_repodata(context, dest_dir, data_types=None,
+                                derived=True):
+    """
+    Download the published repomd.xml, and the metadata files it references
+    (only those of 'data_types', if given, and without the sqlite/zchunk
+    copies unless 'derived' is set), to 'dest_dir'. Returns the repomd.xml
+    data elements, by type.
+    """
+    repomd_item, repomd_xml = read_published_repomd(context)
+    if repomd_item is None:
+        raise ServiceError("No repodata found at %s" % (
+            s3join(context.opts.bucket, context.s3_repodata_path)))
+
+    with open(os.path.join(dest_dir, REPOMD), 'w') as repomd_file:
+        repomd_file.write(repomd_xml)
+    _, entries = repomd_data(dest_dir)
+    items_by_name = dict(
+        (item.name, item) for item in context.s3_repodata_items)
+    referenced = []
+    for data_type, data in sorted(entries.items()):
+        if data_types is not None and data_type not in data_types:
+            continue
+        if not derived and is_derived_data(data_type):
+            continue
+        href = data_location(data)
+        item = items_by_name.get(s3join(
+            context.s3_repodata_path, os.path.basename(href)))
+        if item is None:
+            raise ServiceError("Published metadata file is missing: %s" % (
+                href))
+        referenced.append(item)
+    download_items(context, referenced, dest_dir, True)
+    return entries
+
+
+def prune_repo(context):
+    """
+    Prune old package versions: the metadata is rewritten from the published
+    repodata, without downloading any rpm's, and the pruned rpm's are then
+    bulk-deleted.
+    """
+    init_workingdir(context)
+    old_repodata = tempfile.mkdtemp(prefix='s3yum-repodata-')
+    try:
+        entries = download_published_repodata(context, old_repodata)
+        packages = parse_primary(os.path.join(
+            old_repodata, os.path.basename(data_location(entries['primary']))))
+
+        # primary.xml's file times are the rpm mtimes at the last
+        # regeneration, so the upload times are taken from the listing:
+        items_by_name = dict(
+            (item.name, item) for item in context.s3_rpm_items)
+        added = {}
+        for package in packages:
+            item = items_by_name.get(
+                s3join(context.opts.path, package['location']))
+            if item is not None:
+                added[package['location']] = calendar.timegm(
+                    s3time_as_datetime(item.last_modified).utctimetuple())
+
+        pruned = select_prune(packages, context.opts.keep,
+                              context.opts.older_than, time.time(), added)
+        print "Pruning %i of %i packages from %s" % (
+            len(pruned), len(packages),
+            s3join(context.opts.bucket, context.opts.path))
+        if not pruned:
+            return
+
+        removed = []
+        for package in pruned:
+            item = items_by_name.get(
+                s3join(context.opts.path, package['location']))
+            if item is not None:
+                removed.append(item)
+
+            # Don't leave pruned rpm's in a persistent working dir:
+            local_copy = os.path.join(
+                context.working_dir, os.path.basename(package['location']))
+            if os.path.exists(local_copy):
+                verbose("Removing local copy: %s", local_copy)
+                if not context.opts.dry_run:
+                    os.remove(local_copy)
+
+        pruned_ids = set(package['pkgid'] for package in pruned)
+        keep_ids = set(package['pkgid'] for package in packages
+                       if package['pkgid'] not in pruned_ids)
+        remove_repodata(context)
+        filter_repodata(old_repodata, context.working_dir_repodata, keep_ids)
+        compress_repodata(context)
+        if context.opts.sqlite:
+            from s3yum.sqlitedb import stash_databases, make_databases
+            stash_databases(context, old_repodata)
+            make_databases(context)
+        upload_repodata(context, removed=removed)
+    finally:
+        shutil.rmtree(old_repodata, True)
+    return
+
+
 #----------------------------------------------
 #                    yum:
 #----------------------------------------------
@@ -596,22 +1758,233 @@ def create_repodata(context):
     """
     Invoke 'createrepo' to create the repodata folder to upload.
     """
+    verbose("Generating yum repo metadata")
+    prepare_repodata(context)
+    mirrored = pull_cachedir(context)
+    output = run_createrepo(createrepo_args(context))
+    if output:
+        verbose(output)
+    push_cachedir(context, mirrored)
+    compress_repodata(context)
+    if context.opts.sqlite:
+        from s3yum.sqlitedb import make_databases
+        make_databases(context)
+    if context.opts.deltas:
+        from s3yum.deltas import make_deltas
+        make_deltas(context)
+    return
+
+
+def prepare_repodata(context):
+    """
+    Ready the working directory for createrepo. The previous repodata is
+    kept for 'createrepo --update' to reuse (and its sqlite databases
+    stashed, with --sqlite), unless --no-createrepo-update was given.
+    """
+    if context.opts.no_createrepo_update:
+        remove_repodata(context)
+    else:
+        restore_rpm_mtimes(context)
+        if context.opts.sqlite:
+            from s3yum.sqlitedb import stash_databases
+            stash_databases(context)
+    return
+
+
+def remove_repodata(context):
+    """
+    Remove any old repodata from the working directory.
+    """
+    if os.path.exists(context.working_dir_repodata):
+        verbose(
+            'Removing old repodata: "%s"',
+            context.working_dir_repodata)
+        shutil.rmtree(context.working_dir_repodata)
+    return
+
+
+def restore_rpm_mtimes(context):
+    """
+    createrepo --update only reuses the metadata of an rpm whose size and
+    mtime match the old repodata, and downloaded rpm's have new mtimes. Set
+    them back to the mtimes the old primary.xml records, but only for rpm's
+    whose sha256 is the one recorded: a replacement of the same name and
+    size (e.g. a re-signed rpm) must look changed to createrepo.
+    """
+    if not os.path.exists(os.path.join(context.working_dir_repodata, REPOMD)):
+        return
     try:
-        verbose("Generating yum repo metadata")
-        if os.path.exists(context.working_dir_repodata):
-            verbose(
-                'Removing old repodata: "%s"',
-                context.working_dir_repodata)
-            shutil.rmtree(context.working_dir_repodata)
+        _, entries = repomd_data(context.working_dir_repodata)
+        packages = parse_primary(os.path.join(
+            context.working_dir_repodata,
+            os.path.basename(data_location(entries['primary']))))
+    except (EnvironmentError, ValueError, SyntaxError, KeyError) as ex:
+        verbose("Unable to read the old repodata (%s); regenerating it", ex)
+        remove_repodata(context)
+        return
+
+    candidates = []
+    for package in packages:
+        filepath = os.path.join(
+            context.working_dir, os.path.basename(package['location']))
+        if package['checksum_type'] == 'sha256' and \
+                os.path.exists(filepath) and \
+                os.path.getsize(filepath) == package['size']:
+            candidates.append((filepath, package))
+    hash_files([candidate[0] for candidate in candidates])
+
+    restored = 0
+    for filepath, package in candidates:
+        if get_file_sha256(filepath) == package['pkgid']:
+            set_file_mtime(filepath, package['time'])
+            restored += 1
+    verbose("Reusing old repodata for up to %i rpm's", restored)
+    return
+
+
+def createrepo_cachedir(context):
+    """
+    The createrepo checksum cache directory, created if needed, or None.
+    """
+    if context.opts.no_cachedir or not context.opts.cachedir:
+        return None
+    cachedir = os.path.expanduser(context.opts.cachedir)
+    if not os.path.exists(cachedir):
+        try:
+            os.makedirs(cachedir)
+        except OSError as ex:
+            raise ServiceError('Unable to create "%s": %s' % (
+                cachedir, ex.strerror))
+    return cachedir
+
+
+def pull_cachedir(context):
+    """
+    Download the --cachedir-mirror into the cachedir. Returns the mirror's
+    items, for push_cachedir.
+    """
+    cachedir = createrepo_cachedir(context)
+    if cachedir is None or not context.opts.cachedir_mirror:
+        return []
+    mirror_path = s3join(context.opts.cachedir_mirror, '')
+    items = list(context.s3_bucket.list(prefix=mirror_path))
+    verbose("Syncing %i cache files from %s", len(items), mirror_path)
+    download_items(context, items, cachedir)
+    return items
+
+
+def push_cachedir(context, mirrored):
+    """
+    Upload the cache files createrepo added to the --cachedir-mirror.
+    """
+    cachedir = createrepo_cachedir(context)
+    if cachedir is None or not context.opts.cachedir_mirror:
+        return
+    uploaded = upload_directory(
+        context, cachedir, context.opts.cachedir_mirror, mirrored)
+    verbose("Synced %i new cache files to %s", len(uploaded),
+            context.opts.cachedir_mirror)
+    return
+
+
+def createrepo_args(context):
+    """
+    The 'createrepo' command line for the context's working directory.
+    """
+    import multiprocessing
+
+    args = [CREATEREPO]
+    args.extend(['--workers', str(
+        context.opts.createrepo_workers or multiprocessing.cpu_count())])
+    if not context.opts.no_createrepo_update:
+        args.append('--update')
+    cachedir = createrepo_cachedir(context)
+    if cachedir is not None:
+        args.extend(['--cachedir', cachedir])
+    if context.opts.sqlite:
+        args.append('--no-database')
+    if context.opts.zchunk:
+        args.append('--zck')
+    args.append(context.working_dir)
+    return args
+
+
+def metadata_compressions(context):
+    """
+    Parse --compression into {data type: compression}. Raises UserError if
+    it is malformed.
+    """
+    spec = context.opts.compression
+    if not spec:
+        return {}
+    if '=' not in spec:
+        spec = ','.join('%s=%s' % (data_type, spec)
+                        for data_type in sorted(PACKAGE_DATA))
+    compressions = {}
+    for part in spec.split(','):
+        data_type, _, compression = part.strip().partition('=')
+        if data_type not in PACKAGE_DATA or compression not in COMPRESSIONS:
+            raise UserError(
+                "Bad --compression '%s': expected one of %s, or a list of "
+                "TYPE=COMPRESSION where TYPE is one of %s" % (
+                    part, ', '.join(sorted(COMPRESSIONS)),
+                    ', '.join(sorted(PACKAGE_DATA))))
+        compressions[data_type] = compression
+    return compressions
+
+
+def compress_repodata(context, repodata_dir=None):
+    """
+    Recompress the package metadata in the working repodata (or
+    'repodata_dir') as --compression asks. The files are compressed in
+    parallel, splitting the CPUs between them.
+    """
+    import multiprocessing
+    from multiprocessing.pool import ThreadPool
+
+    compressions = metadata_compressions(context)
+    if not compressions:
+        return
+    repodata_dir = repodata_dir or context.working_dir_repodata
+    tree, entries = repomd_data(repodata_dir)
+    jobs = [(entries[data_type], compression)
+            for data_type, compression in sorted(compressions.items())
+            if data_type in entries and
+            data_compression(entries[data_type]) != compression]
+    if not jobs:
+        return
+
+    threads = max(1, multiprocessing.cpu_count() // len(jobs))
+    verbose("Compressing %s", ', '.join(
+        '%s with %s' % (data.get('type'), compression)
+        for data, compression in jobs))
+    pool = ThreadPool(len(jobs))
+    try:
+        pool.map(lambda job: compress_data_file(
+            repodata_dir, job[0], job[1], threads), jobs)
+    except (EnvironmentError, ValueError) as ex:
+        raise ServiceError("Unable to compress the metadata: %s" % ex)
+    finally:
+        pool.close()
+        pool.join()
+    write_repomd(tree, repodata_dir)
+    return
 
-        args = [CREATEREPO]
-        args.append(context.working_dir)
+
+def run_createrepo(args):
+    """
+    Run the 'createrepo' command line 'args', returning its output (None on
+    python < 2.7). This has no dependency on the context, so that it can be
+    run in a worker process.
+    """
+    import subprocess
+
+    try:
         cmd_line = ' '.join(args)
         verbose("Executing: %s", cmd_line)
 
         if sys.version_info >= (2, 7):
-            output = subprocess.check_output(args)
-            verbose(output)
+            return subprocess.check_output(args)
         else:
             subprocess.check_call(args)
 
@@ -625,16 +1998,55 @@ def create_repodata(context):
             CREATEREPO, ex.strerror)
         raise ServiceError(err_msg)
 
-    return
+    return None
 
 
 #----------------------------------------------
 #                  s3yum:
 #----------------------------------------------
+def update_repo(context):
+    """
+    Bring the working directory up to date with the repo, apply the rpm's to
+    add and remove, then regenerate and publish the repodata.
+    """
+    get_repo(context, context.working_dir)
+    remove_local_rpms(context)
+    copy_rpms(context)
+    create_repodata(context)
+    upload_repodata(context)
+    return
+
+
+def list_and_perform_action(context):
+    """
+    List the repo, then perform the requested action.
+    """
+    list_metadata(context)
+    list_rpms(context)
+    perform_action(context)
+    return
+
+
 def perform_action(context):
     """
     Perform specific action, as indicated on command line.
     """
+    # Plan: print what the action would do, without doing any of it
+    if context.opts.plan:
+        from s3yum.plan import run_plan
+        run_plan(context)
+        return
+
+    # Apply: refuse a plan made against an older repo or older rpm's
+    if context.plan is not None:
+        from s3yum.plan import check_plan
+        check_plan(context)
+
+    # Get a snapshot: as the repo, but with the snapshot's listing
+    if context.action == GET and context.opts.snapshot:
+        from s3yum.snapshots import use_snapshot
+        use_snapshot(context, context.opts.snapshot)
+
     # Create: mktmp, copy rpms, configure, and upload
     if context.action == CREATE:
         init_workingdir(context)
@@ -645,22 +2057,55 @@ def perform_action(context):
     # Update: mktmp, get into tmp, copy rpms, configure, and upload
     elif context.action == UPDATE:
         init_workingdir(context)
-        get_repo(context, context.working_dir)
-        copy_rpms(context)
-        create_repodata(context)
-        upload_repodata(context)
+        update_repo(context)
 
     # List: just print
     elif context.action == LIST:
         print_lists(context)
 
     # Get: copy to output directory
+    elif context.action == GET and context.opts.stream:
+        from s3yum.stream import stream_repo
+        entries = repo_entries(context)
+        verbose("Streaming %i files to %s", len(entries),
+                context.opts.output or 'stdout')
+        stream_repo(context, entries)
+
+    elif context.action == GET and package_filters(context):
+        get_filtered(context, context.opts.output)
+
     elif context.action == GET:
         get_repo(context, context.opts.output)
 
     # Destroy the repo!
     elif context.action == DELETE:
         delete_repo(context)
+
+    # Prune: rewrite the metadata without old packages, then delete them
+    elif context.action == PRUNE:
+        prune_repo(context)
+
+    # Verify: compare the metadata with the listing and the objects
+    elif context.action == VERIFY:
+        from s3yum.verify import run_verify
+        run_verify(context)
+
+    # Daemon: mktmp, then publish submitted rpm's until interrupted
+    elif context.action == DAEMON:
+        from s3yum.daemon import run_daemon
+        init_workingdir(context)
+        run_daemon(context)
+
+    # Watch: mktmp, then publish dropped rpm's until interrupted
+    elif context.action == WATCH:
+        from s3yum.watch import run_watch
+        init_workingdir(context)
+        run_watch(context)
+
+    # Rollback: copy back the snapshot's metadata, then swap repomd.xml
+    elif context.action == ROLLBACK:
+        from s3yum.snapshots import rollback
+        rollback(context)
     return
 
 
@@ -672,6 +2117,7 @@ def main(argv=None):
         argv = sys.argv
 
     context = S3YumContext()
+    failed = False
     try:
         parse_args(context, argv)
 
@@ -692,33 +2138,121 @@ def main(argv=None):
                 print "\t%s: %s" % (action, usage)
             sys.exit(0)
 
+        # Apply: run the action saved in the plan, as it was planned
+        if context.action == APPLY:
+            from s3yum.plan import load_plan
+            load_plan(context)
+
+        if context.opts.plan_output:
+            context.opts.plan = True
+
+        if context.opts.plan and (context.action not in (CREATE, UPDATE) or
+                                  context.opts.daemon_url):
+            raise UserError("--plan is only for the create and update "
+                            "actions.")
+
         if context.action in (
                 CREATE, UPDATE) and not context.rpm_args and not context.opts.remove:
             raise UserError("Please specify at least one RPM to add/remove.")
 
+        # Hand the update to a running daemon, which publishes it for us:
+        if context.action == UPDATE and context.opts.daemon_url:
+            from s3yum.daemon import submit_to_daemon
+            submit_to_daemon(
+                context.opts.daemon_url,
+                context.rpm_args,
+                context.opts.remove,
+                timeout=context.opts.daemon_timeout)
+            return
+
+        if context.action == PRUNE and context.opts.keep is None and \
+                context.opts.older_than is None:
+            raise UserError(
+                "Please specify --keep and/or --older-than to prune.")
+
+        if context.opts.keep is not None and context.opts.keep < 1:
+            raise UserError("--keep must be at least 1.")
+
+        metadata_compressions(context)
+
+        if context.action == BATCH and len(context.rpm_args) != 1:
+            raise UserError("Please specify a single batch manifest file.")
+
+        if context.action == DAEMON and (
+                context.rpm_args or context.opts.remove):
+            raise UserError("The daemon action takes no rpm's or --remove.")
+
+        if context.action == WATCH and (
+                len(context.rpm_args) != 1 or context.opts.remove):
+            raise UserError("Please specify a single directory to watch.")
+
+        if context.action == SERVE and (
+                context.rpm_args or context.opts.remove):
+            raise UserError("The serve action takes no rpm's or --remove.")
+
+        if context.action == ROLLBACK and (
+                not context.opts.snapshot or context.rpm_args or
+                context.opts.remove):
+            raise UserError("Please specify a --snapshot to roll back to.")
+
+        if context.opts.snapshot and context.action not in (GET, ROLLBACK):
+            raise UserError("--snapshot is only for the get and rollback "
+                            "actions.")
+
+        if context.opts.snapshots < 0:
+            raise UserError("--snapshots must be at least 0.")
+
+        if context.action == SERVE and context.opts.serve_cache_size < 1:
+            raise UserError("--serve-cache-size must be at least 1.")
+
         if not context.opts.bucket:
             raise UserError("Please specify a bucket.")
 
-        if context.action in (GET) and not context.opts.output:
+        # Verify the bucket's contents, not the package manifest:
+        if context.action == VERIFY:
+            context.opts.no_manifest = True
+
+        if context.action in (GET) and not context.opts.output and \
+                not context.opts.stream:
             raise UserError("Please specify an output directory.")
 
+        if context.opts.stream and package_filters(context):
+            raise UserError(
+                "--stream downloads the whole repo; it can't be combined "
+                "with package filters.")
+
         # Init tmp, copy rpms, get the bucket, create repodata, upload:
         connect_to_bucket(context)
-        list_metadata(context)
-        list_rpms(context)
-        perform_action(context)
+        if context.action == BATCH:
+            from s3yum.batch import run_batch
+            run_batch(context)
+        elif context.action == SERVE:
+            # Objects are fetched on demand; there's nothing to list:
+            from s3yum.serve import run_serve
+            run_serve(context)
+        elif context.action in (CREATE, UPDATE, PRUNE, ROLLBACK) and \
+                context.opts.lock and not context.opts.dry_run and \
+                not context.opts.plan:
+            with_publish_lock(context, list_and_perform_action)
+        else:
+            list_and_perform_action(context)
     except IOError as ex:
-        print("Error: Unable to read from %s: %s (%i)" % (
-            ex.filename, ex.strerror, ex.errno))
+        failed = True
+        print >>error_out(context), \
+            "Error: Unable to read from %s: %s (%i)" % (
+                ex.filename, ex.strerror, ex.errno)
 
     except UserError as ex:
-        print(ex.strerror)
-        context.parser.print_help()
+        failed = True
+        print >>error_out(context), ex.strerror
+        context.parser.print_help(error_out(context))
 
     except ServiceError as ex:
-        print(ex.strerror)
+        failed = True
+        print >>error_out(context), ex.strerror
 
     except Exception:
+        failed = True
         traceback.print_exc()
 
     #==============
@@ -728,9 +2262,29 @@ def main(argv=None):
     # Remove *temp* working dir, but not user-specified:
     if context.working_dir is not None and not context.opts.working_dir:
         shutil.rmtree(context.working_dir)
+
+    # A tar streamed to stdout mustn't look complete when it isn't:
+    if failed and streaming_to_stdout(context):
+        return 1
     return
 
 
+def streaming_to_stdout(context):
+    """
+    Whether 'get --stream' is writing the repo to stdout.
+    """
+    opts = context.opts
+    return opts is not None and context.action == GET and \
+        getattr(opts, 'stream', False) and opts.output in (None, '-')
+
+
+def error_out(context):
+    """
+    Where main reports errors: stdout, unless the repo is streamed there.
+    """
+    return sys.stderr if streaming_to_stdout(context) else sys.stdout
+
+
 if __name__ == '__main__':
     main(sys.argv)
 # EOF
@@ -31,6 +31,9 @@ class UserError(Exception):
     """
 
     def __init__(self, msg):
+        # Passing 'msg' on lets the error be pickled, e.g. out of a
+        # multiprocessing worker:
+        Exception.__init__(self, msg)
         self.strerror = msg
 
 
@@ -41,6 +44,7 @@ class ServiceError(Exception):
     """
 
     def __init__(self, msg):
+        Exception.__init__(self, msg)
         self.strerror = msg
 
 
@@ -61,9 +65,12 @@ class S3YumContext(object):
         self.args = None # All non-option command line arguments
         self.opts = None # Command line options
         self.parser = None # The parser object used to get options
+        self.plan = None # Saved plan being applied, if any
         self.rpm_args = None # Filename command line arguments
         self.s3_bucket = None # boto.s3.Bucket object used for session
         self.s3_conn = None # boto.s3.Connection object used for AWS
+        self.s3_lease = None # s3yum.lock.S3Lease held while publishing
+        self.s3_manifest = None # Package manifest used for listing, if any
         self.s3_repodata_items = None # List of s3 repodata items
         self.s3_repodata_path = None # The path within the bucket to repodata
         self.s3_rpm_items = None # List of s3 rpm items
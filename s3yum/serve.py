@@ -0,0 +1,444 @@
+#!python
+# -*- coding: utf-8 -*-
+#==============================================================================
+#
+# s3yum: Repo creation/maintenance tool for S3-based yum repos
+#
+# Copyright 2013-2019 The New York Times Company
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+
+"""s3yum.serve: Read-through caching HTTP gateway to a repo.
+
+'serve' exposes --path over plain HTTP on --listen, so yum clients without
+S3 credentials (or a route to S3) can use the repo as a baseurl. Objects are
+fetched with s3yum's own credentials:
+ - rpm's and checksum-named metadata never change, so they are kept in an
+   on-disk LRU cache (--serve-cache, up to --serve-cache-size MB).
+ - repomd.xml (and anything else overwritten in place) is kept in memory for
+   --repomd-max-age seconds, and served stale if S3 can't be reached.
+Concurrent misses for the same object share a single fetch, and GET/HEAD
+support single byte Range requests.
+"""
+
+#----------------
+#    Imports:
+#----------------
+import os
+import re
+import time
+import socket
+import hashlib
+import urllib
+import urlparse
+import tempfile
+import threading
+import BaseHTTPServer
+from collections import OrderedDict
+
+from s3yum import s3yum_cli
+from s3yum.daemon import make_server
+from s3yum.s3yum_types import ServiceError
+from s3yum.util import (
+    s3join,
+    md5_matches,
+    get_s3item_md5
+)
+
+#----------------------------------------------
+#                Constants:
+#----------------------------------------------
+MEGABYTE = 1024 * 1024
+COPY_BUFSIZE = 65536
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+#----------------------------------------------
+#                 Classes:
+#----------------------------------------------
+class ObjectCache(object):
+
+    """
+    On-disk LRU cache of immutable objects, by S3 key.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # filename -> size, oldest use first
+        self.size = 0
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # Files are touched when used, so their mtimes give the LRU order:
+        cached = []
+        for filename in os.listdir(cache_dir):
+            filepath = os.path.join(cache_dir, filename)
+            if filename.endswith('.tmp'):
+                os.remove(filepath)
+                continue
+            stat = os.stat(filepath)
+            cached.append((stat.st_mtime, filename, stat.st_size))
+        for _, filename, size in sorted(cached):
+            self.entries[filename] = size
+            self.size += size
+        self.evict()
+        return
+
+    def filename(self, key):
+        return hashlib.sha1(key).hexdigest()
+
+    def lookup(self, key):
+        """
+        Return the cached file for 'key', or None.
+        """
+        filename = self.filename(key)
+        with self.lock:
+            if filename not in self.entries:
+                return None
+            self.entries[filename] = self.entries.pop(filename)
+        filepath = os.path.join(self.cache_dir, filename)
+        try:
+            os.utime(filepath, None)
+        except OSError:
+            return None
+        return filepath
+
+    def temp_file(self):
+        """
+        Return an open (file, path) to download an object into.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        return os.fdopen(fd, 'wb'), tmp_path
+
+    def add(self, key, tmp_path):
+        """
+        Move the downloaded 'tmp_path' into the cache as 'key'. Returns its
+        path in the cache.
+        """
+        filename = self.filename(key)
+        filepath = os.path.join(self.cache_dir, filename)
+        size = os.path.getsize(tmp_path)
+        os.rename(tmp_path, filepath)
+        with self.lock:
+            self.size += size - self.entries.pop(filename, 0)
+            self.entries[filename] = size
+        self.evict()
+        return filepath
+
+    def evict(self):
+        """
+        Remove the least recently used files until the cache fits. Readers
+        which already have a file open can carry on reading it.
+        """
+        while True:
+            with self.lock:
+                if self.size <= self.max_bytes or len(self.entries) <= 1:
+                    return
+                filename, size = self.entries.popitem(last=False)
+                self.size -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, filename))
+            except OSError:
+                pass
+
+
+class Coalescer(object):
+
+    """
+    Runs one call at a time per key; callers which arrive while a call is
+    running wait for, and share, its result.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}     # key -> [done event, result, exception]
+        return
+
+    def run(self, key, func):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = [threading.Event(), None, None]
+
+        if leader:
+            try:
+                call[1] = func()
+            except Exception as ex:
+                call[2] = ex
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call[0].set()
+        else:
+            call[0].wait()
+
+        if call[2] is not None:
+            raise call[2]
+        return call[1]
+
+
+class Gateway(object):
+
+    """
+    Fetches and caches the objects of one repo.
+    """
+
+    def __init__(self, context, cache):
+        self.context = context
+        self.cache = cache
+        self.coalescer = Coalescer()
+        self.metadata = {}      # key -> (expires, body)
+        self.lock = threading.Lock()
+        return
+
+    def get(self, path):
+        """
+        Return (headers, body, filepath) for the object at 'path' in the
+        repo, with either the body or the path of a cached copy; or None if
+        there is no such object.
+        """
+        key = s3join(self.context.opts.path, path)
+        filename = os.path.basename(key)
+        headers = s3yum_cli.get_upload_headers(self.context, filename)
+        headers.setdefault('Content-Type', 'application/octet-stream')
+
+        if s3yum_cli.is_immutable(filename):
+            filepath = self.cache.lookup(key)
+            if filepath is None:
+                filepath = self.coalescer.run(
+                    key, lambda: self.fetch_immutable(key))
+            if filepath is None:
+                return None
+            return headers, None, filepath
+
+        with self.lock:
+            expires, body = self.metadata.get(key, (0, None))
+        if expires < time.time():
+            try:
+                body = self.coalescer.run(
+                    key, lambda: self.fetch_metadata(key))
+            except Exception as ex:
+                if body is None:
+                    raise
+                s3yum_cli.verbose("Serving stale %s: %s", key, ex)
+        if body is None:
+            return None
+        return headers, body, None
+
+    def fetch_immutable(self, key):
+        """
+        Download 'key' into the cache, returning its path (None if it
+        doesn't exist).
+        """
+        # Another request may have finished fetching it just before ours:
+        filepath = self.cache.lookup(key)
+        if filepath is not None:
+            return filepath
+
+        item = self.context.s3_bucket.get_key(key)
+        if item is None:
+            return None
+        s3yum_cli.verbose("Fetching %s", key)
+        tmp_file, tmp_path = self.cache.temp_file()
+        try:
+            with tmp_file:
+                item.get_contents_to_file(tmp_file)
+            if not md5_matches(tmp_path, get_s3item_md5(item)):
+                raise ServiceError("Download failed: md5 mismatch for %s" % (
+                    key))
+            return self.cache.add(key, tmp_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def fetch_metadata(self, key):
+        """
+        Download the mutable object 'key' into memory, returning its body
+        (None if it doesn't exist).
+        """
+        item = self.context.s3_bucket.get_key(key)
+        body = None if item is None else item.get_contents_as_string()
+        with self.lock:
+            if body is None:
+                self.metadata.pop(key, None)
+            else:
+                self.metadata[key] = (
+                    time.time() + self.context.opts.repomd_max_age, body)
+        return body
+
+
+class GatewayRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """
+    GET/HEAD request handler for the gateway.
+    """
+
+    def do_GET(self):
+        self.serve(True)
+        return
+
+    def do_HEAD(self):
+        self.serve(False)
+        return
+
+    def send_error_status(self, code, message):
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(message) + 1))
+        self.end_headers()
+        self.wfile.write(message + '\n')
+        return
+
+    def serve(self, send_body, retries=1):
+        path = urllib.unquote(urlparse.urlparse(self.path).path)
+        parts = [part for part in path.split('/') if part]
+        if not parts or '..' in parts:
+            self.send_error_status(404, "Not found: %s" % self.path)
+            return
+
+        try:
+            result = self.server.gateway.get('/'.join(parts))
+        except Exception as ex:
+            s3yum_cli.verbose("Error fetching %s: %s", self.path, ex)
+            self.send_error_status(502, "Error fetching %s" % self.path)
+            return
+        if result is None:
+            self.send_error_status(404, "Not found: %s" % self.path)
+            return
+
+        headers, body, filepath = result
+        try:
+            source = open(filepath, 'rb') if filepath else None
+        except IOError:
+            # Evicted since it was looked up; fetch it again, but only once,
+            # so that objects evicting each other can't loop:
+            if retries > 0:
+                self.serve(send_body, retries - 1)
+            else:
+                self.send_error_status(
+                    502, "Error caching %s" % self.path)
+            return
+        try:
+            size = len(body) if source is None else \
+                os.fstat(source.fileno()).st_size
+            try:
+                byte_range = parse_range(self.headers.get('Range'), size)
+            except ValueError:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%i' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            start, end = byte_range or (0, size - 1)
+            if byte_range is None:
+                self.send_response(200)
+            else:
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %i-%i/%i' % (
+                    start, end, size))
+            for name, value in sorted(headers.items()):
+                if name.lower() in ('content-type', 'cache-control'):
+                    self.send_header(name, value)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+            if not send_body:
+                return
+
+            if source is None:
+                self.wfile.write(body[start:end + 1])
+                return
+            source.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                buf = source.read(min(COPY_BUFSIZE, remaining))
+                if not buf:
+                    break
+                self.wfile.write(buf)
+                remaining -= len(buf)
+        except socket.error:
+            pass    # The client went away
+        finally:
+            if source is not None:
+                source.close()
+        return
+
+    def log_message(self, fmt, *args):
+        s3yum_cli.verbose("%s: %s", self.address_string(), fmt % args)
+        return
+
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix:'
+
+
+#----------------------------------------------
+#                Functions:
+#----------------------------------------------
+def parse_range(header, size):
+    """
+    Parse a Range header for an object of 'size' bytes. Returns the
+    (first, last) bytes requested, or None for the whole object (no header,
+    or one we don't support). Raises ValueError if the range can't be
+    satisfied.
+    """
+    match = RANGE_RE.match(header or '')
+    if match is None or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first == '':
+        # The last 'last' bytes:
+        if int(last) == 0:
+            raise ValueError("Empty suffix range")
+        return max(0, size - int(last)), size - 1
+    first = int(first)
+    last = size - 1 if last == '' else min(int(last), size - 1)
+    if first >= size or last < first:
+        raise ValueError("Unsatisfiable range: %s" % header)
+    return first, last
+
+
+def run_serve(context):
+    """
+    Serve the repo until interrupted.
+    """
+    cache_dir = os.path.expanduser(context.opts.serve_cache)
+    try:
+        cache = ObjectCache(cache_dir, context.opts.serve_cache_size * MEGABYTE)
+    except OSError as ex:
+        raise ServiceError('Unable to use cache "%s": %s' % (
+            cache_dir, ex.strerror))
+    try:
+        server = make_server(context.opts.listen, GatewayRequestHandler)
+    except socket.error as ex:
+        raise ServiceError("Unable to listen on %s: %s" % (
+            context.opts.listen, ex))
+    server.gateway = Gateway(context, cache)
+
+    print "Serving %s from %s on %s" % (
+        context.opts.path or '/', context.opts.bucket, context.opts.listen)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print "Shutting down.."
+    finally:
+        server.server_close()
+    return
+
+# EOF
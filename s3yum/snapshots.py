@@ -0,0 +1,238 @@
+#!python
+# -*- coding: utf-8 -*-
+#==============================================================================
+#
+# s3yum: Repo creation/maintenance tool for S3-based yum repos
+#
+# Copyright 2013-2019 The New York Times Company
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+
+"""s3yum.snapshots: Immutable snapshots of published repodata.
+
+With --snapshots N, every publish copies its repomd.xml and the metadata
+files it references to repodata/snapshots/<id>/ with server-side copies (ids
+are UTC timestamps, so they sort oldest first). Rpm's are referenced by the
+snapshot's metadata, never copied. The newest N snapshots are kept, and
+older ones are removed with bulk deletes.
+
+'rollback --snapshot ID' copies back any of the snapshot's metadata files
+which have since been garbage collected, then swaps repomd.xml with a single
+copy, in the same order as a publish. 'get --snapshot ID' downloads the repo
+as it was at that snapshot, for pinned builds.
+
+Rpm's deleted since a snapshot was taken (by update --remove or prune) are
+gone for good, so rollback and get refuse snapshots which reference them.
+"""
+
+#----------------
+#    Imports:
+#----------------
+import os
+import shutil
+import tempfile
+import datetime
+
+from s3yum import s3yum_cli
+from s3yum.s3yum_types import (
+    UserError,
+    ServiceError
+)
+from s3yum.engine import transfer_map
+from s3yum.metadata import (
+    data_location,
+    parse_primary
+)
+from s3yum.util import s3join
+
+#----------------------------------------------
+#                Constants:
+#----------------------------------------------
+SNAPSHOT_ID_FORMAT = '%Y%m%dT%H%M%SZ'
+
+
+#----------------------------------------------
+#                Functions:
+#----------------------------------------------
+def snapshot_path(context, *args):
+    """
+    Path of the snapshots, or of a snapshot or item within them.
+    """
+    return s3join(context.opts.path, s3yum_cli.REPODATA, s3yum_cli.SNAPSHOTS,
+                  *args)
+
+
+def list_snapshots(context):
+    """
+    Return the repo's snapshots, as a dict of snapshot id -> items.
+    """
+    prefix = snapshot_path(context, '')
+    snapshots = {}
+    for item in context.s3_bucket.list(prefix=prefix):
+        snapshot_id, _, filename = item.name[len(prefix):].partition('/')
+        if filename:
+            snapshots.setdefault(snapshot_id, []).append(item)
+    return snapshots
+
+
+def new_snapshot_id(snapshots):
+    """
+    A snapshot id for now, distinct from those of 'snapshots'.
+    """
+    snapshot_id = datetime.datetime.utcnow().strftime(SNAPSHOT_ID_FORMAT)
+    unique_id = snapshot_id
+    count = 1
+    while unique_id in snapshots:
+        count += 1
+        unique_id = '%s-%i' % (snapshot_id, count)
+    return unique_id
+
+
+def copy_items(context, copies):
+    """
+    Server-side copy each of 'copies', a list of (source, dest) paths in the
+    bucket. Copies keep the source's headers.
+    """
+    def copy_item(copy):
+        source, dest = copy
+        s3yum_cli.verbose("Copying: %s -> %s", source, dest)
+        if not context.opts.dry_run:
+            context.s3_bucket.copy_key(dest, context.s3_bucket.name, source)
+        return
+
+    transfer_map(context, copy_item, copies)
+    return
+
+
+def take_snapshot(context, metadata_files):
+    """
+    Snapshot the just-published repomd.xml and its 'metadata_files', then
+    expire all but the newest --snapshots snapshots.
+    """
+    snapshots = list_snapshots(context)
+    snapshot_id = new_snapshot_id(snapshots)
+    repodata_path = s3join(context.opts.path, s3yum_cli.REPODATA)
+    dest_path = snapshot_path(context, snapshot_id)
+    s3yum_cli.verbose("Taking snapshot %s", snapshot_id)
+
+    # repomd.xml goes last; a snapshot without one is incomplete:
+    copy_items(context, [
+        (s3join(repodata_path, filename), s3join(dest_path, filename))
+        for filename in metadata_files])
+    copy_items(context, [
+        (s3join(repodata_path, s3yum_cli.REPOMD),
+         s3join(dest_path, s3yum_cli.REPOMD))])
+
+    expire_snapshots(context, snapshots, context.opts.snapshots - 1)
+    return snapshot_id
+
+
+def expire_snapshots(context, snapshots, keep):
+    """
+    Bulk-delete all but the newest 'keep' of 'snapshots'.
+    """
+    expired = sorted(snapshots)[:max(0, len(snapshots) - keep)]
+    items = []
+    for snapshot_id in expired:
+        s3yum_cli.verbose("Expiring snapshot %s", snapshot_id)
+        items.extend(snapshots[snapshot_id])
+    s3yum_cli.delete_items(context, items)
+    return expired
+
+
+def use_snapshot(context, snapshot_id):
+    """
+    Make the listing of the repo (the repodata and rpm items) that of the
+    snapshot 'snapshot_id'. Raises ServiceError if the snapshot references
+    rpm's which are no longer in the bucket.
+    """
+    snapshots = list_snapshots(context)
+    repomd_path = snapshot_path(context, snapshot_id, s3yum_cli.REPOMD)
+    if repomd_path not in [item.name for item in
+                           snapshots.get(snapshot_id, [])]:
+        raise UserError("No snapshot '%s' of %s (snapshots: %s)" % (
+            snapshot_id, s3join(context.opts.bucket, context.opts.path),
+            ', '.join(sorted(snapshots)) or 'none'))
+    context.s3_repodata_path = snapshot_path(context, snapshot_id)
+    context.s3_repodata_items = snapshots[snapshot_id]
+
+    repodata_dir = tempfile.mkdtemp(prefix='s3yum-repodata-')
+    try:
+        entries = s3yum_cli.download_published_repodata(
+            context, repodata_dir, ['primary'])
+        packages = parse_primary(os.path.join(
+            repodata_dir,
+            os.path.basename(data_location(entries['primary']))))
+    finally:
+        shutil.rmtree(repodata_dir, True)
+
+    items_by_name = dict(
+        (item.name, item) for item in context.s3_rpm_items)
+    items = []
+    missing = []
+    for package in packages:
+        item = items_by_name.get(s3join(context.opts.path, package['location']))
+        if item is None:
+            missing.append(package['location'])
+        else:
+            items.append(item)
+    if missing:
+        raise ServiceError(
+            "Snapshot %s references %i rpm's which have since been "
+            "deleted, e.g. %s" % (snapshot_id, len(missing), missing[0]))
+    context.s3_rpm_items = items
+    return
+
+
+def rollback(context):
+    """
+    Republish the repodata of snapshot --snapshot.
+    """
+    snapshot_id = context.opts.snapshot
+    repodata_path = context.s3_repodata_path
+    repodata_items = context.s3_repodata_items
+    rpm_items = context.s3_rpm_items
+    repomd_item, repomd_xml = s3yum_cli.read_published_repomd(context)
+
+    use_snapshot(context, snapshot_id)
+    prefix = snapshot_path(context, snapshot_id, '')
+    filenames = sorted(item.name[len(prefix):]
+                       for item in context.s3_repodata_items)
+    context.s3_repodata_path = repodata_path
+    context.s3_repodata_items = repodata_items
+    context.s3_rpm_items = rpm_items
+
+    # Restore metadata files garbage collected since, then swap repomd.xml:
+    published_names = set(item.name for item in repodata_items)
+    metadata_files = [filename for filename in filenames
+                      if filename != s3yum_cli.REPOMD]
+    copy_items(context, [
+        (prefix + filename, s3join(repodata_path, filename))
+        for filename in metadata_files
+        if s3join(repodata_path, filename) not in published_names])
+    if context.s3_lease is not None:
+        context.s3_lease.check()
+    copy_items(context, [(prefix + s3yum_cli.REPOMD,
+                          s3join(repodata_path, s3yum_cli.REPOMD))])
+    print "Rolled back %s to snapshot %s" % (
+        s3join(context.opts.bucket, context.opts.path), snapshot_id)
+
+    # The metadata we replaced is collected like that of any publish. The
+    # package manifest is now stale, so the next run lists the bucket:
+    rolled_back = set(s3join(repodata_path, filename) for filename in filenames)
+    s3yum_cli.delete_items(context, s3yum_cli.collect_stale_metadata(
+        context, rolled_back, repomd_item, repomd_xml))
+    return
+
+# EOF
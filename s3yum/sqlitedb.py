@@ -0,0 +1,480 @@
+#!python
+# -*- coding: utf-8 -*-
+#==============================================================================
+#
+# s3yum: Repo creation/maintenance tool for S3-based yum repos
+#
+# Copyright 2013-2019 The New York Times Company
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+
+"""s3yum.sqlitedb: sqlite metadata databases (primary_db, etc.).
+
+With --sqlite, s3yum builds the sqlite databases yum would otherwise build
+for itself from the XML metadata, in the schema createrepo uses (version
+10). Rather than rebuilding them from scratch, the previous publish's
+databases are stashed before createrepo runs, and updated: packages which
+are no longer in the metadata are deleted, and only the new ones are
+inserted. The three databases are built in parallel processes.
+"""
+
+#----------------
+#    Imports:
+#----------------
+import os
+import bz2
+import shutil
+import sqlite3
+import hashlib
+import multiprocessing
+from collections import OrderedDict
+import xml.etree.ElementTree as ElementTree
+
+from s3yum import s3yum_cli
+from s3yum.s3yum_types import ServiceError
+from s3yum.metadata import (
+    PACKAGE_DATA,
+    HASHLIB_NAMES,
+    repo_tag,
+    common_tag,
+    rpm_tag,
+    repomd_data,
+    data_location,
+    open_metadata,
+    file_checksum,
+    update_data,
+    replace_data,
+    write_repomd
+)
+
+#----------------------------------------------
+#                Constants:
+#----------------------------------------------
+DB_VERSION = 10
+STASH = '.s3yum-sqlite'
+XML_BASE = '{http://www.w3.org/XML/1998/namespace}base'
+
+# Dependency tables, and the primary.xml elements they come from:
+DEP_TABLES = ('requires', 'provides', 'conflicts', 'obsoletes', 'suggests',
+              'enhances', 'recommends', 'supplements')
+
+PRIMARY_TABLES = [
+    "CREATE TABLE IF NOT EXISTS db_info (dbversion INTEGER, checksum TEXT)",
+    "CREATE TABLE IF NOT EXISTS packages (pkgKey INTEGER PRIMARY KEY, "
+    "pkgId TEXT, name TEXT, arch TEXT, version TEXT, epoch TEXT, "
+    "release TEXT, summary TEXT, description TEXT, url TEXT, "
+    "time_file INTEGER, time_build INTEGER, rpm_license TEXT, "
+    "rpm_vendor TEXT, rpm_group TEXT, rpm_buildhost TEXT, "
+    "rpm_sourcerpm TEXT, rpm_header_start INTEGER, rpm_header_end INTEGER, "
+    "rpm_packager TEXT, size_package INTEGER, size_installed INTEGER, "
+    "size_archive INTEGER, location_href TEXT, location_base TEXT, "
+    "checksum_type TEXT)",
+    "CREATE TABLE IF NOT EXISTS files (name TEXT, type TEXT, "
+    "pkgKey INTEGER)",
+    "CREATE TABLE IF NOT EXISTS requires (name TEXT, flags TEXT, "
+    "epoch TEXT, version TEXT, release TEXT, pkgKey INTEGER, "
+    "pre BOOLEAN DEFAULT FALSE)",
+] + [
+    "CREATE TABLE IF NOT EXISTS %s (name TEXT, flags TEXT, epoch TEXT, "
+    "version TEXT, release TEXT, pkgKey INTEGER)" % table
+    for table in DEP_TABLES[1:]
+] + [
+    "CREATE TRIGGER IF NOT EXISTS removals AFTER DELETE ON packages "
+    "BEGIN DELETE FROM files WHERE pkgKey = old.pkgKey; %s END" % ' '.join(
+        "DELETE FROM %s WHERE pkgKey = old.pkgKey;" % table
+        for table in DEP_TABLES),
+]
+
+PRIMARY_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS packagename ON packages (name)",
+    "CREATE INDEX IF NOT EXISTS packageId ON packages (pkgId)",
+    "CREATE INDEX IF NOT EXISTS filenames ON files (name)",
+    "CREATE INDEX IF NOT EXISTS pkgfiles ON files (pkgKey)",
+] + [
+    "CREATE INDEX IF NOT EXISTS pkg%s ON %s (pkgKey)" % (table, table)
+    for table in DEP_TABLES
+] + [
+    "CREATE INDEX IF NOT EXISTS %sname ON %s (name)" % (table, table)
+    for table in ('requires', 'provides')
+]
+
+FILELISTS_TABLES = [
+    "CREATE TABLE IF NOT EXISTS db_info (dbversion INTEGER, checksum TEXT)",
+    "CREATE TABLE IF NOT EXISTS packages (pkgKey INTEGER PRIMARY KEY, "
+    "pkgId TEXT)",
+    "CREATE TABLE IF NOT EXISTS filelist (pkgKey INTEGER, dirname TEXT, "
+    "filenames TEXT, filetypes TEXT)",
+    "CREATE TRIGGER IF NOT EXISTS remove_filelist AFTER DELETE ON packages "
+    "BEGIN DELETE FROM filelist WHERE pkgKey = old.pkgKey; END",
+]
+
+FILELISTS_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS keyfile ON filelist (pkgKey)",
+    "CREATE INDEX IF NOT EXISTS pkgId ON packages (pkgId)",
+    "CREATE INDEX IF NOT EXISTS dirnames ON filelist (dirname)",
+]
+
+OTHER_TABLES = [
+    "CREATE TABLE IF NOT EXISTS db_info (dbversion INTEGER, checksum TEXT)",
+    "CREATE TABLE IF NOT EXISTS packages (pkgKey INTEGER PRIMARY KEY, "
+    "pkgId TEXT)",
+    "CREATE TABLE IF NOT EXISTS changelog (pkgKey INTEGER, author TEXT, "
+    "date INTEGER, changelog TEXT)",
+    "CREATE TRIGGER IF NOT EXISTS remove_changelogs AFTER DELETE ON "
+    "packages BEGIN DELETE FROM changelog WHERE pkgKey = old.pkgKey; END",
+]
+
+OTHER_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS keychange ON changelog (pkgKey)",
+    "CREATE INDEX IF NOT EXISTS pkgId ON packages (pkgId)",
+]
+
+FILE_TYPES = {'dir': 'd', 'ghost': 'g'}
+
+
+#----------------------------------------------
+#                Functions:
+#----------------------------------------------
+def iter_packages(xml_path, namespace):
+    """
+    Yield the package elements of the metadata file 'xml_path', whose
+    default namespace is 'namespace', clearing each once it has been used.
+    """
+    tag = '{%s}package' % namespace
+    with open_metadata(xml_path) as xml_file:
+        for _, elem in ElementTree.iterparse(xml_file):
+            if elem.tag == tag:
+                yield elem
+                elem.clear()
+    return
+
+
+def primary_key(elem):
+    """
+    The key of a primary.xml package element: its pkgid and location (the
+    same rpm may be in the repo twice).
+    """
+    return (elem.find(common_tag('checksum')).text,
+            elem.find(common_tag('location')).get('href'))
+
+
+def insert_primary(conn, elem):
+    """
+    Insert the primary.xml package element 'elem'.
+    """
+    version = elem.find(common_tag('version'))
+    checksum = elem.find(common_tag('checksum'))
+    times = elem.find(common_tag('time'))
+    sizes = elem.find(common_tag('size'))
+    location = elem.find(common_tag('location'))
+    fmt = elem.find(common_tag('format'))
+    if fmt is None:
+        fmt = ElementTree.Element(common_tag('format'))
+    header_range = fmt.find(rpm_tag('header-range'))
+    if header_range is None:
+        header_range = ElementTree.Element(rpm_tag('header-range'))
+
+    cursor = conn.execute(
+        "INSERT INTO packages (pkgId, name, arch, version, epoch, release, "
+        "summary, description, url, time_file, time_build, rpm_license, "
+        "rpm_vendor, rpm_group, rpm_buildhost, rpm_sourcerpm, "
+        "rpm_header_start, rpm_header_end, rpm_packager, size_package, "
+        "size_installed, size_archive, location_href, location_base, "
+        "checksum_type) VALUES (%s)" % ', '.join(['?'] * 25), (
+            checksum.text,
+            elem.findtext(common_tag('name')),
+            elem.findtext(common_tag('arch')),
+            version.get('ver'),
+            version.get('epoch'),
+            version.get('rel'),
+            elem.findtext(common_tag('summary')),
+            elem.findtext(common_tag('description')),
+            elem.findtext(common_tag('url')),
+            times.get('file'),
+            times.get('build'),
+            fmt.findtext(rpm_tag('license')),
+            fmt.findtext(rpm_tag('vendor')),
+            fmt.findtext(rpm_tag('group')),
+            fmt.findtext(rpm_tag('buildhost')),
+            fmt.findtext(rpm_tag('sourcerpm')),
+            header_range.get('start'),
+            header_range.get('end'),
+            elem.findtext(common_tag('packager')),
+            sizes.get('package'),
+            sizes.get('installed'),
+            sizes.get('archive'),
+            location.get('href'),
+            location.get(XML_BASE),
+            checksum.get('type'),
+        ))
+    pkg_key = cursor.lastrowid
+
+    conn.executemany(
+        "INSERT INTO files (name, type, pkgKey) VALUES (?, ?, ?)",
+        [(f.text, f.get('type', 'file'), pkg_key)
+         for f in fmt.findall(common_tag('file'))])
+    for table in DEP_TABLES:
+        entries = fmt.find(rpm_tag(table))
+        if entries is None:
+            continue
+        rows = [(entry.get('name'), entry.get('flags'), entry.get('epoch'),
+                 entry.get('ver'), entry.get('rel'), pkg_key)
+                for entry in entries.findall(rpm_tag('entry'))]
+        if table == 'requires':
+            rows = [row + ('TRUE' if entry.get('pre') in ('1', 'true')
+                           else 'FALSE',)
+                    for row, entry in zip(
+                        rows, entries.findall(rpm_tag('entry')))]
+            conn.executemany(
+                "INSERT INTO requires (name, flags, epoch, version, release, "
+                "pkgKey, pre) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        else:
+            conn.executemany(
+                "INSERT INTO %s (name, flags, epoch, version, release, "
+                "pkgKey) VALUES (?, ?, ?, ?, ?, ?)" % table, rows)
+    return
+
+
+def insert_filelists(conn, elem):
+    """
+    Insert the filelists.xml package element 'elem'. Its files are stored
+    one row per directory.
+    """
+    pkg_key = conn.execute("INSERT INTO packages (pkgId) VALUES (?)",
+                           (elem.get('pkgid'),)).lastrowid
+    dirs = OrderedDict()
+    for f in elem.findall('{%s}file' % PACKAGE_DATA['filelists']):
+        dirname, _, basename = f.text.rpartition('/')
+        names, types = dirs.setdefault(dirname or '/', ([], []))
+        names.append(basename)
+        types.append(FILE_TYPES.get(f.get('type'), 'f'))
+    conn.executemany(
+        "INSERT INTO filelist (pkgKey, dirname, filenames, filetypes) "
+        "VALUES (?, ?, ?, ?)",
+        [(pkg_key, dir_name, '/'.join(dir_names), ''.join(dir_types))
+         for dir_name, (dir_names, dir_types) in dirs.items()])
+    return
+
+
+def insert_other(conn, elem):
+    """
+    Insert the other.xml package element 'elem'.
+    """
+    pkg_key = conn.execute("INSERT INTO packages (pkgId) VALUES (?)",
+                           (elem.get('pkgid'),)).lastrowid
+    conn.executemany(
+        "INSERT INTO changelog (pkgKey, author, date, changelog) "
+        "VALUES (?, ?, ?, ?)",
+        [(pkg_key, entry.get('author'), entry.get('date'), entry.text)
+         for entry in elem.findall(
+             '{%s}changelog' % PACKAGE_DATA['other'])])
+    return
+
+
+# The schema, and how to key and insert the packages, of each database:
+DATABASES = {
+    'primary': (PRIMARY_TABLES, PRIMARY_INDEXES,
+                "SELECT pkgId, location_href, pkgKey FROM packages",
+                primary_key, insert_primary),
+    'filelists': (FILELISTS_TABLES, FILELISTS_INDEXES,
+                  "SELECT pkgId, pkgKey FROM packages",
+                  lambda elem: elem.get('pkgid'), insert_filelists),
+    'other': (OTHER_TABLES, OTHER_INDEXES,
+              "SELECT pkgId, pkgKey FROM packages",
+              lambda elem: elem.get('pkgid'), insert_other),
+}
+
+
+def database_version(conn):
+    """
+    The schema version of the database 'conn', or None if it has none.
+    """
+    try:
+        row = conn.execute("SELECT dbversion FROM db_info").fetchone()
+    except sqlite3.DatabaseError:
+        return None
+    return row[0] if row else None
+
+
+def build_database(args):
+    """
+    Bring the sqlite database 'db_path' up to date with the metadata file
+    'xml_path' of 'data_type', whose checksum is 'xml_checksum'. If
+    'db_path' holds a previous database, it is updated in place; otherwise
+    it is built from scratch. Returns (added, removed, kept) package counts.
+    This has no dependency on the context, so that it can be run in a
+    worker process.
+    """
+    data_type, xml_path, xml_checksum, db_path = args
+    tables, indexes, select_keys, package_key, insert = DATABASES[data_type]
+
+    conn = sqlite3.connect(db_path)
+    if database_version(conn) != DB_VERSION:
+        conn.close()
+        os.remove(db_path)
+        conn = sqlite3.connect(db_path)
+    try:
+        conn.text_factory = str
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute("PRAGMA journal_mode = MEMORY")
+        for statement in tables:
+            conn.execute(statement)
+
+        # filelists.xml and other.xml only identify packages by pkgid, so a
+        # package listed twice (at two locations) is told apart by its
+        # occurrence: each key is numbered, in database and XML order alike,
+        # and the databases get a row per XML entry.
+        existing = {}
+        counts = {}
+        for row in conn.execute(select_keys + " ORDER BY pkgKey"):
+            key = row[0] if len(row) == 2 else row[:2]
+            counts[key] = counts.get(key, 0) + 1
+            existing[(key, counts[key])] = row[-1]
+        seen = set()
+        counts = {}
+        for elem in iter_packages(xml_path, PACKAGE_DATA[data_type]):
+            key = package_key(elem)
+            counts[key] = counts.get(key, 0) + 1
+            key = (key, counts[key])
+            if key not in existing:
+                insert(conn, elem)
+            seen.add(key)
+
+        removed = [(pkg_key,) for row_key, pkg_key in existing.items()
+                   if row_key not in seen]
+        conn.executemany("DELETE FROM packages WHERE pkgKey = ?", removed)
+        for statement in indexes:
+            conn.execute(statement)
+        conn.execute("DELETE FROM db_info")
+        conn.execute("INSERT INTO db_info (dbversion, checksum) VALUES (?, ?)",
+                     (DB_VERSION, xml_checksum))
+        conn.commit()
+    finally:
+        conn.close()
+    kept = len(existing) - len(removed)
+    return len(seen) - kept, len(removed), kept
+
+
+def stash_path(context, data_type):
+    """
+    Where the previous 'data_type' database is stashed.
+    """
+    return os.path.join(context.working_dir, STASH, '%s.sqlite' % data_type)
+
+
+def stash_databases(context, repodata_dir=None):
+    """
+    Decompress the sqlite databases of the repodata in 'repodata_dir' (by
+    default, the working repodata, before createrepo replaces it) into the
+    stash, to be updated by make_databases.
+    """
+    repodata_dir = repodata_dir or context.working_dir_repodata
+    stash_dir = os.path.join(context.working_dir, STASH)
+    shutil.rmtree(stash_dir, True)
+    os.makedirs(stash_dir)
+    if not os.path.exists(os.path.join(repodata_dir, 'repomd.xml')):
+        return
+    _, entries = repomd_data(repodata_dir)
+    for data_type in PACKAGE_DATA:
+        data = entries.get('%s_db' % data_type)
+        if data is None:
+            continue
+        db_file = os.path.join(
+            repodata_dir, os.path.basename(data_location(data)))
+        try:
+            with open_metadata(db_file) as src:
+                with open(stash_path(context, data_type), 'wb') as dest:
+                    shutil.copyfileobj(src, dest)
+        except (EnvironmentError, ValueError) as ex:
+            s3yum_cli.verbose("Not reusing %s: %s", db_file, ex)
+    return
+
+
+def write_database_file(repodata_dir, data_type, db_path, checksum_type):
+    """
+    Write the database 'db_path' as a bzip2'd, checksum-named file in
+    'repodata_dir'. Returns the repomd.xml values describing it.
+    """
+    tmp_path = os.path.join(repodata_dir, '%s.sqlite.bz2.tmp' % data_type)
+    open_checksum = hashlib.new(HASHLIB_NAMES.get(checksum_type, checksum_type))
+    bz2_file = bz2.BZ2File(tmp_path, 'wb')
+    try:
+        with open(db_path, 'rb') as src:
+            for buf in iter(lambda: src.read(65536), ''):
+                open_checksum.update(buf)
+                bz2_file.write(buf)
+    finally:
+        bz2_file.close()
+
+    checksum = file_checksum(tmp_path, checksum_type)
+    filename = '%s-%s.sqlite.bz2' % (checksum, data_type)
+    os.rename(tmp_path, os.path.join(repodata_dir, filename))
+    return {
+        'checksum': checksum,
+        'open-checksum': open_checksum.hexdigest(),
+        'location': 'repodata/%s' % filename,
+        'size': os.path.getsize(os.path.join(repodata_dir, filename)),
+        'open-size': os.path.getsize(db_path),
+        'database_version': DB_VERSION,
+    }
+
+
+def make_databases(context):
+    """
+    Build the primary_db, filelists_db and other_db databases for the
+    working repodata, updating the stashed databases where there are any,
+    and add them to repomd.xml.
+    """
+    repodata_dir = context.working_dir_repodata
+    stash_dir = os.path.join(context.working_dir, STASH)
+    if not os.path.exists(stash_dir):
+        os.makedirs(stash_dir)
+    tree, entries = repomd_data(repodata_dir)
+
+    jobs = []
+    for data_type in sorted(PACKAGE_DATA):
+        data = entries[data_type]
+        jobs.append((
+            data_type,
+            os.path.join(repodata_dir, os.path.basename(data_location(data))),
+            data.findtext(repo_tag('checksum')),
+            stash_path(context, data_type)))
+
+    procs = multiprocessing.Pool(len(jobs))
+    try:
+        results = procs.map(build_database, jobs)
+    except (EnvironmentError, ValueError, SyntaxError,
+            sqlite3.Error) as ex:
+        raise ServiceError("Unable to build the sqlite metadata: %s" % ex)
+    finally:
+        procs.close()
+        procs.join()
+
+    try:
+        for (data_type, _, _, db_path), result in zip(jobs, results):
+            s3yum_cli.verbose(
+                "%s_db: %i packages added, %i removed, %i kept",
+                data_type, *result)
+            checksum_type = entries[data_type].find(
+                repo_tag('checksum')).get('type')
+            data = replace_data(repodata_dir, tree, entries,
+                                '%s_db' % data_type)
+            update_data(data, checksum_type, write_database_file(
+                repodata_dir, data_type, db_path, checksum_type))
+        write_repomd(tree, repodata_dir)
+    finally:
+        shutil.rmtree(stash_dir, True)
+    return
+
+# EOF
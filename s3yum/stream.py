@@ -0,0 +1,200 @@
+#!python
+# -*- coding: utf-8 -*-
+#==============================================================================
+#
+# s3yum: Repo creation/maintenance tool for S3-based yum repos
+#
+# Copyright 2013-2019 The New York Times Company
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+
+"""s3yum.stream: Stream a repo out of S3 as a tar archive.
+
+'get --stream' writes the repo, laid out as 'get' would on disk, as a tar to
+a file or stdout. Objects are fetched into memory by --workers threads, up
+to --read-ahead MB ahead of the writer, and written to the tar in listing
+order. An object larger than the read-ahead window is streamed straight
+from S3 into the tar once everything before it has been written. Nothing
+is written to disk.
+"""
+
+#----------------
+#    Imports:
+#----------------
+import sys
+import hashlib
+import calendar
+import tarfile
+import StringIO
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from s3yum.s3yum_types import (
+    UserError,
+    ServiceError
+)
+from s3yum.util import (
+    get_s3item_md5,
+    s3time_as_datetime
+)
+
+#----------------------------------------------
+#                Constants:
+#----------------------------------------------
+MEGABYTE = 1024 * 1024
+
+
+#----------------------------------------------
+#                 Classes:
+#----------------------------------------------
+class HashingReader(object):
+
+    """
+    File-like wrapper which md5's everything read through it.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.md5 = hashlib.md5()
+        return
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.md5.update(data)
+        return data
+
+
+#----------------------------------------------
+#                Functions:
+#----------------------------------------------
+def check_md5(item, md5):
+    """
+    Raise ServiceError if the hex digest 'md5' isn't the item's checksum.
+    """
+    if md5 != get_s3item_md5(item):
+        raise ServiceError("Download failed: md5 mismatch for %s" % item.name)
+    return
+
+
+def fetch_item(item):
+    """
+    Download the s3 item 'item' into memory, checking its md5.
+    """
+    data = item.get_contents_as_string()
+    check_md5(item, hashlib.md5(data).hexdigest())
+    return data
+
+
+def item_tarinfo(arcname, item):
+    """
+    Build the tar header for the s3 item 'item'.
+    """
+    tarinfo = tarfile.TarInfo(arcname)
+    tarinfo.size = int(item.size)
+    tarinfo.mode = 0644
+    tarinfo.mtime = calendar.timegm(
+        s3time_as_datetime(item.last_modified).utctimetuple())
+    return tarinfo
+
+
+def write_items(tar, entries, workers, read_ahead):
+    """
+    Write 'entries', a list of (arcname, s3 item) tuples, to the tarfile
+    'tar' in order. Up to 'read_ahead' bytes are downloaded ahead of the
+    writer, by 'workers' threads.
+    """
+    pool = ThreadPool(max(1, workers))
+    pending = deque()   # (arcname, item, async result), in write order
+
+    def write_oldest():
+        arcname, item, result = pending.popleft()
+        tar.addfile(item_tarinfo(arcname, item),
+                    StringIO.StringIO(result.get()))
+        return
+
+    try:
+        for arcname, item in entries:
+            size = int(item.size)
+            while pending and size + sum(
+                    int(p[1].size) for p in pending) > read_ahead:
+                write_oldest()
+
+            if size > read_ahead:
+                # Too big to buffer; everything before it has been written:
+                reader = HashingReader(item)
+                try:
+                    tar.addfile(item_tarinfo(arcname, item), reader)
+                finally:
+                    item.close()
+                check_md5(item, reader.md5.hexdigest())
+            else:
+                pending.append((arcname, item,
+                                pool.apply_async(fetch_item, (item,))))
+
+        while pending:
+            write_oldest()
+    finally:
+        pool.close()
+        pool.join()
+    return
+
+
+def open_output(output):
+    """
+    Open the stream's destination: the file 'output', or stdout if it is
+    None or '-'. Returns (file, should_close).
+    """
+    if output in (None, '-'):
+        return sys.stdout, False
+    try:
+        return open(output, 'wb'), True
+    except IOError as ex:
+        raise UserError("Unable to write to %s: %s" % (output, ex.strerror))
+
+
+def stream_repo(context, entries):
+    """
+    Write the repo's 'entries' (see write_items) as a tar to --output, with
+    --stream-compression.
+    """
+    compression = context.opts.stream_compression
+    compressor = None
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise UserError(
+                "The zstandard module is required for zstd compression")
+        compressor = zstandard.ZstdCompressor()
+
+    outfile, should_close = open_output(context.opts.output)
+    try:
+        if compressor is not None:
+            writer = compressor.stream_writer(outfile)
+        else:
+            writer = outfile
+        tar = tarfile.open(
+            fileobj=writer, mode='w|gz' if compression == 'gzip' else 'w|')
+        write_items(tar, entries, context.opts.workers,
+                    context.opts.read_ahead * MEGABYTE)
+        tar.close()
+        if compressor is not None:
+            writer.flush(zstandard.FLUSH_FRAME)
+        outfile.flush()
+    finally:
+        if should_close:
+            outfile.close()
+    return
+
+# EOF
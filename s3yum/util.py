@@ -36,6 +36,117 @@ import re
 import logging
 import hashlib
 import datetime
+import json
+import gzip
+import bisect
+import fnmatch
+import StringIO
+from collections import OrderedDict
+
+#----------------------------------------------
+#                Constants:
+#----------------------------------------------
+HASH_BUFSIZE = 1024 * 1024
+# Below this many bytes to hash, a process pool costs more than it saves:
+BULK_HASH_BYTES = 64 * 1024 * 1024
+
+# (realpath, inode, size, mtime) -> (md5, sha256) of the files hashed
+# recently; the least recently used are dropped past HASH_CACHE_ENTRIES, so
+# that long-running daemon/watch/serve processes don't grow without bound:
+HASH_CACHE_ENTRIES = 100000
+_HASHES = OrderedDict()
+
+
+#----------------------------------------------
+#                 Classes:
+#----------------------------------------------
+class GlobMatcher(object):
+
+    """
+    Matches names against many fnmatch-style globs at once.
+
+    Globs without wildcards are looked up in a set. Globs with a literal
+    prefix (e.g. 'el7/my_pkg-*') only test the names sharing that prefix,
+    found by bisecting the sorted names. The rest (e.g. '*/my_pkg-*') are
+    compiled into a single regex (one per GLOB_CHUNK globs, python2.7's
+    limit on groups), tried once per name.
+    """
+
+    GLOB_CHUNK = 90
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.literals = set()
+        self.prefixed = []      # (literal prefix, compiled regex, pattern)
+        self.unprefixed = []
+        for pattern in self.patterns:
+            prefix = re.split(r'[*?[]', pattern, 1)[0]
+            if prefix == pattern:
+                self.literals.add(pattern)
+            elif prefix:
+                self.prefixed.append(
+                    (prefix, re.compile(fnmatch.translate(pattern)), pattern))
+            else:
+                self.unprefixed.append(pattern)
+
+        self.combined = []      # (compiled regex, patterns)
+        for start in range(0, len(self.unprefixed), self.GLOB_CHUNK):
+            chunk = self.unprefixed[start:start + self.GLOB_CHUNK]
+            self.combined.append((re.compile('|'.join(
+                '(?P<_%i>%s)' % (i, glob_regex(pattern))
+                for i, pattern in enumerate(chunk)), re.S | re.M), chunk))
+        self.matched = set()
+        return
+
+    def filter(self, names):
+        """
+        Return the names in 'names' matching any of the globs, in their
+        original order. Every glob which matched is added to self.matched.
+        """
+        sorted_names = sorted(names)
+        name_set = set(sorted_names)
+        hits = set()
+
+        for pattern in self.literals:
+            if pattern in name_set:
+                hits.add(pattern)
+                self.matched.add(pattern)
+
+        for prefix, regex, pattern in self.prefixed:
+            index = bisect.bisect_left(sorted_names, prefix)
+            while index < len(sorted_names) and \
+                    sorted_names[index].startswith(prefix):
+                if regex.match(sorted_names[index]):
+                    hits.add(sorted_names[index])
+                    self.matched.add(pattern)
+                index += 1
+
+        if self.combined:
+            combined_hits = []
+            for name in sorted_names:
+                for regex, chunk in self.combined:
+                    found = regex.match(name)
+                    if found:
+                        combined_hits.append(name)
+                        self.matched.add(chunk[int(found.lastgroup[1:])])
+                        break
+            hits.update(combined_hits)
+
+            # A glob may only have matched names an earlier one claimed:
+            for pattern in self.unprefixed:
+                if pattern not in self.matched:
+                    regex = re.compile(fnmatch.translate(pattern))
+                    if any(regex.match(name) for name in combined_hits):
+                        self.matched.add(pattern)
+
+        return [name for name in names if name in hits]
+
+    def unmatched(self):
+        """
+        The globs which haven't matched any name so far.
+        """
+        return [pattern for pattern in self.patterns
+                if pattern not in self.matched]
 
 #----------------------------------------------
 #                Functions:
@@ -51,6 +162,81 @@ def s3join(*args):
     return outstr
 
 
+def list_keys_sharded(bucket, prefix, boundaries, workers):
+    """
+    List all keys in 'bucket' starting with 'prefix', splitting the keyspace
+    into ranges at the key names given by 'boundaries'. Each range is listed
+    by a separate worker, starting at its lower boundary (via the listing
+    marker) and stopping once it passes its upper boundary. The ranges are
+    (lo, hi], so every key is listed exactly once; results are merged in key
+    order and de-duplicated.
+    """
+    from multiprocessing.pool import ThreadPool
+
+    bounds = sorted(set(boundaries))
+    ranges = zip([None] + bounds, bounds + [None])
+
+    def list_range(key_range):
+        lower, upper = key_range
+        keys = []
+        for key in bucket.list(prefix=prefix, marker=lower or ''):
+            if upper is not None and key.name > upper:
+                break
+            keys.append(key)
+        return keys
+
+    pool = ThreadPool(max(1, min(workers, len(ranges))))
+    try:
+        shards = pool.map(list_range, ranges)
+    finally:
+        pool.close()
+        pool.join()
+
+    seen = set()
+    merged = []
+    for shard in shards:
+        for key in shard:
+            if key.name not in seen:
+                seen.add(key.name)
+                merged.append(key)
+    return merged
+
+
+def quantile_boundaries(names, count):
+    """
+    Choose up to count-1 names, evenly spaced through the sorted list 'names',
+    to split it into 'count' similarly sized ranges.
+    """
+    names = sorted(names)
+    if count < 2 or not names:
+        return []
+    step = float(len(names)) / count
+    return sorted(set(names[int(i * step)] for i in range(1, count)))
+
+
+def charset_boundaries(prefix, charset, count):
+    """
+    Choose up to count-1 boundaries of the form '<prefix><char>' evenly
+    spaced through the sorted characters of 'charset'.
+    """
+    chars = sorted(set(charset))
+    if count < 2 or not chars:
+        return []
+    step = float(len(chars)) / count
+    return sorted(set(prefix + chars[int(i * step)] for i in range(1, count)))
+
+
+def glob_regex(pattern):
+    """
+    Translate the glob 'pattern' to a regex which can be embedded in a larger
+    one (fnmatch.translate appends flags, which must come first).
+    """
+    regex = fnmatch.translate(pattern)
+    if regex.endswith('\\Z(?ms)'):
+        regex = regex[:-len('(?ms)')]
+    return regex
+
+
 def get_print_fn(is_dryrun, is_verbose):
     """
     Called at init to get a verbose function, based on -v switch.
@@ -84,33 +270,160 @@ def get_print_fn(is_dryrun, is_verbose):
     return verbose
 
 
-def get_progress_fn(is_verbose, name):
+def format_bytes(size):
+    """
+    Format a byte count for people: 512B, 1.5KB, 3.0GB.
+    """
+    if size < 1024:
+        return '%iB' % size
+    for unit in ('KB', 'MB', 'GB'):
+        size /= 1024.0
+        if size < 1024 or unit == 'GB':
+            return '%.1f%s' % (size, unit)
+
+
+def hash_file(filepath):
     """
-    Utility function to print upload/download progress.
+    Return the (md5, sha256) hex digests of the file located at "filepath",
+    computed in one pass. Regular files are memory-mapped, so the digests
+    read the page cache directly instead of copying it into Python strings;
+    anything which can't be mapped is read into one reused buffer.
     """
-    def progress_fn(recv, total):
-        if is_verbose:
-            sys.stdout.write("\r%s: %i/%ib" % (name, recv, total))
-            sys.stdout.flush()
+    import mmap
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as afile:
+        size = os.fstat(afile.fileno()).st_size
+        try:
+            mapped = mmap.mmap(afile.fileno(), size, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            mapped = None
+        if mapped is not None:
+            try:
+                md5.update(mapped)
+                sha256.update(mapped)
+            finally:
+                mapped.close()
+        else:
+            buf = bytearray(HASH_BUFSIZE)
+            view = memoryview(buf)
+            length = afile.readinto(buf)
+            while length:
+                md5.update(view[:length])
+                sha256.update(view[:length])
+                length = afile.readinto(buf)
+    return md5.hexdigest(), sha256.hexdigest()
+
+
+def _file_key(filepath):
+    stat = os.stat(filepath)
+    return (os.path.realpath(filepath), stat.st_ino, stat.st_size,
+            stat.st_mtime)
+
+
+def _hash_entry(filepath):
+    """
+    hash_file for a process pool: returns (filepath, digests), with None
+    digests if the file can't be read.
+    """
+    try:
+        return filepath, hash_file(filepath)
+    except EnvironmentError:
+        return filepath, None
+
+
+def _cache_hashes(key, digests):
+    """
+    Cache the 'digests' of the file with 'key' (see _file_key) as the most
+    recently used, dropping the least recently used past HASH_CACHE_ENTRIES.
+    """
+    _HASHES.pop(key, None)
+    _HASHES[key] = digests
+    while len(_HASHES) > HASH_CACHE_ENTRIES:
+        _HASHES.popitem(last=False)
+    return
+
+
+def cached_hashes(filepath):
+    """
+    Return the (md5, sha256) of the file at "filepath", hashing it only if
+    it has changed (by inode, size or mtime) since it was last hashed.
+    """
+    key = _file_key(filepath)
+    digests = _HASHES.get(key)
+    if digests is None:
+        digests = hash_file(filepath)
+    _cache_hashes(key, digests)
+    return digests
+
+
+def hash_files(filepaths, processes=None):
+    """
+    Hash the files "filepaths" which aren't already hashed, in a pool of
+    "processes" (default: one per CPU) when there's enough to hash, so that
+    later get_file_md5/get_file_sha256/md5_matches calls for them are
+    lookups. Files which can't be read are left for those calls to report.
+    """
+    pending = []
+    pending_bytes = 0
+    for filepath in filepaths:
+        try:
+            key = _file_key(filepath)
+        except OSError:
+            continue
+        if key not in _HASHES:
+            pending.append((key, filepath))
+            pending_bytes += key[2]
+    if not pending:
+        return
+
+    import multiprocessing
+    processes = processes or multiprocessing.cpu_count()
+    if processes <= 1 or len(pending) <= 1 or pending_bytes < BULK_HASH_BYTES:
+        for key, filepath in pending:
+            _, digests = _hash_entry(filepath)
+            if digests is not None:
+                _cache_hashes(key, digests)
+        return
+
+    keys = dict((filepath, key) for key, filepath in pending)
+    pool = multiprocessing.Pool(min(processes, len(pending)))
+    try:
+        for filepath, digests in pool.imap_unordered(
+                _hash_entry, [job[1] for job in pending]):
+            if digests is not None:
+                _cache_hashes(keys[filepath], digests)
+    finally:
+        pool.close()
+        pool.join()
+    return
 
-            if recv >= total:
-                sys.stdout.write('\n')
-                sys.stdout.flush()
-    return progress_fn
+
+def set_file_mtime(filepath, mtime):
+    """
+    Set the atime and mtime of the file at "filepath" to "mtime", keeping
+    its cached hashes (the contents haven't changed).
+    """
+    old_key = _file_key(filepath)
+    os.utime(filepath, (mtime, mtime))
+    digests = _HASHES.pop(old_key, None)
+    if digests is not None:
+        _cache_hashes(_file_key(filepath), digests)
+    return
 
 
 def get_file_md5(filepath):
     """
     Generate an md5 checksum of the file located at "filepath"
     """
-    BLOCKSIZE = 65536
-    hasher = hashlib.md5()
-    with open(filepath, 'r') as afile:
-        buf = afile.read(BLOCKSIZE)
-        while len(buf) > 0:
-            hasher.update(buf)
-            buf = afile.read(BLOCKSIZE)
-    return hasher.hexdigest()
+    return cached_hashes(filepath)[0]
+
+
+def get_file_sha256(filepath):
+    """
+    Generate a sha256 checksum of the file located at "filepath"
+    """
+    return cached_hashes(filepath)[1]
 
 
 def get_s3item_md5(item):
@@ -172,4 +485,40 @@ def s3time_as_datetime(t_string):
     return stamp_s3
 
 
+def datetime_as_s3time(stamp):
+    """
+    Format the datetime given by *stamp* the same way an S3 bucket listing
+    formats its LastModified values, so that s3time_as_datetime can read it
+    back.
+    """
+    return stamp.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def json_to_gzip(obj):
+    """
+    Serialize *obj* as JSON and return the gzip-compressed bytes.
+    """
+    buf = StringIO.StringIO()
+    gz_file = gzip.GzipFile(fileobj=buf, mode='wb')
+    try:
+        json.dump(obj, gz_file, sort_keys=True, separators=(',', ':'))
+    finally:
+        gz_file.close()
+    return buf.getvalue()
+
+
+def gzip_to_json(data):
+    """
+    Inverse of json_to_gzip: decompress the bytes given by *data* and parse
+    them as JSON. Raises ValueError if the data is not valid gzip'd JSON.
+    """
+    gz_file = gzip.GzipFile(fileobj=StringIO.StringIO(data), mode='rb')
+    try:
+        return json.load(gz_file)
+    except IOError as ex:
+        raise ValueError(str(ex))
+    finally:
+        gz_file.close()
+
+
 # EOF
@@ -0,0 +1,201 @@
+#!python
+# -*- coding: utf-8 -*-
+#==============================================================================
+#
+# s3yum: Repo creation/maintenance tool for S3-based yum repos
+#
+# Copyright 2013-2019 The New York Times Company
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+
+"""s3yum.verify: Check that a repo's metadata agrees with its objects.
+
+Nothing is downloaded but repomd.xml and the primary metadata. Every package
+is checked against the bucket listing (missing, orphaned, size) and, where
+s3yum recorded one, the sha256 in the package manifest. A sample of packages
+(--sample, all if 0) is then checked with HEAD requests, which see the
+object's current size, ETag and stored sha256.
+"""
+
+#----------------
+#    Imports:
+#----------------
+import os
+import random
+import shutil
+import tempfile
+
+from s3yum import s3yum_cli
+from s3yum.s3yum_types import ServiceError
+from s3yum.engine import transfer_map
+from s3yum.metadata import (
+    repo_tag,
+    data_location,
+    parse_primary
+)
+from s3yum.util import (
+    s3join,
+    get_s3item_md5
+)
+
+
+#----------------------------------------------
+#                Functions:
+#----------------------------------------------
+def check_checksum(package, sha256):
+    """
+    Compare the sha256 recorded for a package's object with its metadata.
+    Returns a description of the mismatch, or None.
+    """
+    if sha256 and package['checksum_type'] == 'sha256' and \
+            sha256 != package['pkgid']:
+        return "sha256 %s, metadata says %s" % (sha256, package['pkgid'])
+    return None
+
+
+def compare_listing(path, packages, rpm_items, manifest=None):
+    """
+    Compare the packages from primary.xml with the listed rpm items. Returns
+    (missing, orphaned, mismatched, pairs): the names of packages without an
+    object, the objects without a package, (name, problem) tuples, and the
+    (package, item) pairs which were found.
+
+    The sha256s in 'manifest' are used for objects whose ETag is unchanged.
+    """
+    items_by_name = dict((item.name, item) for item in rpm_items)
+    checksums = {}
+    if manifest is not None:
+        for entry in manifest['packages']:
+            checksums[entry['name']] = (entry['etag'], entry.get('sha256'))
+
+    missing, mismatched, pairs = [], [], []
+    for package in packages:
+        name = s3join(path, package['location'])
+        item = items_by_name.pop(name, None)
+        if item is None:
+            missing.append(name)
+            continue
+        pairs.append((package, item))
+        if int(item.size) != package['size']:
+            mismatched.append((name, "size %s, metadata says %i" % (
+                item.size, package['size'])))
+            continue
+        etag, sha256 = checksums.get(name, (None, None))
+        if etag != get_s3item_md5(item):
+            continue
+        problem = check_checksum(package, sha256)
+        if problem:
+            mismatched.append((name, problem))
+    return missing, sorted(items_by_name), mismatched, pairs
+
+
+def head_check(bucket, pair):
+    """
+    Check one (package, listed item) pair with a HEAD request. Returns
+    (name, problem, has_checksum); problem is None if the object is fine.
+    """
+    package, item = pair
+    head = bucket.get_key(item.name)
+    if head is None:
+        return item.name, "deleted since it was listed", False
+    if int(head.size) != package['size']:
+        return item.name, "size %s, metadata says %i" % (
+            head.size, package['size']), False
+    if get_s3item_md5(head) != get_s3item_md5(item):
+        return item.name, "ETag %s, listing says %s" % (
+            get_s3item_md5(head), get_s3item_md5(item)), False
+    sha256 = head.get_metadata(
+        s3yum_cli.SHA256_HEADER[len('x-amz-meta-'):])
+    return item.name, check_checksum(package, sha256), bool(sha256)
+
+
+def check_metadata(context, entries):
+    """
+    Check that every metadata file repomd.xml references is in the listing,
+    with the size repomd.xml gives. Returns (name, problem) tuples.
+    """
+    items_by_name = dict(
+        (item.name, item) for item in context.s3_repodata_items)
+    problems = []
+    for data_type, data in sorted(entries.items()):
+        name = s3join(context.opts.path, data_location(data))
+        item = items_by_name.get(name)
+        size = data.findtext(repo_tag('size'))
+        if item is None:
+            problems.append((name, "missing %s metadata" % data_type))
+        elif size is not None and int(size) != int(item.size):
+            problems.append((name, "size %s, repomd.xml says %s" % (
+                item.size, size)))
+    return problems
+
+
+def run_verify(context):
+    """
+    Verify the repo, printing every problem found. Raises ServiceError if
+    there were any.
+    """
+    repodata_dir = tempfile.mkdtemp(prefix='s3yum-verify-')
+    try:
+        entries = s3yum_cli.download_published_repodata(
+            context, repodata_dir, ['primary'])
+        packages = parse_primary(os.path.join(
+            repodata_dir, os.path.basename(data_location(entries['primary']))))
+    finally:
+        shutil.rmtree(repodata_dir, True)
+
+    # The repo was listed from the bucket itself; the manifest only supplies
+    # checksums:
+    manifest = s3yum_cli.read_manifest(context)
+    missing, orphaned, mismatched, pairs = compare_listing(
+        context.opts.path, packages, context.s3_rpm_items, manifest)
+    mismatched += check_metadata(context, entries)
+
+    sample = pairs
+    if context.opts.sample and len(pairs) > context.opts.sample:
+        sample = random.sample(pairs, context.opts.sample)
+    s3yum_cli.verbose("Checking %i of %i packages with HEAD requests",
+                      len(sample), len(pairs))
+
+    results = transfer_map(
+        context, lambda pair: head_check(context.s3_bucket, pair), sample)
+    already = set(name for name, _ in mismatched)
+    unchecked = 0
+    for name, problem, has_checksum in results:
+        if problem:
+            if name not in already:
+                mismatched.append((name, problem))
+        elif not has_checksum:
+            unchecked += 1
+
+    for name in missing:
+        print "missing: %s" % name
+    for name in orphaned:
+        print "orphaned: %s" % name
+    for name, problem in sorted(mismatched):
+        print "mismatched: %s: %s" % (name, problem)
+    if unchecked:
+        s3yum_cli.verbose(
+            "%i sampled objects have no stored sha256; only their size and "
+            "ETag were checked", unchecked)
+
+    summary = "%s: %i packages, %i checked with HEAD requests: " \
+        "%i missing, %i orphaned, %i mismatched" % (
+            s3join(context.opts.bucket, context.opts.path), len(packages),
+            len(sample), len(missing), len(orphaned), len(mismatched))
+    if missing or orphaned or mismatched:
+        raise ServiceError("Verify failed for %s" % summary)
+    print "Verified %s" % summary
+    return
+
+# EOF
@@ -0,0 +1,268 @@
+#!python
+# -*- coding: utf-8 -*-
+#==============================================================================
+#
+# s3yum: Repo creation/maintenance tool for S3-based yum repos
+#
+# Copyright 2013-2019 The New York Times Company
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#==============================================================================
+
+"""s3yum.watch: Publish the rpm's dropped into a local directory.
+
+'watch DIRECTORY' keeps running, publishing every rpm which is written (or
+moved) into the directory. Completed files are queued with the daemon's
+batching: the first one opens a batch, which is published --batch-window
+seconds later along with everything else that arrived meanwhile. Between
+batches, the connection and working directory are kept, and the package
+manifest keeps each listing down to a single GET.
+
+On Linux, inotify reports files as soon as they are closed after writing or
+moved in. Writes made on other NFS clients don't raise inotify events, so
+the directory is also rescanned every --poll-interval seconds; a file found
+by a scan is queued once its size and mtime have stopped changing. rpm's
+already in the repo with the same size are not republished on startup, and
+the rpm's of a failed batch are retried by the next scan.
+"""
+
+#----------------
+#    Imports:
+#----------------
+import os
+import time
+import errno
+import shutil
+import select
+import struct
+import tempfile
+import threading
+
+from s3yum import s3yum_cli
+from s3yum.daemon import (
+    PublishDaemon,
+    PUBLISHED,
+    FAILED
+)
+from s3yum.s3yum_types import UserError
+
+#----------------------------------------------
+#                Constants:
+#----------------------------------------------
+IN_CLOEXEC = 02000000
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+EVENT_HEADER = struct.Struct('iIII')
+
+
+#----------------------------------------------
+#                 Classes:
+#----------------------------------------------
+class Inotify(object):
+
+    """
+    Minimal inotify watch (through ctypes) for completed files in a single
+    directory.
+    """
+
+    def __init__(self, dir_path):
+        """
+        Raises OSError if inotify isn't available.
+        """
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            init, add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "inotify is not supported")
+        self.fd = init(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if add_watch(self.fd, dir_path, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, "Unable to watch %s" % dir_path)
+        return
+
+    def read(self, timeout):
+        """
+        Wait up to 'timeout' seconds for events. Returns the names of the
+        files which were completed, or None if events were lost.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 65536)
+        names = []
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            if mask & IN_Q_OVERFLOW:
+                return None
+            names.append(data[offset:offset + length].rstrip('\0'))
+            offset += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+        return
+
+
+class DropWatcher(object):
+
+    """
+    Finds completed rpm's in a drop directory, and queues them with a
+    PublishDaemon.
+    """
+
+    def __init__(self, daemon, drop_dir, published_items=()):
+        """
+        Local rpm's matching 'published_items' (the repo's rpm items) by
+        name and size are taken to be published already.
+        """
+        self.daemon = daemon
+        self.drop_dir = drop_dir
+        self.seen = {}          # filename -> (size, mtime) queued/published
+        self.pending = {}       # filename -> (size, mtime) at the last scan
+        self.batches = {}       # batch id -> [(filename, (size, mtime))]
+
+        sizes = dict((os.path.basename(item.name), int(item.size))
+                     for item in published_items)
+        for filename, signature in self.candidates():
+            if sizes.get(filename) == signature[0]:
+                self.seen[filename] = signature
+        return
+
+    def candidates(self, filenames=None):
+        """
+        Yield (filename, (size, mtime)) for the rpm's in the drop directory
+        (or just 'filenames').
+        """
+        if filenames is None:
+            filenames = os.listdir(self.drop_dir)
+        for filename in filenames:
+            # Skip anything still being written under a temporary name:
+            if not filename.endswith('.rpm') or filename.startswith('.'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.drop_dir, filename))
+            except OSError:
+                continue
+            yield filename, (stat.st_size, stat.st_mtime)
+        return
+
+    def scan(self, completed=None):
+        """
+        Queue the new and changed rpm's: those in 'completed' (which are known
+        to be written), or, for a scan of the whole directory, those whose
+        size and mtime haven't changed since the last scan.
+        """
+        queued = 0
+        for filename, signature in self.candidates(completed):
+            if self.seen.get(filename) == signature:
+                continue
+            if completed is None and \
+                    self.pending.get(filename) != signature:
+                self.pending[filename] = signature
+                continue
+            self.pending.pop(filename, None)
+            self.seen[filename] = signature
+            batch_id = self.daemon.queue_file(
+                os.path.join(self.drop_dir, filename))
+            self.batches.setdefault(batch_id, []).append(
+                (filename, signature))
+            queued += 1
+        return queued
+
+    def check_batches(self):
+        """
+        Forget the rpm's of failed batches, so that they're queued again.
+        """
+        for batch_id, queued in self.batches.items():
+            status = self.daemon.status(batch_id)['status']
+            if status == FAILED:
+                for filename, signature in queued:
+                    if self.seen.get(filename) == signature:
+                        # Complete already; the next scan can queue it:
+                        del self.seen[filename]
+                        self.pending[filename] = signature
+            if status in (PUBLISHED, FAILED):
+                del self.batches[batch_id]
+        return
+
+    def run(self, poll_interval, inotify=None, stop=None):
+        """
+        Watch until 'stop' (a threading.Event) is set, or forever.
+        """
+        next_scan = 0
+        while stop is None or not stop.is_set():
+            if time.time() >= next_scan:
+                self.scan()
+                next_scan = time.time() + poll_interval
+            timeout = max(0, min(next_scan - time.time(), 1.0))
+            if inotify is not None:
+                completed = inotify.read(timeout)
+                if completed is None:
+                    next_scan = 0
+                elif completed:
+                    self.scan(completed)
+            else:
+                time.sleep(timeout)
+            self.check_batches()
+        return
+
+
+#----------------------------------------------
+#                Functions:
+#----------------------------------------------
+def run_watch(context):
+    """
+    Publish the rpm's dropped into the watched directory until interrupted.
+    """
+    drop_dir = os.path.abspath(context.rpm_args[0])
+    if not os.path.isdir(drop_dir):
+        raise UserError("Not a directory: %s" % drop_dir)
+    context.rpm_args = []
+
+    # Dropped rpm's are published in place; nothing is spooled:
+    spool_dir = tempfile.mkdtemp(prefix='s3yum-spool-')
+    daemon = PublishDaemon(context, spool_dir, context.opts.batch_window)
+    watcher = DropWatcher(daemon, drop_dir, context.s3_rpm_items)
+    try:
+        inotify = Inotify(drop_dir)
+    except OSError as ex:
+        s3yum_cli.verbose("Not using inotify (%s); polling every %is",
+                          ex.strerror, context.opts.poll_interval)
+        inotify = None
+
+    worker = threading.Thread(target=daemon.run, name='s3yum-publish')
+    worker.start()
+    print "Publishing rpm's dropped into %s to %s in %s" % (
+        drop_dir, context.opts.path, context.opts.bucket)
+    try:
+        watcher.run(context.opts.poll_interval, inotify)
+    except KeyboardInterrupt:
+        print "Shutting down, publishing any queued rpm's.."
+    finally:
+        if inotify is not None:
+            inotify.close()
+        daemon.stop()
+        worker.join()
+        shutil.rmtree(spool_dir, True)
+    return
+
+# EOF
@@ -1,4 +1,5 @@
 import os
+import re
 import sys
 
 # Make sure we have setuptools:
@@ -16,11 +17,15 @@ try:
 except:
     commit_info = "n/a"
 
+# Get the version from the package, without importing it:
+with open(os.path.join(os.path.dirname(__file__), 's3yum', '__init__.py')) as f:
+    VERSION = re.search(r"^__version__ = '([^']+)'", f.read(), re.M).group(1)
+
 DESCRIPTION = "Command line utility for managing yum repos in Amazon S3"
 setup(
     # Metadata:
     name="s3yum",
-    version="1.6.4",
+    version=VERSION,
     url="https://github.com/NYTimes/s3yum",
     author="New York Times Digital",
     author_email="code@nytimes.com",
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+
+"""
+Test module for s3yum.batch
+"""
+
+import logging
+import unittest
+import sys
+import os
+import json
+import shutil
+import tempfile
+import optparse
+import multiprocessing
+from mock import (
+    MagicMock,
+    patch,
+    )
+
+from s3yum.s3yum_types import (
+    S3YumContext,
+    UserError,
+    ServiceError,
+    )
+from s3yum.s3yum_cli import run_createrepo
+from s3yum.engine import transfer_map
+from s3yum.batch import (
+    load_batch_manifest,
+    plan_uploads,
+    transfer_rpm,
+    record_published,
+    )
+
+
+class TestS3YumBatch(unittest.TestCase):
+    """
+    Test multi-repo batch updates
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.rpm_path = os.path.join(self.tmp_dir, 'a-1.0-1.noarch.rpm')
+        with open(self.rpm_path, 'w') as rpm_file:
+            rpm_file.write('rpm')
+        self.patch = patch('s3yum.s3yum_cli.verbose', MagicMock())
+        self.patch.start()
+        return
+
+    def tearDown(self):
+        self.patch.stop()
+        shutil.rmtree(self.tmp_dir)
+        return
+
+    def write_manifest(self, manifest):
+        filename = os.path.join(self.tmp_dir, 'batch.json')
+        with open(filename, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        return filename
+
+    def make_repo(self, path, bucket):
+        repo = S3YumContext()
+        repo.opts = optparse.Values({
+            'path': path, 'dry_run': False, 'force_upload': False,
+            'no_cache_headers': True})
+        repo.rpm_args = [self.rpm_path]
+        repo.s3_rpm_items = []
+        repo.s3_bucket = bucket
+        return repo
+
+    def test_manifest(self):
+        """
+        Batch: manifests are normalized and validated
+        """
+        entries = load_batch_manifest(self.write_manifest({'repos': [
+            {'path': '/el7/stable', 'add': ['*.rpm']},
+            {'path': 'el7/testing', 'remove': ['*/a-*']}]}))
+        self.assertEqual(entries, [
+            {'path': 'el7/stable', 'add': ['*.rpm'], 'remove': []},
+            {'path': 'el7/testing', 'add': [], 'remove': ['*/a-*']}])
+
+        self.assertRaises(UserError, load_batch_manifest,
+                          self.write_manifest([]))
+        self.assertRaises(UserError, load_batch_manifest,
+                          self.write_manifest([{'add': ['*.rpm']}]))
+        self.assertRaises(UserError, load_batch_manifest,
+                          self.write_manifest([{'path': 'a'}, {'path': 'a'}]))
+        return
+
+    def test_shared_upload(self):
+        """
+        Batch: an rpm added to several repos is uploaded once, then copied
+        """
+        bucket = MagicMock()
+        bucket.name = 'bucket'
+        repos = [self.make_repo(path, bucket) for path in ('a', 'b', 'c')]
+        uploads = plan_uploads(repos)
+        self.assertEqual(len(uploads), 1)
+        self.assertEqual(uploads[0][1], repos)
+
+        with patch('boto.s3.key.Key.set_contents_from_filename') as upload:
+            record_published([transfer_rpm(uploads[0])])
+        self.assertEqual(upload.call_count, 1)
+        self.assertEqual(bucket.copy_key.call_count, 2)
+        bucket.copy_key.assert_any_call(
+            'c/a-1.0-1.noarch.rpm', 'bucket', 'a/a-1.0-1.noarch.rpm')
+
+        # Every repo's listing now includes the rpm, so it isn't re-uploaded:
+        self.assertEqual(plan_uploads(repos), [])
+        return
+
+    def test_concurrent_transfers(self):
+        """
+        Batch: rpm's transferred concurrently to the same repos all end up
+        in every repo's listing
+        """
+        bucket = MagicMock()
+        bucket.name = 'bucket'
+        repos = [self.make_repo(path, bucket) for path in ('a', 'b', 'c')]
+        for repo in repos:
+            repo.rpm_args = []
+            for index in range(20):
+                rpm_path = os.path.join(self.tmp_dir, 'p%i-1.0-1.rpm' % index)
+                with open(rpm_path, 'w') as rpm_file:
+                    rpm_file.write('rpm %i' % index)
+                repo.rpm_args.append(rpm_path)
+
+        context = S3YumContext()
+        context.opts = optparse.Values({'engine': 'threads', 'workers': 8})
+        uploads = plan_uploads(repos)
+        self.assertEqual(len(uploads), 20)
+        with patch('boto.s3.key.Key.set_contents_from_filename') as upload:
+            record_published(transfer_map(context, transfer_rpm, uploads))
+        self.assertEqual(upload.call_count, 20)
+        for repo in repos:
+            self.assertEqual(len(repo.s3_rpm_items), 20)
+        self.assertEqual(plan_uploads(repos), [])
+        return
+
+    def test_failed_createrepo(self):
+        """
+        Batch: a createrepo failing in a worker process fails the batch
+        rather than hanging it
+        """
+        procs = multiprocessing.Pool(1)
+        try:
+            result = procs.map_async(
+                run_createrepo, [[os.path.join(self.tmp_dir, 'createrepo')]])
+            self.assertRaises(ServiceError, result.get, 30)
+        finally:
+            procs.terminate()
+            procs.join()
+        return
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr)
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
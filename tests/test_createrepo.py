@@ -0,0 +1,164 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+
+"""
+Test module for s3yum metadata generation with createrepo
+"""
+
+import os
+import shutil
+import hashlib
+import logging
+import unittest
+import tempfile
+import optparse
+import sys
+from mock import (
+    MagicMock,
+    patch,
+    )
+
+from s3yum.s3yum_types import (
+    S3YumContext,
+    UserError
+)
+from s3yum.s3yum_cli import (
+    createrepo_args,
+    prepare_repodata,
+    metadata_compressions,
+    compress_repodata
+)
+from s3yum.metadata import (
+    repomd_data,
+    data_location,
+    parse_primary,
+    open_metadata
+)
+from test_metadata import make_repodata
+
+
+class TestS3YumCreaterepo(unittest.TestCase):
+    """
+    Test the createrepo command line, and reuse of the old repodata
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.context = S3YumContext()
+        self.context.working_dir = self.tmp_dir
+        self.context.working_dir_repodata = os.path.join(
+            self.tmp_dir, 'repodata')
+        self.context.opts = optparse.Values({
+            'createrepo_workers': None,
+            'no_createrepo_update': False,
+            'cachedir': os.path.join(self.tmp_dir, 'cache'),
+            'no_cachedir': False,
+            'zchunk': False,
+            'sqlite': False,
+            'compression': None,
+        })
+        return
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        return
+
+    def test_args(self):
+        """
+        Createrepo: workers, --update and the cachedir are passed
+        """
+        with patch('multiprocessing.cpu_count', MagicMock(return_value=6)):
+            args = createrepo_args(self.context)
+        self.assertEqual(args[1:], [
+            '--workers', '6', '--update',
+            '--cachedir', os.path.join(self.tmp_dir, 'cache'), self.tmp_dir])
+        self.assertTrue(os.path.isdir(os.path.join(self.tmp_dir, 'cache')))
+
+        self.context.opts.createrepo_workers = 2
+        self.context.opts.no_createrepo_update = True
+        self.context.opts.no_cachedir = True
+        self.assertEqual(createrepo_args(self.context)[1:],
+                         ['--workers', '2', self.tmp_dir])
+
+        self.context.opts.zchunk = True
+        self.assertEqual(createrepo_args(self.context)[1:],
+                         ['--workers', '2', '--zck', self.tmp_dir])
+        return
+
+    def test_compression_option(self):
+        """
+        Createrepo: --compression sets all package metadata, or each type
+        """
+        self.assertEqual(metadata_compressions(self.context), {})
+        self.context.opts.compression = 'zstd'
+        self.assertEqual(metadata_compressions(self.context), {
+            'primary': 'zstd', 'filelists': 'zstd', 'other': 'zstd'})
+        self.context.opts.compression = 'filelists=xz, other=zstd'
+        self.assertEqual(metadata_compressions(self.context), {
+            'filelists': 'xz', 'other': 'zstd'})
+        for bad in ('lz4', 'primary=lz4', 'group=gz'):
+            self.context.opts.compression = bad
+            self.assertRaises(UserError, metadata_compressions, self.context)
+        return
+
+    def test_compress_repodata(self):
+        """
+        Createrepo: metadata is recompressed, and repomd.xml updated
+        """
+        repodata_dir = self.context.working_dir_repodata
+        os.makedirs(repodata_dir)
+        make_repodata(repodata_dir)
+        self.context.opts.compression = 'primary=bz2,filelists=zstd,other=xz'
+        with patch('s3yum.s3yum_cli.verbose', MagicMock()):
+            compress_repodata(self.context)
+
+        _, entries = repomd_data(repodata_dir)
+        for data_type, extension in (('primary', '.bz2'),
+                                     ('filelists', '.zst'),
+                                     ('other', '.xz')):
+            location = data_location(entries[data_type])
+            self.assertTrue(location.endswith('-%s.xml%s' % (
+                data_type, extension)))
+            filepath = os.path.join(repodata_dir, os.path.basename(location))
+            with open_metadata(filepath) as data_file:
+                self.assertIn('<?xml', data_file.read())
+        self.assertFalse(os.path.exists(
+            os.path.join(repodata_dir, 'primary.xml.gz')))
+        self.assertEqual(len(parse_primary(os.path.join(
+            repodata_dir, os.path.basename(
+                data_location(entries['primary']))))), 2)
+        return
+
+    def test_reuse_repodata(self):
+        """
+        Createrepo: old repodata is kept, with the mtimes of unchanged rpm's
+        restored; a same-size replacement keeps its own
+        """
+        os.makedirs(self.context.working_dir_repodata)
+        make_repodata(self.context.working_dir_repodata, [
+            {'name': 'foo', 'ver': '1.0', 'pkgid': 'a' * 64, 'time': 100},
+            {'name': 'foo', 'ver': '1.1',
+             'pkgid': hashlib.sha256('x' * 1024).hexdigest(), 'time': 200},
+        ])
+        rpm_path = os.path.join(self.tmp_dir, 'foo-1.1-1.x86_64.rpm')
+        resigned_path = os.path.join(self.tmp_dir, 'foo-1.0-1.x86_64.rpm')
+        for path in (rpm_path, resigned_path):
+            with open(path, 'w') as rpm:
+                rpm.write('x' * 1024)
+            os.utime(path, (300, 300))
+        with patch('s3yum.s3yum_cli.verbose', MagicMock()):
+            prepare_repodata(self.context)
+        self.assertEqual(os.path.getmtime(rpm_path), 200)
+        self.assertEqual(os.path.getmtime(resigned_path), 300)
+
+        self.context.opts.no_createrepo_update = True
+        with patch('s3yum.s3yum_cli.verbose', MagicMock()):
+            prepare_repodata(self.context)
+        self.assertFalse(os.path.exists(self.context.working_dir_repodata))
+        return
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr)
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+
+"""
+Test module for s3yum.daemon
+"""
+
+import logging
+import unittest
+import sys
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import optparse
+from mock import (
+    MagicMock,
+    patch,
+    )
+
+from s3yum.s3yum_types import (
+    S3YumContext,
+    ServiceError,
+    )
+from s3yum.daemon import (
+    PublishDaemon,
+    DaemonRequestHandler,
+    make_server,
+    submit_to_daemon,
+    )
+
+
+class TestS3YumDaemon(unittest.TestCase):
+    """
+    Test the s3yum publish daemon
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.context = S3YumContext()
+        self.context.opts = optparse.Values(
+            {'bucket': 'bucket', 'path': 'dev', 'remove': []})
+        self.context.working_dir = os.path.join(self.tmp_dir, 'work')
+        os.makedirs(self.context.working_dir)
+        self.spool_dir = os.path.join(self.tmp_dir, 'spool')
+        os.makedirs(self.spool_dir)
+
+        self.rpms = []
+        for name in ('a-1.0-1.noarch.rpm', 'b-1.0-1.noarch.rpm'):
+            rpm_path = os.path.join(self.tmp_dir, name)
+            with open(rpm_path, 'w') as rpm_file:
+                rpm_file.write('rpm ' + name)
+            self.rpms.append(rpm_path)
+
+        self.patches = [patch('s3yum.s3yum_cli.verbose', MagicMock())]
+        for p in self.patches:
+            p.start()
+        return
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        shutil.rmtree(self.tmp_dir)
+        return
+
+    def serve(self):
+        daemon = PublishDaemon(self.context, self.spool_dir, 0.2)
+        server = make_server('127.0.0.1:0', DaemonRequestHandler)
+        server.publish_daemon = daemon
+        threads = [threading.Thread(target=daemon.run),
+                   threading.Thread(target=server.serve_forever)]
+        for thread in threads:
+            thread.start()
+        url = 'http://127.0.0.1:%i' % server.server_address[1]
+
+        def stop():
+            server.shutdown()
+            server.server_close()
+            daemon.stop()
+            for thread in threads:
+                thread.join()
+        return url, stop
+
+    def test_coalesce(self):
+        """
+        Daemon: submissions within the batch window are published once
+        """
+        published = []
+
+        def publish_update(context):
+            published.append((sorted(context.rpm_args),
+                              list(context.opts.remove),
+                              [open(p).read() for p in context.rpm_args]))
+
+        with patch('s3yum.daemon.publish_update', publish_update):
+            url, stop = self.serve()
+            try:
+                submit_to_daemon(url, self.rpms, ['*c-*'], 0.05)
+            finally:
+                stop()
+
+        self.assertEqual(len(published), 1)
+        rpm_args, removes, contents = published[0]
+        self.assertEqual([os.path.basename(p) for p in rpm_args],
+                         [os.path.basename(p) for p in self.rpms])
+        self.assertEqual(removes, ['*c-*'])
+        self.assertEqual(contents, ['rpm a-1.0-1.noarch.rpm',
+                                    'rpm b-1.0-1.noarch.rpm'])
+        # Spooled files are cleaned up after publishing:
+        self.assertEqual(os.listdir(self.spool_dir), [])
+        return
+
+    def test_failed_batch(self):
+        """
+        Daemon: a failed publish is reported to the submitter
+        """
+        def publish_update(context):
+            raise ServiceError('createrepo exploded')
+
+        with patch('s3yum.daemon.publish_update', publish_update):
+            url, stop = self.serve()
+            try:
+                self.assertRaises(ServiceError, submit_to_daemon,
+                                  url, self.rpms[:1], [], 0.05)
+            finally:
+                stop()
+        return
+
+    def test_bad_upload(self):
+        """
+        Daemon: a truncated or malformed upload gets a 400, and leaves
+        nothing spooled
+        """
+        url, stop = self.serve()
+        try:
+            host, port = url[len('http://'):].split(':')
+            for length in ('100', 'lots'):
+                sock = socket.create_connection((host, int(port)))
+                sock.sendall('PUT /rpms/a-1.0-1.noarch.rpm HTTP/1.0\r\n'
+                             'Content-Length: %s\r\n\r\nshort' % length)
+                sock.shutdown(socket.SHUT_WR)
+                response = sock.makefile().read()
+                sock.close()
+                self.assertTrue(response.startswith('HTTP/1.0 400'), response)
+        finally:
+            stop()
+        self.assertEqual(os.listdir(self.spool_dir), [])
+        return
+
+    def test_lost_batch(self):
+        """
+        Daemon: the submitter gives up on a batch the daemon doesn't know,
+        one from before a restart, or one not published in time
+        """
+        queued = {'batch': 1, 'status': 'queued', 'instance': 'one'}
+        for status in (
+                {'batch': 1, 'status': None, 'instance': 'one'},
+                {'batch': 1, 'status': 'published', 'instance': 'two'},
+                queued):
+            with patch('s3yum.daemon.daemon_request',
+                       MagicMock(side_effect=[queued, status])):
+                self.assertRaises(ServiceError, submit_to_daemon,
+                                  'http://daemon', self.rpms[:1], [], 0, 0)
+        return
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr)
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,226 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+
+"""
+Test module for s3yum delta rpm generation
+"""
+
+import os
+import gzip
+import time
+import shutil
+import logging
+import unittest
+import tempfile
+import optparse
+import sys
+from multiprocessing.pool import ThreadPool
+from mock import (
+    MagicMock,
+    patch,
+    )
+
+from s3yum.s3yum_types import (
+    S3YumContext,
+    ServiceError
+)
+from s3yum.util import json_to_gzip
+from s3yum.metadata import (
+    repomd_data,
+    data_location
+)
+from s3yum.deltas import (
+    plan_deltas,
+    delta_key,
+    delta_filename,
+    build_deltas,
+    make_deltas
+)
+from test_metadata import make_repodata
+
+
+def package(name, version, pkgid):
+    return {'name': name, 'epoch': '0', 'version': version, 'release': '1',
+            'arch': 'x86_64', 'pkgid': pkgid, 'size': 1024,
+            'location': '%s-%s-1.x86_64.rpm' % (name, version)}
+
+
+def s3item(name):
+    item = MagicMock()
+    item.name = name
+    return item
+
+
+class TestS3YumDeltas(unittest.TestCase):
+    """
+    Test choosing, reusing and retiring delta rpm's
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.context = S3YumContext()
+        self.context.working_dir = self.tmp_dir
+        self.context.working_dir_repodata = os.path.join(
+            self.tmp_dir, 'repodata')
+        os.makedirs(self.context.working_dir_repodata)
+        make_repodata(self.context.working_dir_repodata)
+        for version in ('1.0', '1.1'):
+            open(os.path.join(
+                self.tmp_dir, 'foo-%s-1.x86_64.rpm' % version), 'w').close()
+        self.context.opts = optparse.Values({
+            'path': 'repo',
+            'num_deltas': 1,
+            'metadata_grace': 3600,
+            'dry_run': True,
+        })
+        self.context.s3_bucket = MagicMock()
+        self.context.s3_bucket.get_key.return_value = None
+        self.context.s3_bucket.list.return_value = []
+        self.patch = patch('s3yum.s3yum_cli.verbose', MagicMock())
+        self.patch.start()
+        return
+
+    def tearDown(self):
+        self.patch.stop()
+        shutil.rmtree(self.tmp_dir)
+        return
+
+    def set_index(self, index):
+        index_key = MagicMock()
+        index_key.get_contents_as_string.return_value = json_to_gzip(index)
+        self.context.s3_bucket.get_key.return_value = index_key
+        return
+
+    def prestodelta(self):
+        _, entries = repomd_data(self.context.working_dir_repodata)
+        path = os.path.join(self.context.working_dir_repodata,
+                            os.path.basename(data_location(
+                                entries['prestodelta'])))
+        return gzip.open(path).read()
+
+    def test_plan(self):
+        """
+        Deltas: the previous num_deltas versions of each package, to the newest
+        """
+        packages = [package('foo', '1.0', 'a'), package('foo', '1.10', 'c'),
+                    package('foo', '1.2', 'b'), package('bar', '2.0', 'd')]
+        self.assertEqual(
+            [(old['pkgid'], new['pkgid'])
+             for old, new in plan_deltas(packages, 2)],
+            [('b', 'c'), ('a', 'c')])
+        self.assertEqual(
+            [(old['pkgid'], new['pkgid'])
+             for old, new in plan_deltas(packages, 1)], [('b', 'c')])
+        self.assertEqual(
+            delta_filename(packages[0], packages[1]),
+            'drpms/foo-1.0-1_1.10-1.x86_64.drpm')
+        return
+
+    def test_build(self):
+        """
+        Deltas: missing deltas are built, uploaded and put in prestodelta
+        """
+        key = delta_key({'pkgid': 'a' * 64}, {'pkgid': 'b' * 64})
+        built = {key: {'filename': 'drpms/foo-1.0-1_1.1-1.x86_64.drpm',
+                       'sequence': 'seq', 'size': 100, 'checksum': 'c' * 64}}
+        with patch('s3yum.deltas.build_deltas',
+                   MagicMock(return_value=built)) as build_deltas, \
+                patch('s3yum.s3yum_cli.upload_directory') as upload:
+            make_deltas(self.context)
+        jobs = build_deltas.call_args[0][1]
+        self.assertEqual([job[0] for job in jobs], [key])
+        self.assertTrue(upload.called)
+        prestodelta = self.prestodelta()
+        self.assertIn('<filename>drpms/foo-1.0-1_1.1-1.x86_64.drpm'
+                      '</filename>', prestodelta)
+        self.assertIn('oldversion="1.0"', prestodelta)
+        return
+
+    def test_failed_build(self):
+        """
+        Deltas: a makedeltarpm failing in a worker process fails the publish
+        rather than hanging it
+        """
+        self.context.opts.createrepo_workers = 1
+        jobs = [('key', package('foo', '1.0', 'a'), package('foo', '1.1', 'b'))]
+        # Run in a thread, so that a hung pool fails the test:
+        pool = ThreadPool(1)
+        try:
+            with patch('s3yum.deltas.MAKEDELTARPM',
+                       os.path.join(self.tmp_dir, 'makedeltarpm')):
+                result = pool.apply_async(build_deltas, (self.context, jobs))
+                self.assertRaises(ServiceError, result.get, 30)
+        finally:
+            pool.terminate()
+        return
+
+    def test_reuse(self):
+        """
+        Deltas: indexed deltas are reused; useless ones are not offered
+        """
+        key = delta_key({'pkgid': 'a' * 64}, {'pkgid': 'b' * 64})
+        self.set_index({key: {'useless': True}})
+        with patch('s3yum.deltas.build_deltas') as build_deltas:
+            make_deltas(self.context)
+        self.assertFalse(build_deltas.called)
+        self.assertNotIn('<delta', self.prestodelta())
+
+        name = 'drpms/foo-1.0-1_1.1-1.x86_64.drpm'
+        self.set_index({key: {'filename': name, 'sequence': 'seq',
+                              'size': 100, 'checksum': 'c' * 64}})
+        self.context.s3_bucket.list.return_value = [s3item('repo/' + name)]
+        with patch('s3yum.deltas.build_deltas') as build_deltas:
+            make_deltas(self.context)
+        self.assertFalse(build_deltas.called)
+        self.assertIn(name, self.prestodelta())
+        return
+
+    def test_missing_drpm(self):
+        """
+        Deltas: an indexed delta whose drpm is gone, and which can't be
+        rebuilt without the old rpm, is not offered
+        """
+        key = delta_key({'pkgid': 'a' * 64}, {'pkgid': 'b' * 64})
+        name = 'drpms/foo-1.0-1_1.1-1.x86_64.drpm'
+        self.set_index({key: {'filename': name, 'sequence': 'seq',
+                              'size': 100, 'checksum': 'c' * 64}})
+        os.remove(os.path.join(self.tmp_dir, 'foo-1.0-1.x86_64.rpm'))
+        with patch('s3yum.deltas.build_deltas') as build_deltas:
+            make_deltas(self.context)
+        self.assertFalse(build_deltas.called)
+        self.assertNotIn(name, self.prestodelta())
+        return
+
+    def test_retire(self):
+        """
+        Deltas: unused deltas are retired, then deleted after the grace period
+        """
+        key = delta_key({'pkgid': 'a' * 64}, {'pkgid': 'b' * 64})
+        name = 'drpms/foo-0.9-1_1.0-1.x86_64.drpm'
+        old = s3item('repo/' + name)
+        self.context.s3_bucket.list.return_value = [old]
+        entry = {'filename': name, 'sequence': 'seq', 'size': 100,
+                 'checksum': 'c' * 64}
+        index = {key: {'useless': True}, 'old_key': dict(entry)}
+
+        written = []
+        with patch('s3yum.deltas.write_delta_index',
+                   lambda context, index: written.append(index)), \
+                patch('s3yum.s3yum_cli.delete_items') as delete_items:
+            self.set_index(index)
+            make_deltas(self.context)
+            self.assertIn('retired', written[-1]['old_key'])
+            self.assertEqual(delete_items.call_args[0][1], [])
+
+            entry['retired'] = time.time() - 7200
+            self.set_index({key: {'useless': True}, 'old_key': entry})
+            make_deltas(self.context)
+            self.assertNotIn('old_key', written[-1])
+            self.assertEqual(delete_items.call_args[0][1], [old])
+        return
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr)
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
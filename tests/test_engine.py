@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+
+"""
+Test module for s3yum transfer engines
+"""
+
+import time
+import logging
+import unittest
+import optparse
+import threading
+import sys
+from mock import patch
+
+from s3yum.s3yum_types import (
+    S3YumContext,
+    UserError
+)
+from s3yum.engine import (
+    init_engine,
+    transfer_map,
+    transfer_width
+)
+
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+
+class TestS3YumEngine(unittest.TestCase):
+    """
+    Test running transfers with each engine
+    """
+
+    def setUp(self):
+        self.context = S3YumContext()
+        self.context.opts = optparse.Values({
+            'engine': 'threads',
+            'workers': 4,
+            'concurrency': 50,
+        })
+        return
+
+    def test_width(self):
+        """
+        Engine: --workers threads, or --concurrency greenlets
+        """
+        self.assertEqual(transfer_width(self.context, 100), 4)
+        self.assertEqual(transfer_width(self.context, 2), 2)
+        self.assertEqual(transfer_width(self.context, 0), 1)
+        self.context.opts.engine = 'gevent'
+        self.assertEqual(transfer_width(self.context, 100), 50)
+        return
+
+    def test_threads(self):
+        """
+        Engine: threads run jobs concurrently, returning results in order
+        """
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def job(i):
+            with lock:
+                running.append(i)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(i)
+            return i * 2
+
+        self.assertEqual(transfer_map(self.context, job, range(20)),
+                         [i * 2 for i in range(20)])
+        self.assertEqual(max(peak), 4)
+
+        def fail(i):
+            raise ValueError(i)
+        self.assertRaises(ValueError, transfer_map, self.context, fail,
+                          range(3))
+        return
+
+    def test_missing_gevent(self):
+        """
+        Engine: --engine gevent without gevent is a user error
+        """
+        self.context.opts.engine = 'gevent'
+        with patch.dict(sys.modules, {'gevent': None}):
+            self.assertRaises(UserError, init_engine, self.context)
+        return
+
+    @unittest.skipIf(gevent is None, "gevent is not installed")
+    def test_gevent(self):
+        """
+        Engine: gevent runs jobs in greenlets, returning results in order
+        """
+        self.context.opts.engine = 'gevent'
+        self.assertEqual(
+            transfer_map(self.context, lambda i: gevent.sleep(0.01) or i,
+                         range(100)), range(100))
+        return
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr)
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+
+"""
+Test module for s3yum.lock
+"""
+
+import logging
+import unittest
+import sys
+import hashlib
+import datetime
+from mock import (
+    MagicMock,
+    patch,
+    )
+import boto.exception
+
+from s3yum.s3yum_types import ServiceError
+from s3yum.lock import S3Lease
+
+
+class FakeBucket(object):
+    """
+    Just enough of an S3 bucket to honour conditional writes.
+    """
+
+    def __init__(self):
+        self.objects = {}   # name -> (body, etag, last_modified)
+
+    def put(self, name, body, headers):
+        current = self.objects.get(name)
+        if headers.get('If-None-Match') == '*' and current is not None:
+            raise boto.exception.S3ResponseError(412, 'Precondition Failed')
+        if 'If-Match' in headers and (
+                current is None or
+                '"%s"' % current[1] != headers['If-Match']):
+            raise boto.exception.S3ResponseError(412, 'Precondition Failed')
+        self.objects[name] = (body, hashlib.md5(body).hexdigest(),
+                              datetime.datetime.utcnow())
+
+    def age(self, name, seconds):
+        body, etag, stamp = self.objects[name]
+        self.objects[name] = (
+            body, etag, stamp - datetime.timedelta(seconds=seconds))
+
+    def get_key(self, name):
+        if name not in self.objects:
+            return None
+        body, etag, stamp = self.objects[name]
+        key = MagicMock()
+        key.md5 = None
+        key.etag = '"%s"' % etag
+        key.last_modified = stamp.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        key.get_contents_as_string.return_value = body
+        return key
+
+    def delete_key(self, name, headers=None):
+        self.objects.pop(name, None)
+
+
+def fake_key(bucket, name):
+    key = MagicMock()
+    key.set_contents_from_string.side_effect = \
+        lambda body, headers: bucket.put(name, body, headers)
+    return key
+
+
+class TestS3YumLock(unittest.TestCase):
+    """
+    Test the S3 lease
+    """
+
+    def setUp(self):
+        self.bucket = FakeBucket()
+        self.patch = patch('s3yum.lock.boto.s3.key.Key', fake_key)
+        self.patch.start()
+        return
+
+    def tearDown(self):
+        self.patch.stop()
+        return
+
+    def test_exclusive(self):
+        """
+        Lock: only one writer holds the lease; release frees it
+        """
+        first = S3Lease(self.bucket, 'dev/.s3yum-lock', 300, 'first')
+        second = S3Lease(self.bucket, 'dev/.s3yum-lock', 300, 'second')
+        self.assertTrue(first.try_acquire())
+        self.assertFalse(second.try_acquire())
+        first.release()
+        self.assertTrue(second.try_acquire())
+        return
+
+    def test_expired_takeover(self):
+        """
+        Lock: an expired lease is taken over, and the old holder loses it
+        """
+        first = S3Lease(self.bucket, 'dev/.s3yum-lock', 300, 'first')
+        second = S3Lease(self.bucket, 'dev/.s3yum-lock', 300, 'second')
+        self.assertTrue(first.try_acquire())
+        self.bucket.age('dev/.s3yum-lock', 301)
+        self.assertTrue(second.try_acquire())
+
+        first.renew()
+        self.assertTrue(first.lost)
+        self.assertRaises(ServiceError, first.check)
+
+        # Releasing a lost lease must not delete the new holder's lock:
+        first.release()
+        self.assertFalse(S3Lease(
+            self.bucket, 'dev/.s3yum-lock', 300, 'third').try_acquire())
+        return
+
+    def test_renew(self):
+        """
+        Lock: the holder can keep renewing its lease
+        """
+        lease = S3Lease(self.bucket, 'dev/.s3yum-lock', 300, 'first')
+        self.assertTrue(lease.try_acquire())
+        for _ in range(3):
+            lease.renew()
+            self.assertFalse(lease.lost)
+        return
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr)
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
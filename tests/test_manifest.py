@@ -0,0 +1,136 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+
+"""
+Test module for the s3yum package manifest
+"""
+
+import logging
+import unittest
+import sys
+import optparse
+from mock import (
+    MagicMock,
+    patch,
+    )
+
+from s3yum.s3yum_types import S3YumContext
+from s3yum.s3yum_cli import (
+    manifest_is_fresh,
+    manifest_items,
+    manifest_entry_from_item,
+    list_rpms,
+    list_shard_count,
+    )
+
+
+def mock_item(name, etag):
+    item = MagicMock()
+    item.name = name
+    item.md5 = None
+    item.etag = '"%s"' % etag
+    item.size = 1024
+    item.last_modified = '2015-07-08T14:50:48.000Z'
+    return item
+
+
+class TestS3YumManifest(unittest.TestCase):
+    """
+    Test s3yum package manifest functions
+    """
+
+    def setUp(self):
+        self.context = S3YumContext()
+        self.context.s3_repodata_path = 'dev/repodata'
+        self.context.s3_repodata_items = [
+            mock_item('dev/repodata/abc-primary.xml.gz', 'primary'),
+            mock_item('dev/repodata/repomd.xml', 'repomd'),
+            ]
+        return
+
+    def test_fresh(self):
+        """
+        Manifest: fresh if written for the published repomd.xml
+        """
+        manifest = {'repomd_etag': 'repomd', 'packages': []}
+        self.assertTrue(manifest_is_fresh(self.context, manifest))
+        return
+
+    def test_stale(self):
+        """
+        Manifest: stale if repomd.xml changed or is missing
+        """
+        manifest = {'repomd_etag': 'older', 'packages': []}
+        self.assertFalse(manifest_is_fresh(self.context, manifest))
+
+        self.context.s3_repodata_items = []
+        manifest = {'repomd_etag': 'repomd', 'packages': []}
+        self.assertFalse(manifest_is_fresh(self.context, manifest))
+        return
+
+    def test_round_trip(self):
+        """
+        Manifest: entries convert back to equivalent s3 items
+        """
+        item = mock_item('dev/foo-1.0-1.noarch.rpm', 'd41d8cd9')
+        manifest = {'packages': [manifest_entry_from_item(item, 'sha')]}
+        items = manifest_items(self.context, manifest)
+        self.assertEqual(len(items), 1)
+        self.assertEqual(items[0].name, item.name)
+        self.assertEqual(items[0].size, item.size)
+        self.assertEqual(items[0].etag, item.etag)
+        self.assertEqual(items[0].last_modified, item.last_modified)
+        return
+
+    def test_list_rpms(self):
+        """
+        Listing: without a manifest, rpm's come from the bucket listing,
+        sharded or not, leaving out the inbox and other files
+        """
+        names = [
+            'dev/.s3yum-inbox/new-1.0-1.noarch.rpm',
+            'dev/bar-1.0-1.noarch.rpm',
+            'dev/drpms/bar-0.9-1_1.0-1.noarch.drpm',
+            'dev/foo-1.0-1.noarch.rpm',
+            'dev/repodata/repomd.xml',
+            'dev/zap-1.0-1.noarch.rpm',
+            ]
+        bucket = MagicMock()
+        bucket.list.side_effect = lambda prefix='', marker='': [
+            mock_item(name, name) for name in names
+            if name.startswith(prefix) and name > marker]
+        self.context.s3_bucket = bucket
+        self.context.opts = optparse.Values({
+            'path': 'dev', 'no_manifest': True, 'workers': 4})
+        with patch('s3yum.s3yum_cli.verbose', MagicMock()):
+            for shards in (1, 4):
+                self.context.opts.list_shards = shards
+                list_rpms(self.context)
+                self.assertEqual(
+                    [item.name for item in self.context.s3_rpm_items],
+                    ['dev/bar-1.0-1.noarch.rpm', 'dev/foo-1.0-1.noarch.rpm',
+                     'dev/zap-1.0-1.noarch.rpm'])
+        return
+
+    def test_shard_count(self):
+        """
+        Listing: only repos a stale manifest shows to be large are sharded,
+        unless --list-shards is given
+        """
+        self.context.opts = optparse.Values({'list_shards': None})
+        self.assertEqual(list_shard_count(self.context), 1)
+        self.assertEqual(list_shard_count(
+            self.context, {'packages': [{}] * 12}), 1)
+        self.assertEqual(list_shard_count(
+            self.context, {'packages': [{}] * 45000}), 4)
+        self.assertEqual(list_shard_count(
+            self.context, {'packages': [{}] * 900000}), 16)
+        self.context.opts.list_shards = 8
+        self.assertEqual(list_shard_count(self.context), 8)
+        return
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr)
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+
+"""
+Test module for s3yum yum metadata functions
+"""
+
+import os
+import gzip
+import shutil
+import logging
+import unittest
+import tempfile
+import sys
+
+from s3yum.metadata import (
+    rpmvercmp,
+    compare_evr,
+    repomd_data,
+    data_location,
+    parse_primary,
+    filter_repodata,
+    file_checksum,
+    open_metadata
+)
+
+PACKAGE_XML = """<package type="rpm">
+  <name>%(name)s</name>
+  <arch>x86_64</arch>
+  <version epoch="0" ver="%(ver)s" rel="1"/>
+  <checksum type="sha256" pkgid="YES">%(pkgid)s</checksum>
+  <location href="%(name)s-%(ver)s-1.x86_64.rpm"/>
+  <size package="1024" installed="2048" archive="2100"/>
+  <time file="%(time)s" build="%(time)s"/>
+  <format>
+    <rpm:provides><rpm:entry name="%(name)s" flags="EQ" ver="%(ver)s"/>
+    </rpm:provides>
+    <rpm:requires><rpm:entry name="libc.so.6()(64bit)"/></rpm:requires>
+    <file>/usr/bin/%(name)s</file>
+  </format>
+</package>
+"""
+
+PRIMARY_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<metadata xmlns="http://linux.duke.edu/metadata/common"
+          xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="%i">
+%s</metadata>
+"""
+
+PKGID_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<%(root)s xmlns="http://linux.duke.edu/metadata/%(ns)s" packages="%(count)i">
+%(packages)s</%(root)s>
+"""
+
+REPOMD_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<repomd xmlns="http://linux.duke.edu/metadata/repo">
+  <revision>1</revision>
+  <data type="primary">
+    <checksum type="sha256">x</checksum>
+    <location href="repodata/primary.xml.gz"/>
+  </data>
+  <data type="filelists">
+    <checksum type="sha256">x</checksum>
+    <location href="repodata/filelists.xml.gz"/>
+  </data>
+  <data type="other">
+    <checksum type="sha256">x</checksum>
+    <location href="repodata/other.xml.gz"/>
+  </data>
+  <data type="primary_db">
+    <checksum type="sha256">x</checksum>
+    <location href="repodata/primary.sqlite.bz2"/>
+  </data>
+  <data type="group">
+    <checksum type="sha256">x</checksum>
+    <location href="repodata/comps.xml"/>
+  </data>
+</repomd>
+"""
+
+PACKAGES = [
+    {'name': 'foo', 'ver': '1.0', 'pkgid': 'a' * 64, 'time': 100},
+    {'name': 'foo', 'ver': '1.1', 'pkgid': 'b' * 64, 'time': 200},
+]
+
+
+def write_gzip(filepath, text):
+    gz_file = gzip.GzipFile(filepath, 'wb')
+    gz_file.write(text)
+    gz_file.close()
+    return
+
+
+def make_repodata(repodata_dir, packages=PACKAGES):
+    """
+    Write a minimal createrepo-style repodata folder with 'packages'.
+    """
+    write_gzip(os.path.join(repodata_dir, 'primary.xml.gz'), PRIMARY_XML % (
+        len(packages), ''.join(PACKAGE_XML % p for p in packages)))
+    for data_type, root, tag in (('filelists', 'filelists', 'file'),
+                                 ('other', 'otherdata', 'changelog')):
+        elems = ''.join(
+            '<package pkgid="%s" name="foo" arch="x86_64"><%s>x</%s>'
+            '</package>\n' % (p['pkgid'], tag, tag) for p in packages)
+        write_gzip(os.path.join(repodata_dir, '%s.xml.gz' % data_type),
+                   PKGID_XML % {'root': root, 'ns': data_type,
+                                'count': len(packages),
+                                'packages': elems})
+    with open(os.path.join(repodata_dir, 'comps.xml'), 'w') as comps:
+        comps.write('<comps/>')
+    with open(os.path.join(repodata_dir, 'repomd.xml'), 'w') as repomd:
+        repomd.write(REPOMD_XML)
+    return
+
+
+class TestS3YumMetadata(unittest.TestCase):
+    """
+    Test reading and rewriting yum metadata
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src_dir = os.path.join(self.tmp_dir, 'src')
+        self.dest_dir = os.path.join(self.tmp_dir, 'dest')
+        os.makedirs(self.src_dir)
+        make_repodata(self.src_dir)
+        return
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        return
+
+    def test_rpmvercmp(self):
+        """
+        Metadata: versions compare like rpm
+        """
+        self.assertEqual(rpmvercmp('1.10', '1.9'), 1)
+        self.assertEqual(rpmvercmp('1.0', '1.0.1'), -1)
+        self.assertEqual(rpmvercmp('1.0a', '1.0'), 1)
+        self.assertEqual(rpmvercmp('1.0~rc1', '1.0'), -1)
+        self.assertEqual(rpmvercmp('1.0^git1', '1.0'), 1)
+        self.assertEqual(rpmvercmp('1.0^git1', '1.0.1'), -1)
+        self.assertEqual(rpmvercmp('2a', '2.0'), -1)
+        self.assertEqual(compare_evr(('1', '1.0', '1'), (None, '9.0', '1')), 1)
+        return
+
+    def test_parse_primary(self):
+        """
+        Metadata: packages are read from primary.xml
+        """
+        packages = parse_primary(os.path.join(self.src_dir, 'primary.xml.gz'))
+        self.assertEqual([p['pkgid'] for p in packages], ['a' * 64, 'b' * 64])
+        self.assertEqual(packages[0]['location'], 'foo-1.0-1.x86_64.rpm')
+        self.assertEqual(packages[1]['time'], 200)
+        self.assertNotIn('requires', packages[0])
+
+        packages = parse_primary(
+            os.path.join(self.src_dir, 'primary.xml.gz'), deps=True)
+        self.assertEqual(packages[0]['provides'], ['foo'])
+        self.assertEqual(packages[0]['requires'], ['libc.so.6()(64bit)'])
+        self.assertEqual(packages[0]['files'], ['/usr/bin/foo'])
+        return
+
+    def test_filter_repodata(self):
+        """
+        Metadata: filtering rewrites per-package metadata and drops dbs
+        """
+        filter_repodata(self.src_dir, self.dest_dir, set(['b' * 64]))
+        _, entries = repomd_data(self.dest_dir)
+        self.assertEqual(sorted(entries),
+                         ['filelists', 'group', 'other', 'primary'])
+
+        primary = os.path.join(
+            self.dest_dir, os.path.basename(data_location(entries['primary'])))
+        packages = parse_primary(primary)
+        self.assertEqual([p['pkgid'] for p in packages], ['b' * 64])
+
+        # Files are checksum-named, and repomd.xml describes them:
+        checksum = entries['primary'].findtext(
+            '{http://linux.duke.edu/metadata/repo}checksum')
+        self.assertEqual(file_checksum(primary, 'sha256'), checksum)
+        self.assertTrue(os.path.basename(primary).startswith(checksum))
+
+        other = os.path.join(
+            self.dest_dir, os.path.basename(data_location(entries['other'])))
+        with open_metadata(other) as other_file:
+            text = other_file.read()
+        self.assertNotIn('a' * 64, text)
+        self.assertIn('packages="1"', text)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.dest_dir, 'comps.xml')))
+        return
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr)
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
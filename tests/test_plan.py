@@ -0,0 +1,194 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+
+"""
+Test module for s3yum.plan
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import unittest
+import sys
+import optparse
+from mock import (
+    MagicMock,
+    patch,
+    )
+
+from s3yum.s3yum_types import (
+    S3YumContext,
+    ServiceError
+)
+from s3yum.plan import (
+    make_plan,
+    run_plan,
+    load_plan,
+    check_plan,
+    page_count,
+    format_bytes
+)
+
+OLD = '2018-01-01T00:00:00.000Z'
+NEW = '2018-01-02T00:00:00.000Z'
+
+
+def s3item(name, size, last_modified=NEW, md5='0' * 32):
+    item = MagicMock()
+    item.name = name
+    item.size = size
+    item.last_modified = last_modified
+    item.md5 = md5
+    return item
+
+
+class TestS3YumPlan(unittest.TestCase):
+    """
+    Test planning a create/update from the listing
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.rpm_path = os.path.join(self.tmp_dir, 'baz-1.0-1.noarch.rpm')
+        with open(self.rpm_path, 'w') as rpm:
+            rpm.write('x' * 5000)
+
+        self.context = S3YumContext()
+        self.context.action = 'update'
+        self.context.rpm_args = [self.rpm_path]
+        self.context.opts = optparse.Values({
+            'bucket': 'bucket',
+            'path': 'dev',
+            'working_dir': None,
+            'remove': ['*/foo-*'],
+            'force_download': False,
+            'force_upload': False,
+            'metadata_grace': 3600,
+            'snapshots': 0,
+            'sqlite': False,
+            'deltas': False,
+            'engine': 'threads',
+            'workers': 4,
+            'plan_output': None,
+        })
+        self.context.s3_manifest = None
+        self.context.s3_repodata_path = 'dev/repodata'
+        self.context.s3_repodata_items = [
+            s3item('dev/repodata/repomd.xml', 3000),
+            s3item('dev/repodata/%s-primary.xml.gz' % ('a' * 64), 2000),
+            s3item('dev/repodata/%s-primary.xml.gz' % ('b' * 64), 1000, OLD),
+        ]
+        self.context.s3_rpm_items = [
+            s3item('dev/foo-1.0-1.noarch.rpm', 10000),
+            s3item('dev/bar-1.0-1.noarch.rpm', 20000),
+        ]
+        self.verbose = patch('s3yum.s3yum_cli.verbose', MagicMock())
+        self.verbose.start()
+        return
+
+    def tearDown(self):
+        self.verbose.stop()
+        shutil.rmtree(self.tmp_dir)
+        return
+
+    def names(self, plan, operation):
+        return [op['name'] for op in plan['operations'][operation]]
+
+    def test_update_plan(self):
+        """
+        Plan: update downloads the repo, uploads new rpm's and estimated
+        metadata, and deletes --remove'd rpm's and stale metadata
+        """
+        plan = make_plan(self.context)
+        self.assertEqual(len(plan['operations']['get']), 5)
+        self.assertEqual(self.names(plan, 'put'), [
+            'dev/baz-1.0-1.noarch.rpm',
+            'dev/repodata/<checksum>-primary.xml.gz',
+            'dev/repodata/repomd.xml'])
+        # Two packages before and after, so the metadata stays the same size:
+        self.assertEqual(plan['operations']['put'][1]['bytes'], 2000)
+        self.assertEqual(self.names(plan, 'delete'), [
+            'dev/foo-1.0-1.noarch.rpm',
+            'dev/repodata/%s-primary.xml.gz' % ('b' * 64)])
+        self.assertEqual(plan['requests'], {
+            'LIST': 2, 'GET': 6, 'PUT': 4, 'COPY': 0, 'DELETE': 1})
+        self.assertTrue(plan['estimates']['seconds'] > 0)
+        self.assertTrue(plan['estimates']['request_cost'] > 0)
+        return
+
+    def test_create_plan(self):
+        """
+        Plan: create downloads nothing
+        """
+        self.context.action = 'create'
+        self.context.opts.remove = []
+        plan = make_plan(self.context)
+        self.assertEqual(plan['operations']['get'], [])
+        self.assertEqual(self.names(plan, 'put')[0],
+                         'dev/baz-1.0-1.noarch.rpm')
+        return
+
+    def test_working_dir(self):
+        """
+        Plan: rpm's already in the --working-dir aren't downloaded
+        """
+        self.context.opts.working_dir = self.tmp_dir
+        with open(os.path.join(self.tmp_dir, 'bar-1.0-1.noarch.rpm'), 'w') \
+                as rpm:
+            rpm.write('bar')
+        self.context.s3_rpm_items[1].md5 = hashlib.md5('bar').hexdigest()
+        plan = make_plan(self.context)
+        self.assertFalse('dev/bar-1.0-1.noarch.rpm' in self.names(plan, 'get'))
+        self.assertTrue('dev/foo-1.0-1.noarch.rpm' in self.names(plan, 'get'))
+        return
+
+    def test_save_and_apply(self):
+        """
+        Apply: a saved plan restores the action, and is refused once the
+        repo or the rpm's change
+        """
+        plan_path = os.path.join(self.tmp_dir, 'plan.json')
+        self.context.opts.plan_output = plan_path
+        run_plan(self.context)
+        with open(plan_path) as plan_file:
+            self.assertEqual(json.load(plan_file)['action'], 'update')
+
+        context = S3YumContext()
+        context.rpm_args = [plan_path]
+        context.opts = optparse.Values({'bucket': None, 'path': 'dev',
+                                        'remove': []})
+        load_plan(context)
+        self.assertEqual(context.action, 'update')
+        self.assertEqual(context.rpm_args, [self.rpm_path])
+        self.assertEqual(context.opts.remove, ['*/foo-*'])
+        self.assertEqual(context.opts.bucket, 'bucket')
+
+        context.s3_repodata_path = self.context.s3_repodata_path
+        context.s3_repodata_items = self.context.s3_repodata_items
+        check_plan(context)
+        os.utime(self.rpm_path, (1, 1))
+        self.assertRaises(ServiceError, check_plan, context)
+        context.s3_repodata_items[0].md5 = '1' * 32
+        self.assertRaises(ServiceError, check_plan, context)
+        return
+
+    def test_formatting(self):
+        """
+        Plan: page counts and byte sizes
+        """
+        self.assertEqual(page_count(0), 0)
+        self.assertEqual(page_count(1000), 1)
+        self.assertEqual(page_count(1001), 2)
+        self.assertEqual(format_bytes(512), '512B')
+        self.assertEqual(format_bytes(1536), '1.5KB')
+        self.assertEqual(format_bytes(3 * 1024 ** 3), '3.0GB')
+        return
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr)
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,172 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+
+"""
+Test module for s3yum.progress
+"""
+
+import json
+import logging
+import unittest
+import sys
+import optparse
+from StringIO import StringIO
+from mock import patch
+
+from s3yum import s3yum_cli
+from s3yum.s3yum_types import S3YumContext
+from s3yum.progress import (
+    ProgressAggregator,
+    start_progress,
+    format_status,
+    format_duration
+)
+
+
+class TTY(StringIO):
+
+    def isatty(self):
+        return True
+
+
+class TestS3YumProgress(unittest.TestCase):
+    """
+    Test aggregating the progress of concurrent transfers
+    """
+
+    def setUp(self):
+        self.time = patch('s3yum.progress.time.time', return_value=100.0)
+        self.time.start()
+        return
+
+    def tearDown(self):
+        self.time.stop()
+        return
+
+    def test_totals(self):
+        """
+        Totals: in-flight bytes count towards the total, skipped transfers
+        leave it, and the ETA follows the throughput
+        """
+        progress = ProgressAggregator('Downloading', [1000, 2000, 3000], 1,
+                                      stream=StringIO())
+        progress.callback('a')(500, 1000)
+        progress.callback('b')
+        progress.skip(3000)
+        with patch('s3yum.progress.time.time', return_value=110.0):
+            status = progress.snapshot()
+        self.assertEqual(status['files_total'], 2)
+        self.assertEqual(status['bytes_total'], 3000)
+        self.assertEqual(status['bytes_done'], 500)
+        self.assertEqual(status['active'], 2)
+        self.assertEqual(status['bytes_per_second'], 50)
+        self.assertEqual(status['eta_seconds'], 50)
+
+        progress.finish('a', 1000)
+        status = progress.snapshot()
+        self.assertEqual((status['files_done'], status['active']), (1, 1))
+        self.assertEqual(status['bytes_done'], 1000)
+        return
+
+    def test_json_lines(self):
+        """
+        Rendering: one JSON object per line when not on a terminal, written
+        less often
+        """
+        stream = StringIO()
+        progress = ProgressAggregator('Uploading', [10], 2, stream=stream)
+        self.assertTrue(progress.json_lines)
+        self.assertEqual(progress.interval, 20)
+        progress.finish('a', 10)
+        progress.close()
+        status = json.loads(stream.getvalue())
+        self.assertEqual(status['label'], 'Uploading')
+        self.assertEqual(status['files_done'], 1)
+        self.assertEqual(status['eta_seconds'], 0)
+        return
+
+    def test_status_line(self):
+        """
+        Rendering: a terminal gets one status line, rewritten in place
+        """
+        stream = TTY()
+        progress = ProgressAggregator('Downloading', [2048] * 20, 1,
+                                      stream=stream)
+        self.assertFalse(progress.json_lines)
+        progress.render()
+        progress.finish('a', 2048)
+        progress.close()
+        lines = stream.getvalue().split('\r')
+        self.assertEqual(lines[0], '')
+        self.assertTrue(lines[1].startswith(
+            'Downloading: 0/20 files, 0B/40.0KB, 0B/s, ETA ?, 0 active'))
+        self.assertTrue(lines[2].startswith('Downloading: 1/20 files'))
+        self.assertTrue(lines[2].endswith('\n'))
+        # A shorter line is padded over the previous one:
+        progress.line_length = 100
+        progress.render()
+        self.assertEqual(len(stream.getvalue().split('\r')[-1]), 100)
+        return
+
+    def test_verbose_over_status(self):
+        """
+        Rendering: verbose lines clear the status line, which is redrawn
+        after them, and verbose is restored by close()
+        """
+        stream = TTY()
+
+        def print_fn(msg, *args):
+            stream.write(msg % args + '\n')
+
+        context = S3YumContext()
+        context.opts = optparse.Values({
+            'verbose': True, 'dry_run': False, 'progress_interval': 60})
+        with patch('s3yum.s3yum_cli.verbose', print_fn), \
+                patch('s3yum.progress.sys.stderr', stream):
+            progress = start_progress(context, 'Uploading', [10])
+            progress.render()
+            s3yum_cli.verbose("Retrying %s", 'foo')
+            progress.close()
+            self.assertEqual(s3yum_cli.verbose, print_fn)
+        status = format_status(progress.snapshot())
+        self.assertEqual(stream.getvalue().split('\r'), [
+            '', status, ' ' * len(status), 'Retrying foo\n', status,
+            status + '\n'])
+        return
+
+    def test_start_progress(self):
+        """
+        Progress: only reported with -v, and not for dry runs
+        """
+        context = S3YumContext()
+        context.opts = optparse.Values({
+            'verbose': False, 'dry_run': False, 'progress_interval': 60})
+        self.assertEqual(start_progress(context, 'Uploading', [1]), None)
+        context.opts.verbose = True
+        self.assertEqual(start_progress(context, 'Uploading', []), None)
+        context.opts.dry_run = True
+        self.assertEqual(start_progress(context, 'Uploading', [1]), None)
+
+        context.opts.dry_run = False
+        with patch('s3yum.progress.sys.stderr', StringIO()):
+            progress = start_progress(context, 'Uploading', [1])
+            self.assertTrue(progress.thread.is_alive())
+            progress.close()
+        self.assertFalse(progress.thread.is_alive())
+        return
+
+    def test_format_duration(self):
+        """
+        Formatting: ETAs
+        """
+        self.assertEqual(format_duration(None), '?')
+        self.assertEqual(format_duration(42), '42s')
+        self.assertEqual(format_duration(185), '3m05s')
+        self.assertEqual(format_duration(7800), '2h10m')
+        return
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr)
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+
+"""
+Test module for s3yum prune
+"""
+
+import os
+import shutil
+import logging
+import unittest
+import tempfile
+import optparse
+import sys
+from mock import (
+    MagicMock,
+    patch,
+    )
+
+from s3yum.s3yum_types import S3YumContext
+from s3yum.s3yum_cli import (
+    select_prune,
+    prune_repo
+)
+from s3yum.metadata import repomd_data
+from test_metadata import make_repodata
+
+DAY = 86400
+NOW = 100 * DAY
+
+
+def package(name, version, age_days, arch='x86_64'):
+    return {'name': name, 'arch': arch, 'epoch': '0', 'version': version,
+            'release': '1', 'age_days': age_days,
+            'location': '%s-%s-1.%s.rpm' % (name, version, arch)}
+
+
+class TestS3YumPrune(unittest.TestCase):
+    """
+    Test choosing which package versions to prune
+    """
+
+    def setUp(self):
+        self.packages = [
+            package('foo', '1.9', 30),
+            package('foo', '1.10', 20),
+            package('foo', '1.2', 40),
+            package('foo', '1.2', 40, arch='i686'),
+            package('bar', '0.1', 90),
+        ]
+        return
+
+    def pruned(self, keep, older_than):
+        added = dict((p['location'], NOW - p['age_days'] * DAY)
+                     for p in self.packages)
+        return [p['location'] for p in
+                select_prune(self.packages, keep, older_than, NOW, added)]
+
+    def test_keep(self):
+        """
+        Prune: the newest --keep versions of each name and arch are kept
+        """
+        self.assertEqual(self.pruned(2, None), ['foo-1.2-1.x86_64.rpm'])
+        self.assertEqual(self.pruned(1, None),
+                         ['foo-1.2-1.x86_64.rpm', 'foo-1.9-1.x86_64.rpm'])
+        return
+
+    def test_older_than(self):
+        """
+        Prune: only versions uploaded long ago are pruned, and never the
+        newest
+        """
+        self.assertEqual(self.pruned(None, 25), ['foo-1.2-1.x86_64.rpm',
+                                                 'foo-1.9-1.x86_64.rpm'])
+        self.assertEqual(self.pruned(None, 35), ['foo-1.2-1.x86_64.rpm'])
+        self.assertEqual(self.pruned(2, 25), ['foo-1.2-1.x86_64.rpm'])
+        return
+
+    def test_dry_run(self):
+        """
+        Prune: a dry run leaves the working directory's rpm's alone
+        """
+        tmp_dir = tempfile.mkdtemp()
+        context = S3YumContext()
+        context.working_dir = tmp_dir
+        context.working_dir_repodata = os.path.join(tmp_dir, 'repodata')
+        context.opts = optparse.Values({
+            'bucket': 'bucket', 'path': 'dev', 'keep': 1, 'older_than': None,
+            'dry_run': True, 'sqlite': False})
+        context.s3_rpm_items = []
+        rpm_path = os.path.join(tmp_dir, 'foo-1.0-1.x86_64.rpm')
+        open(rpm_path, 'w').close()
+
+        def download(context, dest_dir):
+            make_repodata(dest_dir)
+            return repomd_data(dest_dir)[1]
+
+        try:
+            with patch('s3yum.s3yum_cli.verbose', MagicMock()), \
+                    patch('s3yum.s3yum_cli.init_workingdir'), \
+                    patch('s3yum.s3yum_cli.download_published_repodata',
+                          download), \
+                    patch('s3yum.s3yum_cli.compress_repodata'), \
+                    patch('s3yum.s3yum_cli.upload_repodata') as upload:
+                prune_repo(context)
+            self.assertTrue(upload.called)
+            self.assertTrue(os.path.exists(rpm_path))
+        finally:
+            shutil.rmtree(tmp_dir)
+        return
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr)
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
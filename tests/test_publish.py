@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+
+"""
+Test module for s3yum repodata publishing
+"""
+
+import logging
+import unittest
+import sys
+import datetime
+import optparse
+from mock import (
+    MagicMock,
+    patch,
+    )
+
+from s3yum.s3yum_types import S3YumContext
+from s3yum.s3yum_cli import collect_stale_metadata
+
+REPOMD_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<repomd xmlns="http://linux.duke.edu/metadata/repo">
+  <data type="primary">
+    <location href="repodata/old-primary.xml.gz"/>
+  </data>
+</repomd>
+"""
+
+
+def mock_item(name):
+    item = MagicMock()
+    item.name = name
+    return item
+
+
+class TestS3YumPublish(unittest.TestCase):
+    """
+    Test s3yum publish ordering and garbage collection
+    """
+
+    def setUp(self):
+        self.context = S3YumContext()
+        self.context.opts = optparse.Values(
+            {'path': 'dev', 'metadata_grace': 3600, 'dry_run': False})
+        self.new = mock_item('dev/repodata/new-primary.xml.gz')
+        self.old = mock_item('dev/repodata/old-primary.xml.gz')
+        self.older = mock_item('dev/repodata/older-primary.xml.gz')
+        self.context.s3_repodata_items = [self.new, self.old, self.older]
+        self.published = set([self.new.name, 'dev/repodata/repomd.xml'])
+        return
+
+    def collect(self, repomd_age):
+        repomd = mock_item('dev/repodata/repomd.xml')
+        repomd.last_modified = (
+            datetime.datetime.utcnow() - repomd_age
+            ).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        with patch('s3yum.s3yum_cli.verbose', MagicMock()):
+            return collect_stale_metadata(
+                self.context, self.published, repomd, REPOMD_XML)
+
+    def test_gc_after_grace(self):
+        """
+        GC: files stale for longer than the grace period are deleted
+        """
+        stale = self.collect(datetime.timedelta(hours=2))
+        self.assertEqual(stale, [self.older])
+        return
+
+    def test_keep_within_grace(self):
+        """
+        GC: recently superseded files are kept
+        """
+        stale = self.collect(datetime.timedelta(minutes=5))
+        self.assertEqual(stale, [])
+        return
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr)
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
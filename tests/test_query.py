@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+
+"""
+Test module for s3yum package selection
+"""
+
+import logging
+import unittest
+import sys
+
+from s3yum.query import (
+    select_packages,
+    resolve_deps
+)
+
+
+def package(name, version, arch='x86_64', provides=(), requires=(),
+            files=()):
+    return {'pkgid': '%s-%s.%s' % (name, version, arch), 'name': name,
+            'arch': arch, 'epoch': '0', 'version': version, 'release': '1',
+            'location': '%s-%s-1.%s.rpm' % (name, version, arch),
+            'provides': [name] + list(provides), 'requires': list(requires),
+            'files': list(files)}
+
+
+def ids(packages):
+    return [p['pkgid'] for p in packages]
+
+
+class TestS3YumQuery(unittest.TestCase):
+    """
+    Test selecting packages for a partial get
+    """
+
+    def setUp(self):
+        self.packages = [
+            package('nginx', '1.10', requires=['libssl.so.10', 'nginx-conf',
+                                               'rpmlib(PayloadIsXz)']),
+            package('nginx', '1.12', requires=['libssl.so.10', 'nginx-conf',
+                                               '/usr/sbin/useradd']),
+            package('nginx', '1.12', arch='i686'),
+            package('nginx-conf', '1.0', arch='noarch'),
+            package('openssl-libs', '1.0', provides=['libssl.so.10']),
+            package('openssl-libs', '1.1', provides=['libssl.so.10']),
+            package('openssl-libs', '1.1', arch='i686',
+                    provides=['libssl.so.10']),
+            package('shadow-utils', '4.1', files=['/usr/sbin/useradd'],
+                    requires=['glibc']),
+        ]
+        return
+
+    def test_select(self):
+        """
+        Query: globs, arches and NEVRA queries select packages
+        """
+        selected, unmatched = select_packages(self.packages)
+        self.assertEqual(len(selected), len(self.packages))
+
+        selected, unmatched = select_packages(
+            self.packages, includes=['nginx-1*', 'foo-*'], arches=['x86_64'])
+        self.assertEqual(ids(selected), ['nginx-1.10.x86_64',
+                                         'nginx-1.12.x86_64'])
+        self.assertEqual(unmatched, ['foo-*'])
+
+        selected, unmatched = select_packages(
+            self.packages, queries=['nginx', 'openssl-libs-1.0', 'bar'],
+            excludes=['*.i686.rpm'])
+        self.assertEqual(ids(selected), ['nginx-1.12.x86_64',
+                                         'openssl-libs-1.0.x86_64'])
+        self.assertEqual(unmatched, ['bar'])
+
+        selected, _ = select_packages(
+            self.packages, queries=['nginx-0:1.1*-1.i686'])
+        self.assertEqual(ids(selected), ['nginx-1.12.i686'])
+        return
+
+    def test_resolve_deps(self):
+        """
+        Query: dependencies are added by capability and file, newest first
+        """
+        selected, _ = select_packages(
+            self.packages, queries=['nginx.x86_64'])
+        closure, unresolved = resolve_deps(self.packages, selected)
+        self.assertEqual(ids(closure), [
+            'nginx-1.12.x86_64', 'nginx-conf-1.0.noarch',
+            'openssl-libs-1.1.x86_64', 'shadow-utils-4.1.x86_64'])
+        self.assertEqual(unresolved, ['glibc'])
+        return
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr)
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
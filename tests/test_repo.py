@@ -0,0 +1,79 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+
+"""
+Test module for s3yum.repo
+"""
+
+import logging
+import unittest
+import sys
+from mock import (
+    MagicMock,
+    patch,
+    )
+
+from s3yum.s3yum_types import UserError
+from s3yum import repo
+from s3yum.repo import S3YumRepo
+
+
+class TestS3YumRepo(unittest.TestCase):
+    """
+    Test the S3YumRepo python API
+    """
+
+    def setUp(self):
+        repo._connections.clear()
+        return
+
+    def test_options(self):
+        """
+        Repo: options default like the command line, unknown ones fail
+        """
+        yum_repo = S3YumRepo('bucket', '/el7/x86_64', region='us-east-1')
+        self.assertEqual(yum_repo.context.opts.path, 'el7/x86_64')
+        self.assertEqual(yum_repo.context.opts.region, 'us-east-1')
+        self.assertEqual(yum_repo.context.opts.remove, [])
+        self.assertFalse(yum_repo.context.opts.dry_run)
+        self.assertRaises(UserError, S3YumRepo, 'bucket', 'el7', bogus=True)
+        return
+
+    def test_shared_connection(self):
+        """
+        Repo: repos with the same credentials share one connection
+        """
+        with patch('boto.connect_s3', MagicMock()) as connect_s3, \
+                patch('boto.s3.bucket.Bucket', MagicMock()):
+            repos = [S3YumRepo('bucket', path) for path in ('a', 'b', 'c')]
+            for yum_repo in repos:
+                yum_repo.activate()
+        self.assertEqual(connect_s3.call_count, 1)
+        self.assertTrue(repos[0].context.s3_conn is repos[2].context.s3_conn)
+        return
+
+    def test_listing_reused(self):
+        """
+        Repo: the listing is reused until the repo is modified
+        """
+        yum_repo = S3YumRepo('bucket', 'el7')
+        with patch.object(yum_repo, 'activate', MagicMock()), \
+                patch('s3yum.s3yum_cli.list_metadata', MagicMock()), \
+                patch('s3yum.s3yum_cli.list_rpms', MagicMock()) as list_rpms, \
+                patch('s3yum.s3yum_cli.init_workingdir', MagicMock()), \
+                patch('s3yum.s3yum_cli.update_repo', MagicMock()):
+            yum_repo.context.s3_rpm_items = []
+            yum_repo.list()
+            yum_repo.list()
+            self.assertEqual(list_rpms.call_count, 1)
+            yum_repo.remove(['*/old-*'])
+            self.assertEqual(list_rpms.call_count, 1)
+            yum_repo.list()
+            self.assertEqual(list_rpms.call_count, 2)
+        return
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr)
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,317 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+
+"""
+Test module for the s3yum serve action
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import httplib
+import logging
+import optparse
+import unittest
+import tempfile
+import threading
+import sys
+from mock import MagicMock, patch
+
+from s3yum.s3yum_types import S3YumContext
+from s3yum.daemon import make_server
+from s3yum.serve import (
+    ObjectCache,
+    Coalescer,
+    Gateway,
+    GatewayRequestHandler,
+    parse_range
+)
+
+REPOMD = '<repomd/>'
+RPM = ''.join(chr(i % 256) for i in range(1000))
+
+
+class FakeBucket(object):
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.gets = []
+        self.delay = 0
+        return
+
+    def get_key(self, key):
+        if key not in self.objects:
+            return None
+        body = self.objects[key]
+        item = MagicMock()
+        item.name = key
+        item.md5 = None
+        item.etag = '"%s"' % hashlib.md5(body).hexdigest()
+
+        def get_contents_to_file(fp):
+            self.gets.append(key)
+            time.sleep(self.delay)
+            fp.write(body)
+
+        def get_contents_as_string():
+            self.gets.append(key)
+            return body
+
+        item.get_contents_to_file.side_effect = get_contents_to_file
+        item.get_contents_as_string.side_effect = get_contents_as_string
+        return item
+
+
+class TestS3YumServeUtils(unittest.TestCase):
+    """
+    Test the gateway's range parsing, cache and request coalescing
+    """
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        return
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        return
+
+    def test_parse_range(self):
+        """
+        Range: single byte ranges, ignored and unsatisfiable ones
+        """
+        self.assertEqual(parse_range(None, 100), None)
+        self.assertEqual(parse_range('bytes=0-9', 100), (0, 9))
+        self.assertEqual(parse_range('bytes=90-', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=90-200', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=-10', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=-200', 100), (0, 99))
+        # Multiple ranges and other units get the whole object:
+        self.assertEqual(parse_range('bytes=0-1,5-6', 100), None)
+        self.assertEqual(parse_range('items=0-1', 100), None)
+        self.assertRaises(ValueError, parse_range, 'bytes=100-', 100)
+        self.assertRaises(ValueError, parse_range, 'bytes=5-1', 100)
+        self.assertRaises(ValueError, parse_range, 'bytes=-0', 100)
+        return
+
+    def add(self, cache, key, size):
+        tmp_file, tmp_path = cache.temp_file()
+        with tmp_file:
+            tmp_file.write('x' * size)
+        return cache.add(key, tmp_path)
+
+    def test_cache_eviction(self):
+        """
+        Cache: the least recently used files are evicted, and the LRU order
+        survives a restart
+        """
+        cache = ObjectCache(self.cache_dir, 250)
+        self.add(cache, 'a.rpm', 100)
+        self.add(cache, 'b.rpm', 100)
+        self.assertTrue(cache.lookup('a.rpm'))
+        self.add(cache, 'c.rpm', 100)
+        self.assertTrue(cache.lookup('a.rpm'))
+        self.assertEqual(cache.lookup('b.rpm'), None)
+        self.assertTrue(cache.lookup('c.rpm'))
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+        os.utime(cache.lookup('a.rpm'), (1, 1))
+        cache = ObjectCache(self.cache_dir, 150)
+        self.assertEqual(cache.lookup('a.rpm'), None)
+        self.assertTrue(cache.lookup('c.rpm'))
+        self.assertEqual(cache.size, 100)
+        return
+
+    def test_coalescing(self):
+        """
+        Coalescing: concurrent calls for a key share one call's result
+        """
+        coalescer = Coalescer()
+        calls = []
+        release = threading.Event()
+
+        def fetch():
+            calls.append(1)
+            release.wait(5)
+            return 'result'
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(coalescer.run('key', fetch)))
+            for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        deadline = time.time() + 5
+        while not calls and time.time() < deadline:
+            time.sleep(0.01)
+        # Let the others arrive while the first call is running:
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['result'] * 5)
+        self.assertEqual(coalescer.calls, {})
+        return
+
+
+class TestS3YumServe(unittest.TestCase):
+    """
+    Test serving a repo over HTTP
+    """
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.context = S3YumContext()
+        self.context.opts = optparse.Values({
+            'path': 'repo',
+            'max_age': 31536000,
+            'repomd_max_age': 60,
+            'no_cache_headers': False,
+        })
+        self.bucket = FakeBucket({
+            'repo/repodata/repomd.xml': REPOMD,
+            'repo/foo-1.0-1.x86_64.rpm': RPM,
+        })
+        self.context.s3_bucket = self.bucket
+        self.gateway = Gateway(
+            self.context, ObjectCache(self.cache_dir, 1024 * 1024))
+
+        self.verbose = patch('s3yum.s3yum_cli.verbose', MagicMock())
+        self.verbose.start()
+        self.server = make_server('127.0.0.1:0', GatewayRequestHandler)
+        self.server.gateway = self.gateway
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        return
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.verbose.stop()
+        shutil.rmtree(self.cache_dir)
+        return
+
+    def request(self, path, method='GET', headers=None):
+        conn = httplib.HTTPConnection(*self.server.server_address)
+        try:
+            conn.request(method, path, headers=headers or {})
+            response = conn.getresponse()
+            return response, response.read()
+        finally:
+            conn.close()
+
+    def test_rpm(self):
+        """
+        Rpm's: fetched once into the cache, with immutable cache headers
+        """
+        for _ in range(2):
+            response, body = self.request('/foo-1.0-1.x86_64.rpm')
+            self.assertEqual(response.status, 200)
+            self.assertEqual(body, RPM)
+            self.assertEqual(response.getheader('content-type'),
+                             'application/x-rpm')
+            self.assertTrue('immutable' in response.getheader('cache-control'))
+        self.assertEqual(self.bucket.gets, ['repo/foo-1.0-1.x86_64.rpm'])
+
+        response, body = self.request('/foo-1.0-1.x86_64.rpm', 'HEAD')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('content-length'), str(len(RPM)))
+        self.assertEqual(body, '')
+        return
+
+    def test_range(self):
+        """
+        Range: partial content, and 416 past the end
+        """
+        response, body = self.request(
+            '/foo-1.0-1.x86_64.rpm', headers={'Range': 'bytes=10-19'})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(body, RPM[10:20])
+        self.assertEqual(response.getheader('content-range'),
+                         'bytes 10-19/%i' % len(RPM))
+
+        response, body = self.request(
+            '/repodata/repomd.xml', headers={'Range': 'bytes=-4'})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(body, REPOMD[-4:])
+
+        response, _ = self.request(
+            '/foo-1.0-1.x86_64.rpm', headers={'Range': 'bytes=5000-'})
+        self.assertEqual(response.status, 416)
+        return
+
+    def test_repomd_ttl(self):
+        """
+        repomd.xml: kept for --repomd-max-age, then fetched again, and served
+        stale if S3 fails
+        """
+        response, body = self.request('/repodata/repomd.xml')
+        self.assertEqual((response.status, body), (200, REPOMD))
+        self.assertTrue('max-age=60' in response.getheader('cache-control'))
+        self.request('/repodata/repomd.xml')
+        self.assertEqual(len(self.bucket.gets), 1)
+
+        self.bucket.objects['repo/repodata/repomd.xml'] = '<repomd new/>'
+        key = 'repo/repodata/repomd.xml'
+        self.gateway.metadata[key] = (0, self.gateway.metadata[key][1])
+        response, body = self.request('/repodata/repomd.xml')
+        self.assertEqual(body, '<repomd new/>')
+
+        self.gateway.metadata[key] = (0, self.gateway.metadata[key][1])
+        self.bucket.get_key = MagicMock(side_effect=IOError('S3 is down'))
+        response, body = self.request('/repodata/repomd.xml')
+        self.assertEqual((response.status, body), (200, '<repomd new/>'))
+        return
+
+    def test_errors(self):
+        """
+        Errors: 404 for missing objects and escapes, 502 for S3 failures
+        """
+        self.assertEqual(self.request('/bar-1.0-1.x86_64.rpm')[0].status, 404)
+        self.assertEqual(self.request('/../secret.rpm')[0].status, 404)
+        self.assertEqual(self.request('/')[0].status, 404)
+        self.bucket.get_key = MagicMock(side_effect=IOError('S3 is down'))
+        self.assertEqual(self.request('/baz-1.0-1.x86_64.rpm')[0].status, 502)
+        return
+
+    def test_evicted(self):
+        """
+        Eviction: a file evicted before it is opened is fetched once more,
+        then given up on
+        """
+        result = self.gateway.get('foo-1.0-1.x86_64.rpm')
+        self.gateway.get = MagicMock(side_effect=[
+            (result[0], None, os.path.join(self.cache_dir, 'gone')),
+            result])
+        self.assertEqual(self.request('/foo-1.0-1.x86_64.rpm')[0].status, 200)
+
+        self.gateway.get = MagicMock(return_value=(
+            result[0], None, os.path.join(self.cache_dir, 'gone')))
+        self.assertEqual(self.request('/foo-1.0-1.x86_64.rpm')[0].status, 502)
+        self.assertEqual(self.gateway.get.call_count, 2)
+        return
+
+    def test_coalesced_misses(self):
+        """
+        Coalescing: concurrent misses for an rpm fetch it from S3 once
+        """
+        self.bucket.delay = 0.2
+        statuses = []
+        threads = [threading.Thread(target=lambda: statuses.append(
+            self.request('/foo-1.0-1.x86_64.rpm')[0].status))
+            for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(statuses, [200] * 5)
+        self.assertEqual(self.bucket.gets, ['repo/foo-1.0-1.x86_64.rpm'])
+        return
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr)
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,200 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+
+"""
+Test module for s3yum repodata snapshots
+"""
+
+import logging
+import unittest
+import sys
+import optparse
+from mock import (
+    MagicMock,
+    patch,
+    )
+
+from s3yum.s3yum_types import (
+    S3YumContext,
+    UserError,
+    ServiceError
+)
+from s3yum.s3yum_cli import list_metadata
+from s3yum.snapshots import (
+    list_snapshots,
+    new_snapshot_id,
+    take_snapshot,
+    use_snapshot,
+    rollback
+)
+
+REPOMD_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<repomd xmlns="http://linux.duke.edu/metadata/repo">
+  <data type="primary">
+    <location href="repodata/new-primary.xml.gz"/>
+  </data>
+</repomd>
+"""
+
+
+class FakeBucket(object):
+
+    name = 'bucket'
+
+    def __init__(self, names):
+        self.objects = dict((name, REPOMD_XML) for name in names)
+        self.copies = []
+        return
+
+    def item(self, name):
+        item = MagicMock()
+        item.name = name
+        item.last_modified = '2018-01-01T00:00:00.000Z'
+        item.get_contents_as_string.return_value = self.objects[name]
+        return item
+
+    def list(self, prefix=''):
+        return [self.item(name) for name in sorted(self.objects)
+                if name.startswith(prefix)]
+
+    def copy_key(self, dest, bucket_name, source):
+        self.copies.append((source, dest))
+        self.objects[dest] = self.objects[source]
+        return
+
+    def delete_keys(self, names, quiet=False):
+        for name in names:
+            del self.objects[name]
+        return MagicMock(errors=[])
+
+
+class TestS3YumSnapshots(unittest.TestCase):
+    """
+    Test taking, expiring and rolling back to snapshots
+    """
+
+    def setUp(self):
+        self.context = S3YumContext()
+        self.context.opts = optparse.Values({
+            'path': 'dev',
+            'bucket': 'bucket',
+            'snapshots': 2,
+            'snapshot': None,
+            'metadata_grace': 0,
+            'dry_run': False,
+            'engine': 'threads',
+            'workers': 1,
+        })
+        self.bucket = FakeBucket([
+            'dev/repodata/repomd.xml',
+            'dev/repodata/new-primary.xml.gz',
+            'dev/repodata/snapshots/20180101T000000Z/repomd.xml',
+            'dev/repodata/snapshots/20180101T000000Z/old-primary.xml.gz',
+            'dev/repodata/snapshots/20180102T000000Z/repomd.xml',
+            'dev/repodata/snapshots/20180102T000000Z/new-primary.xml.gz',
+            'dev/foo-1.0-1.noarch.rpm',
+        ])
+        self.context.s3_bucket = self.bucket
+        self.context.s3_lease = None
+        self.context.s3_rpm_items = self.bucket.list('dev/foo')
+        self.verbose = patch('s3yum.s3yum_cli.verbose', MagicMock())
+        self.verbose.start()
+        return
+
+    def tearDown(self):
+        self.verbose.stop()
+        return
+
+    def test_list_metadata(self):
+        """
+        Listing: snapshots are not part of the repo's metadata
+        """
+        list_metadata(self.context)
+        self.assertEqual(
+            [item.name for item in self.context.s3_repodata_items],
+            ['dev/repodata/new-primary.xml.gz', 'dev/repodata/repomd.xml'])
+        self.assertEqual(sorted(list_snapshots(self.context)),
+                         ['20180101T000000Z', '20180102T000000Z'])
+        return
+
+    def test_new_snapshot_id(self):
+        """
+        Ids: distinct from existing snapshots, and sortable
+        """
+        snapshot_id = new_snapshot_id({})
+        self.assertEqual(len(snapshot_id), 16)
+        self.assertEqual(new_snapshot_id({snapshot_id: []})[:17],
+                         snapshot_id + '-')
+        return
+
+    def test_take_snapshot(self):
+        """
+        Snapshot: metadata is copied server-side, repomd.xml last, and the
+        oldest snapshots are expired
+        """
+        with patch('s3yum.snapshots.new_snapshot_id',
+                   return_value='20180103T000000Z'):
+            take_snapshot(self.context, ['new-primary.xml.gz'])
+        self.assertEqual(self.bucket.copies, [
+            ('dev/repodata/new-primary.xml.gz',
+             'dev/repodata/snapshots/20180103T000000Z/new-primary.xml.gz'),
+            ('dev/repodata/repomd.xml',
+             'dev/repodata/snapshots/20180103T000000Z/repomd.xml'),
+        ])
+        self.assertEqual(sorted(list_snapshots(self.context)),
+                         ['20180102T000000Z', '20180103T000000Z'])
+        return
+
+    def test_rollback(self):
+        """
+        Rollback: collected metadata is restored before repomd.xml is swapped
+        """
+        self.context.opts.snapshot = '20180101T000000Z'
+        list_metadata(self.context)
+        self.bucket.objects[
+            'dev/repodata/snapshots/20180101T000000Z/repomd.xml'] = \
+            REPOMD_XML.replace('new-', 'old-')
+        packages = [{'location': 'foo-1.0-1.noarch.rpm'}]
+        with patch('s3yum.snapshots.parse_primary', return_value=packages), \
+                patch('s3yum.s3yum_cli.download_items'):
+            rollback(self.context)
+
+        snapshot = 'dev/repodata/snapshots/20180101T000000Z/'
+        self.assertEqual(self.bucket.copies, [
+            (snapshot + 'old-primary.xml.gz',
+             'dev/repodata/old-primary.xml.gz'),
+            (snapshot + 'repomd.xml', 'dev/repodata/repomd.xml'),
+        ])
+        # The replaced metadata is kept for clients holding the old
+        # repomd.xml, until a later publish collects it:
+        self.assertTrue('dev/repodata/new-primary.xml.gz' in
+                        self.bucket.objects)
+        self.assertEqual(self.context.s3_repodata_path, 'dev/repodata')
+        return
+
+    def test_use_snapshot(self):
+        """
+        Snapshot listing: only its rpm's, and snapshots referencing deleted
+        rpm's or which don't exist are refused
+        """
+        list_metadata(self.context)
+        self.assertRaises(UserError, use_snapshot, self.context, 'latest')
+
+        packages = [{'location': 'foo-1.0-1.noarch.rpm'}]
+        with patch('s3yum.snapshots.parse_primary', return_value=packages), \
+                patch('s3yum.s3yum_cli.download_items'):
+            use_snapshot(self.context, '20180102T000000Z')
+            self.assertEqual(
+                [item.name for item in self.context.s3_rpm_items],
+                ['dev/foo-1.0-1.noarch.rpm'])
+
+            packages.append({'location': 'foo-0.9-1.noarch.rpm'})
+            self.assertRaises(ServiceError, use_snapshot, self.context,
+                              '20180102T000000Z')
+        return
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr)
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
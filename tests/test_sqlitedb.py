@@ -0,0 +1,157 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+
+"""
+Test module for s3yum sqlite metadata databases
+"""
+
+import os
+import bz2
+import shutil
+import sqlite3
+import logging
+import unittest
+import tempfile
+import sys
+from mock import (
+    MagicMock,
+    patch,
+    )
+
+from s3yum.s3yum_types import S3YumContext
+from s3yum.metadata import (
+    repomd_data,
+    data_location,
+    repo_tag
+)
+from s3yum.sqlitedb import (
+    stash_databases,
+    make_databases
+)
+from test_metadata import (
+    make_repodata,
+    PACKAGES
+)
+
+
+class TestS3YumSqlite(unittest.TestCase):
+    """
+    Test building the sqlite databases, and updating the previous ones
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.context = S3YumContext()
+        self.context.working_dir = self.tmp_dir
+        self.context.working_dir_repodata = os.path.join(
+            self.tmp_dir, 'repodata')
+        os.makedirs(self.context.working_dir_repodata)
+        self.patch = patch('s3yum.s3yum_cli.verbose', MagicMock())
+        self.verbose = self.patch.start()
+        return
+
+    def tearDown(self):
+        self.patch.stop()
+        shutil.rmtree(self.tmp_dir)
+        return
+
+    def publish(self, packages):
+        """
+        Write repodata for 'packages', as createrepo would, and build the
+        databases from whatever the previous repodata had.
+        """
+        stash_databases(self.context)
+        shutil.rmtree(self.context.working_dir_repodata)
+        os.makedirs(self.context.working_dir_repodata)
+        make_repodata(self.context.working_dir_repodata, packages)
+        make_databases(self.context)
+        return
+
+    def query(self, data_type, sql):
+        _, entries = repomd_data(self.context.working_dir_repodata)
+        data = entries['%s_db' % data_type]
+        self.assertEqual(data.findtext(repo_tag('database_version')), '10')
+        db_path = os.path.join(self.tmp_dir, '%s.sqlite' % data_type)
+        with open(db_path, 'wb') as db_file:
+            db_file.write(bz2.BZ2File(os.path.join(
+                self.context.working_dir_repodata,
+                os.path.basename(data_location(data)))).read())
+        conn = sqlite3.connect(db_path)
+        try:
+            return conn.execute(sql).fetchall()
+        finally:
+            conn.close()
+
+    def test_build(self):
+        """
+        Sqlite: databases are built with every package and its data
+        """
+        self.publish(PACKAGES)
+        self.assertEqual(
+            self.query('primary',
+                       "SELECT name, version, location_href, time_file "
+                       "FROM packages ORDER BY version"),
+            [('foo', '1.0', 'foo-1.0-1.x86_64.rpm', 100),
+             ('foo', '1.1', 'foo-1.1-1.x86_64.rpm', 200)])
+        self.assertEqual(
+            self.query('primary', "SELECT DISTINCT name FROM requires"),
+            [('libc.so.6()(64bit)',)])
+        self.assertEqual(
+            self.query('primary', "SELECT count(*) FROM files"), [(2,)])
+        self.assertEqual(
+            self.query('filelists', "SELECT dirname, filenames, filetypes "
+                                    "FROM filelist LIMIT 1"),
+            [('/', 'x', 'f')])
+        self.assertEqual(
+            self.query('other', "SELECT count(*) FROM changelog"), [(2,)])
+
+        _, entries = repomd_data(self.context.working_dir_repodata)
+        self.assertEqual(
+            self.query('primary', "SELECT dbversion, checksum FROM db_info"),
+            [(10, entries['primary'].findtext(repo_tag('checksum')))])
+        return
+
+    def test_update(self):
+        """
+        Sqlite: the previous databases are updated, not rebuilt
+        """
+        self.publish(PACKAGES)
+        newer = dict(PACKAGES[1], ver='1.2', pkgid='c' * 64, time=300)
+        self.publish(PACKAGES[1:] + [newer])
+        self.verbose.assert_any_call(
+            "%s_db: %i packages added, %i removed, %i kept",
+            'primary', 1, 1, 1)
+        self.assertEqual(
+            self.query('primary',
+                       "SELECT pkgKey, version FROM packages ORDER BY pkgKey"),
+            [(2, '1.1'), (3, '1.2')])
+        self.assertEqual(
+            self.query('primary', "SELECT DISTINCT pkgKey FROM files "
+                                  "ORDER BY pkgKey"), [(2,), (3,)])
+        self.assertEqual(
+            self.query('other', "SELECT count(*) FROM changelog"), [(2,)])
+        self.assertFalse(os.path.exists(os.path.join(
+            self.tmp_dir, '.s3yum-sqlite')))
+        return
+
+    def test_duplicate_pkgid(self):
+        """
+        Sqlite: an rpm listed at two locations has a row for each in every
+        database, as in the XML
+        """
+        copy = dict(PACKAGES[0], ver='1.0.copy')
+        for packages, count in (([PACKAGES[0], copy], 2),
+                                ([PACKAGES[0], copy, PACKAGES[1]], 3),
+                                ([PACKAGES[0]], 1)):
+            self.publish(packages)
+            for data_type in ('primary', 'filelists', 'other'):
+                self.assertEqual(
+                    self.query(data_type, "SELECT count(*) FROM packages"),
+                    [(count,)])
+        return
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr)
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
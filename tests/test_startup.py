@@ -0,0 +1,34 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+
+"""
+Test module for s3yum startup cost
+"""
+
+import logging
+import unittest
+import sys
+import subprocess
+
+
+class TestS3YumStartup(unittest.TestCase):
+    """
+    Test that short invocations don't load heavy modules
+    """
+
+    def test_lazy_imports(self):
+        """
+        Startup: importing the command line doesn't load boto/pkg_resources
+        """
+        code = ('import sys, s3yum.s3yum_cli\n'
+                'print ",".join(sorted(m for m in sys.modules if m in '
+                '("boto", "pkg_resources", "subprocess")))')
+        loaded = subprocess.check_output([sys.executable, '-c', code])
+        self.assertEqual(loaded.strip(), '')
+        return
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr)
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
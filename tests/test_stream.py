@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+
+"""
+Test module for s3yum streaming get
+"""
+
+import logging
+import unittest
+import sys
+import hashlib
+import tarfile
+import StringIO
+from mock import patch
+
+from s3yum.s3yum_types import ServiceError
+from s3yum.s3yum_cli import main
+from s3yum.stream import write_items
+
+
+class FakeKey(object):
+    """
+    Just enough of a boto key to download from.
+    """
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+        self.size = len(data)
+        self.etag = '"%s"' % hashlib.md5(data).hexdigest()
+        self.md5 = None
+        self.last_modified = '2019-01-01T00:00:00.000Z'
+        self.stream = None
+        self.fetched = False
+
+    def get_contents_as_string(self):
+        self.fetched = True
+        return self.data
+
+    def read(self, size=-1):
+        if self.stream is None:
+            self.stream = StringIO.StringIO(self.data)
+        return self.stream.read(size)
+
+    def close(self):
+        self.stream = None
+
+
+class TestS3YumStream(unittest.TestCase):
+    """
+    Test writing a repo to a tar stream
+    """
+
+    def write(self, entries, read_ahead):
+        out = StringIO.StringIO()
+        tar = tarfile.open(fileobj=out, mode='w|')
+        write_items(tar, entries, 4, read_ahead)
+        tar.close()
+        out.seek(0)
+        return tarfile.open(fileobj=out, mode='r|')
+
+    def test_ordered_stream(self):
+        """
+        Stream: files are written in order, big ones streamed unbuffered
+        """
+        keys = [FakeKey('dev/repodata/repomd.xml', 'x' * 10),
+                FakeKey('dev/big.rpm', 'b' * 100),
+                FakeKey('dev/a.rpm', 'a' * 20),
+                FakeKey('dev/c.rpm', 'c' * 30)]
+        entries = [('repodata/repomd.xml', keys[0]), ('big.rpm', keys[1]),
+                   ('a.rpm', keys[2]), ('c.rpm', keys[3])]
+        tar = self.write(entries, 50)
+        members = []
+        for member in tar:
+            members.append((member.name, tar.extractfile(member).read()))
+        self.assertEqual(members, [(name, key.data) for name, key in entries])
+        self.assertEqual(members[0][0], 'repodata/repomd.xml')
+        self.assertFalse(keys[1].fetched)
+        self.assertTrue(keys[2].fetched)
+        return
+
+    def test_md5_mismatch(self):
+        """
+        Stream: corrupt downloads fail the stream
+        """
+        key = FakeKey('dev/a.rpm', 'a' * 20)
+        key.etag = '"0123"'
+        self.assertRaises(ServiceError, self.write, [('a.rpm', key)], 50)
+        self.assertRaises(ServiceError, self.write, [('a.rpm', key)], 10)
+        return
+
+    def test_failure(self):
+        """
+        Stream: a failed stream to stdout reports to stderr, not into the
+        tar, and exits non-zero
+        """
+        stdout = StringIO.StringIO()
+        stderr = StringIO.StringIO()
+        with patch('sys.stdout', stdout), patch('sys.stderr', stderr), \
+                patch('s3yum.s3yum_cli.connect_to_bucket'), \
+                patch('s3yum.s3yum_cli.list_and_perform_action',
+                      side_effect=ServiceError("Transfer failed")):
+            status = main(['s3yum', 'get', '--stream', '-b', 'bucket'])
+        self.assertEqual(status, 1)
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertIn("Transfer failed", stderr.getvalue())
+        return
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr)
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
@@ -9,13 +9,17 @@ import logging
 import unittest
 import sys
 import datetime
+import optparse
 from mock import (
     MagicMock,
     patch,
     )
 
 from s3yum.s3yum_types import S3YumContext
-from s3yum.s3yum_cli import should_upload
+from s3yum.s3yum_cli import (
+    should_upload,
+    get_upload_headers,
+    )
 
 
 class TestS3YumCliUploads(unittest.TestCase):
@@ -124,6 +128,46 @@ class TestS3YumCliUploads(unittest.TestCase):
             self.assertFalse(should_upload(filepath, item, False))
         return
 
+    #-----------------------------
+    # Upload: Headers
+    #-----------------------------
+    def test_upload_headers(self):
+        """
+        Upload: immutable files are cached long, repomd.xml briefly
+        """
+        context = S3YumContext()
+        context.opts = optparse.Values({
+            'no_cache_headers': False,
+            'max_age': 1000,
+            'repomd_max_age': 10})
+
+        headers = get_upload_headers(context, 'foo-1.0-1.x86_64.rpm')
+        self.assertEqual(headers['Content-Type'], 'application/x-rpm')
+        self.assertEqual(headers['Cache-Control'],
+                         'public, max-age=1000, immutable')
+
+        headers = get_upload_headers(
+            context, '0123456789abcdef0123456789abcdef-primary.xml.gz')
+        self.assertEqual(headers['Content-Type'], 'application/x-gzip')
+        self.assertEqual(headers['Cache-Control'],
+                         'public, max-age=1000, immutable')
+
+        for filename in ('repomd.xml', 'primary.xml.gz'):
+            headers = get_upload_headers(context, filename)
+            self.assertEqual(headers['Cache-Control'],
+                             'public, max-age=10, must-revalidate')
+
+        context.opts.no_cache_headers = True
+        self.assertEqual(get_upload_headers(context, 'repomd.xml'), {})
+
+        # Rpm's carry their sha256, for verify:
+        with patch('s3yum.s3yum_cli.get_file_sha256',
+                   MagicMock(return_value='ab' * 32)):
+            headers = get_upload_headers(
+                context, 'foo-1.0-1.x86_64.rpm', '/tmp/foo-1.0-1.x86_64.rpm')
+        self.assertEqual(headers, {'x-amz-meta-sha256': 'ab' * 32})
+        return
+
 if __name__ == '__main__':
     logging.basicConfig(stream=sys.stderr)
     logging.getLogger().setLevel(logging.DEBUG)
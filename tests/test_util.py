@@ -7,20 +7,34 @@ Test module for s3yum.util
 
 import logging
 import unittest
+import os
 import sys
-import io
+import shutil
 import hashlib
+import tempfile
 import datetime
 from mock import (
     MagicMock,
     patch,
     )
 
+from s3yum import util
 from s3yum.util import (
     s3join,
     get_s3item_md5,
     md5_matches,
     s3time_as_datetime,
+    datetime_as_s3time,
+    json_to_gzip,
+    gzip_to_json,
+    list_keys_sharded,
+    quantile_boundaries,
+    charset_boundaries,
+    GlobMatcher,
+    hash_file,
+    hash_files,
+    get_file_md5,
+    get_file_sha256,
     )
 
 
@@ -61,16 +75,14 @@ class TestS3YumUtil(unittest.TestCase):
         """
         Verify that md5 matching works properly
         """
-        filepath = 'my/random/file'
         file_contents = 'Random file contents'
         checksum = hashlib.md5(file_contents).hexdigest()
 
-        m = MagicMock(spec=file,
-            return_value=io.BytesIO(file_contents))
-        with patch('s3yum.util.open', m, create=True):
-            self.assertTrue(md5_matches(filepath,checksum))
-
-        m.assert_called_once_with(filepath, 'r')
+        with tempfile.NamedTemporaryFile() as afile:
+            afile.write(file_contents)
+            afile.flush()
+            self.assertTrue(md5_matches(afile.name, checksum))
+            self.assertFalse(md5_matches(afile.name, '0' * 32))
         return
 
     def test_s3_timestamp(self):
@@ -84,6 +96,120 @@ class TestS3YumUtil(unittest.TestCase):
         ts2 = '2015-07-08T14:50:48.000Z'
         self.assertEqual(s3time_as_datetime(ts2),
             datetime.datetime(2015,7,8,14,50,48))
+
+        # Our own timestamps must round trip:
+        stamp = datetime.datetime(2015,7,8,14,50,48)
+        self.assertEqual(s3time_as_datetime(datetime_as_s3time(stamp)), stamp)
+        return
+
+    def test_gzip_json(self):
+        """
+        Verify that gzip'd json round trips, and garbage is rejected
+        """
+        obj = {'version': 1, 'packages': [{'name': 'a.rpm', 'size': 1}]}
+        self.assertEqual(gzip_to_json(json_to_gzip(obj)), obj)
+        self.assertRaises(ValueError, gzip_to_json, 'not gzip data')
+        return
+
+    def test_list_sharded(self):
+        """
+        Verify that sharded listings return every key exactly once, in order
+        """
+        names = sorted(['dev/%s-1.0.rpm' % c for c in 'abcdefghij'] +
+                       ['dev/b', 'dev/repodata/repomd.xml', 'devel/x.rpm'])
+        keys = []
+        for name in names:
+            key = MagicMock()
+            key.name = name
+            keys.append(key)
+
+        def fake_list(prefix, marker):
+            return [k for k in keys
+                    if k.name.startswith(prefix) and k.name > marker]
+
+        bucket = MagicMock()
+        bucket.list.side_effect = fake_list
+        for boundaries in ([], ['dev/b', 'dev/f', 'dev/r'], ['dev/b'] * 3):
+            listed = list_keys_sharded(bucket, 'dev', boundaries, 4)
+            self.assertEqual([k.name for k in listed], names)
+        return
+
+    def test_boundaries(self):
+        """
+        Verify that shard boundaries are evenly spaced and unique
+        """
+        self.assertEqual(quantile_boundaries(['d', 'c', 'b', 'a'], 2), ['c'])
+        self.assertEqual(quantile_boundaries(['a', 'b'], 1), [])
+        self.assertEqual(quantile_boundaries(['a'], 8), ['a'])
+        self.assertEqual(charset_boundaries('dev/', 'abcd', 4),
+                         ['dev/b', 'dev/c', 'dev/d'])
+        return
+
+    def test_glob_matcher(self):
+        """
+        Verify that GlobMatcher agrees with fnmatch and reports unused globs
+        """
+        import fnmatch
+        names = ['dev/bar-1.0-1.noarch.rpm', 'dev/foo-1.0-1.x86_64.rpm',
+                 'dev/foo-2.0-1.x86_64.rpm', 'dev/foo-devel-2.0-1.x86_64.rpm',
+                 'prod/foo-1.0-1.x86_64.rpm']
+        patterns = ['dev/bar-1.0-1.noarch.rpm', 'dev/foo-[12].*', '*/foo-*',
+                    '*/foo-2*', '*/baz-*', 'dev/qux-*', 'prod/missing.rpm']
+        matcher = GlobMatcher(patterns)
+        self.assertEqual(matcher.filter(names), [
+            name for name in names
+            if any(fnmatch.fnmatch(name, p) for p in patterns)])
+        self.assertEqual(matcher.unmatched(),
+                         ['*/baz-*', 'dev/qux-*', 'prod/missing.rpm'])
+
+        # More globs than one regex can hold:
+        many = GlobMatcher(['*/pkg%i-*' % i for i in range(250)])
+        self.assertEqual(many.filter(['dev/pkg7-1.rpm', 'dev/pkg249-1.rpm',
+                                      'dev/pkg250-1.rpm']),
+                         ['dev/pkg7-1.rpm', 'dev/pkg249-1.rpm'])
+        self.assertEqual(len(many.unmatched()), 248)
+        return
+
+    def test_bulk_hashing(self):
+        """
+        Hashing: md5 and sha256 in one pass, in a process pool, cached until
+        the file changes
+        """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            contents = ['', 'a', 'b' * (3 * 1024 * 1024 + 7)]
+            paths = []
+            for index, data in enumerate(contents):
+                paths.append(os.path.join(tmp_dir, '%i.rpm' % index))
+                with open(paths[-1], 'w') as afile:
+                    afile.write(data)
+            expected = [(hashlib.md5(data).hexdigest(),
+                         hashlib.sha256(data).hexdigest())
+                        for data in contents]
+            self.assertEqual([hash_file(path) for path in paths], expected)
+
+            # An unreadable file doesn't stop the others being hashed:
+            unreadable = os.path.join(tmp_dir, 'dir.rpm')
+            os.mkdir(unreadable)
+            with patch('s3yum.util.BULK_HASH_BYTES', 0):
+                hash_files([unreadable] + paths +
+                           [os.path.join(tmp_dir, 'missing')], 2)
+            with patch('s3yum.util.hash_file') as rehash:
+                self.assertEqual(
+                    [(get_file_md5(path), get_file_sha256(path))
+                     for path in paths], expected)
+                self.assertFalse(rehash.called)
+
+            with open(paths[1], 'a') as afile:
+                afile.write('aa')
+            self.assertEqual(get_file_md5(paths[1]),
+                             hashlib.md5('aaa').hexdigest())
+
+            with patch('s3yum.util.HASH_CACHE_ENTRIES', 2):
+                get_file_md5(paths[0])
+                self.assertEqual(len(util._HASHES), 2)
+        finally:
+            shutil.rmtree(tmp_dir)
         return
 
 
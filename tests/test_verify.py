@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+
+"""
+Test module for s3yum verify
+"""
+
+import logging
+import unittest
+import sys
+from mock import MagicMock
+
+from s3yum.verify import (
+    compare_listing,
+    head_check
+)
+
+SHA_A = 'a' * 64
+SHA_B = 'b' * 64
+
+
+def package(name, pkgid, size=100):
+    return {'location': name, 'pkgid': pkgid, 'checksum_type': 'sha256',
+            'size': size}
+
+
+def mock_item(name, size=100, etag='e1', sha256=None):
+    item = MagicMock()
+    item.name = name
+    item.size = size
+    item.etag = '"%s"' % etag
+    item.md5 = None
+    item.get_metadata.return_value = sha256
+    return item
+
+
+class TestS3YumVerify(unittest.TestCase):
+    """
+    Test comparing repo metadata with the objects in the bucket
+    """
+
+    def test_compare_listing(self):
+        """
+        Verify: missing, orphaned and mismatched packages are found
+        """
+        packages = [package('a.rpm', SHA_A), package('b.rpm', SHA_B),
+                    package('c.rpm', SHA_A), package('d.rpm', SHA_A, 50)]
+        items = [mock_item('dev/a.rpm'), mock_item('dev/b.rpm', etag='e2'),
+                 mock_item('dev/d.rpm'), mock_item('dev/x.rpm')]
+        manifest = {'packages': [
+            {'name': 'dev/a.rpm', 'etag': 'e1', 'sha256': SHA_B},
+            # Stale entry: the object has been replaced since
+            {'name': 'dev/b.rpm', 'etag': 'e1', 'sha256': SHA_A},
+        ]}
+        missing, orphaned, mismatched, pairs = compare_listing(
+            'dev', packages, items, manifest)
+        self.assertEqual(missing, ['dev/c.rpm'])
+        self.assertEqual(orphaned, ['dev/x.rpm'])
+        self.assertEqual([name for name, _ in mismatched],
+                         ['dev/a.rpm', 'dev/d.rpm'])
+        self.assertEqual(len(pairs), 3)
+        return
+
+    def test_head_check(self):
+        """
+        Verify: HEAD requests check size, ETag and the stored sha256
+        """
+        bucket = MagicMock()
+        listed = mock_item('dev/a.rpm')
+
+        bucket.get_key.return_value = mock_item('dev/a.rpm', sha256=SHA_A)
+        self.assertEqual(head_check(bucket, (package('a.rpm', SHA_A), listed)),
+                         ('dev/a.rpm', None, True))
+
+        bucket.get_key.return_value = mock_item('dev/a.rpm', sha256=SHA_B)
+        self.assertTrue(head_check(
+            bucket, (package('a.rpm', SHA_A), listed))[1].startswith('sha256'))
+
+        bucket.get_key.return_value = mock_item('dev/a.rpm', etag='e2')
+        self.assertTrue(head_check(
+            bucket, (package('a.rpm', SHA_A), listed))[1].startswith('ETag'))
+
+        bucket.get_key.return_value = None
+        self.assertEqual(head_check(
+            bucket, (package('a.rpm', SHA_A), listed))[2], False)
+        return
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr)
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,163 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-15 -*-
+
+"""
+Test module for the s3yum watch action
+"""
+
+import os
+import time
+import shutil
+import logging
+import unittest
+import tempfile
+import threading
+import sys
+from mock import MagicMock
+
+from s3yum.daemon import (
+    PUBLISHED,
+    FAILED
+)
+from s3yum.watch import (
+    DropWatcher,
+    Inotify
+)
+
+
+def s3item(name, size):
+    item = MagicMock()
+    item.name = name
+    item.size = size
+    return item
+
+
+class TestS3YumWatch(unittest.TestCase):
+    """
+    Test finding completed rpm's in a drop directory
+    """
+
+    def setUp(self):
+        self.drop_dir = tempfile.mkdtemp()
+        self.daemon = MagicMock()
+        self.daemon.queue_file.return_value = 1
+        self.daemon.status.return_value = {'status': 'queued'}
+        return
+
+    def tearDown(self):
+        shutil.rmtree(self.drop_dir)
+        return
+
+    def drop(self, filename, data='x' * 10):
+        with open(os.path.join(self.drop_dir, filename), 'w') as rpm:
+            rpm.write(data)
+        return
+
+    def queued(self):
+        return sorted(os.path.basename(c[0][0])
+                      for c in self.daemon.queue_file.call_args_list)
+
+    def test_startup(self):
+        """
+        Watch: rpm's already in the repo with the same size aren't queued
+        """
+        self.drop('a-1.rpm')
+        self.drop('b-1.rpm')
+        watcher = DropWatcher(self.daemon, self.drop_dir, [
+            s3item('repo/a-1.rpm', 10), s3item('repo/b-1.rpm', 5)])
+        watcher.scan()
+        watcher.scan()
+        self.assertEqual(self.queued(), ['b-1.rpm'])
+        return
+
+    def test_scan(self):
+        """
+        Watch: scanned files are queued once they stop changing
+        """
+        watcher = DropWatcher(self.daemon, self.drop_dir)
+        self.drop('a-1.rpm')
+        self.drop('.b-1.rpm.part')
+        self.drop('notes.txt')
+        self.assertEqual(watcher.scan(), 0)
+        self.assertEqual(watcher.scan(), 1)
+        self.assertEqual(watcher.scan(), 0)
+        self.assertEqual(self.queued(), ['a-1.rpm'])
+
+        # Completed files are queued straight away:
+        self.drop('c-1.rpm')
+        self.assertEqual(watcher.scan(['c-1.rpm']), 1)
+
+        # A rewritten rpm is queued again:
+        self.drop('a-1.rpm', 'y' * 20)
+        self.assertEqual(watcher.scan(['a-1.rpm']), 1)
+        self.assertEqual(self.queued(), ['a-1.rpm', 'a-1.rpm', 'c-1.rpm'])
+        return
+
+    def test_failed_batch(self):
+        """
+        Watch: the rpm's of a failed batch are queued again
+        """
+        watcher = DropWatcher(self.daemon, self.drop_dir)
+        self.drop('a-1.rpm')
+        watcher.scan(['a-1.rpm'])
+        self.daemon.status.return_value = {'status': PUBLISHED}
+        watcher.check_batches()
+        self.assertEqual(watcher.scan(), 0)
+
+        self.drop('b-1.rpm')
+        watcher.scan(['b-1.rpm'])
+        self.daemon.status.return_value = {'status': FAILED}
+        watcher.check_batches()
+        self.assertEqual(watcher.batches, {})
+        self.assertEqual(watcher.scan(), 1)
+        self.assertEqual(self.queued(), ['a-1.rpm', 'b-1.rpm', 'b-1.rpm'])
+        return
+
+    def test_inotify(self):
+        """
+        Watch: inotify reports files closed after writing, or moved in
+        """
+        try:
+            inotify = Inotify(self.drop_dir)
+        except OSError:
+            raise unittest.SkipTest("inotify is not available")
+        try:
+            self.assertEqual(inotify.read(0), [])
+            self.drop('a-1.rpm')
+            tmp_path = os.path.join(self.drop_dir, '..b-1.rpm.tmp')
+            open(tmp_path, 'w').close()
+            os.rename(tmp_path, os.path.join(self.drop_dir, 'b-1.rpm'))
+            names = []
+            deadline = time.time() + 5
+            while len(names) < 3 and time.time() < deadline:
+                names.extend(inotify.read(1))
+            self.assertEqual(names, ['a-1.rpm', '..b-1.rpm.tmp', 'b-1.rpm'])
+        finally:
+            inotify.close()
+        return
+
+    def test_run(self):
+        """
+        Watch: polling finds files, until stopped
+        """
+        watcher = DropWatcher(self.daemon, self.drop_dir)
+        self.drop('a-1.rpm')
+        stop = threading.Event()
+        thread = threading.Thread(target=watcher.run, args=(0.05, None, stop))
+        thread.start()
+        try:
+            deadline = time.time() + 5
+            while not self.daemon.queue_file.called and \
+                    time.time() < deadline:
+                time.sleep(0.05)
+        finally:
+            stop.set()
+            thread.join()
+        self.assertEqual(self.queued(), ['a-1.rpm'])
+        return
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stderr)
+    logging.getLogger().setLevel(logging.DEBUG)
+    unittest.main()